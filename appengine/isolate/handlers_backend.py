@@ -298,6 +298,9 @@ class InternalTagWorkerHandler(webapp2.RequestHandler):
           to_save.append(item)
       if to_save:
         ndb.put_multi(to_save)
+        # The entries tagged are the hot ones, keep them in the existence
+        # filter so the next /preupload doesn't need the datastore.
+        model.add_to_existence_filter(to_save)
       logging.info(
           'Timestamped %d entries out of %s', len(to_save), len(digests))
     except Exception as e:
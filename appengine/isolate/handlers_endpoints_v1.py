@@ -10,6 +10,7 @@ import hashlib
 import logging
 import os
 import re
+import struct
 import time
 import zlib
 
@@ -38,6 +39,20 @@ import stats
 # Cloud Storage, otherwise it is stored as a blob property.
 MIN_SIZE_FOR_GS = 501
 
+# The maximum number of entries that can be retrieved or stored at once by
+# retrieve_batch and store_inline_batch, and the maximum total size of the
+# content retrieved. The entries past that size are returned as
+# BATCH_NOT_INLINE.
+MAX_ITEMS_PER_BATCH = 1000
+MAX_BATCH_SIZE = 16 * 1024 * 1024
+
+# Length set in RetrievedBatch for an entry whose content is not returned.
+BATCH_NOT_INLINE = 0xffffffff
+
+# A digest is included in at most one tag task during this number of seconds,
+# the following lookups of the same digest do not enqueue it again.
+TAG_COALESCING_TIME = 60*60
+
 
 ### Request Types
 
@@ -68,6 +83,11 @@ class StorageRequest(messages.Message):
   content = messages.BytesField(2)
 
 
+class StorageBatchRequest(messages.Message):
+  """Many small entities to be added to the data store at once."""
+  items = messages.MessageField(StorageRequest, 1, repeated=True)
+
+
 class FinalizeRequest(messages.Message):
   """Request to validate upload of large Google storage entities."""
   upload_ticket = messages.StringField(1)
@@ -80,6 +100,12 @@ class RetrieveRequest(messages.Message):
   offset = messages.IntegerField(3, default=0)
 
 
+class RetrieveBatchRequest(messages.Message):
+  """Request to retrieve the content of many entries stored inline at once."""
+  digests = messages.StringField(1, repeated=True)
+  namespace = messages.MessageField(Namespace, 2)
+
+
 ### Response Types
 
 
@@ -101,6 +127,17 @@ class RetrievedContent(messages.Message):
   url = messages.StringField(2)
 
 
+class RetrievedBatch(messages.Message):
+  """Content retrieved from memcache or DB for a RetrieveBatchRequest.
+
+  For each requested digest, in order, |content| holds the length of the entry
+  as a 32 bits big endian integer followed by its content. The length is
+  BATCH_NOT_INLINE, without content, when the entry must be fetched with
+  retrieve instead, e.g. it is in GS.
+  """
+  content = messages.BytesField(1)
+
+
 class PushPing(messages.Message):
   """Indicates whether data storage executed successfully."""
   ok = messages.BooleanField(1)
@@ -219,7 +256,7 @@ class IsolateService(remote.Service):
           'Only up to 1000 items can be looked up at once')
 
     # check for existing elements
-    new_digests, existing_digests = self.partition_collection(request)
+    new_digests, existing_digests, to_tag = self.partition_collection(request)
 
     # process all elements; add an upload ticket for cache misses
     for index, digest_element in enumerate(request.items):
@@ -248,7 +285,7 @@ class IsolateService(remote.Service):
 
     # Tag existing entities and collect stats.
     self.tag_existing(DigestCollection(
-        items=list(existing_digests), namespace=request.namespace))
+        items=list(to_tag), namespace=request.namespace))
     stats.add_entry(stats.LOOKUP, len(request.items), len(existing_digests))
     return response
 
@@ -258,6 +295,24 @@ class IsolateService(remote.Service):
     """Stores relatively small entities in the datastore."""
     return self.storage_helper(request, False)
 
+  @auth.endpoints_method(StorageBatchRequest, PushPing)
+  @auth.require(acl.isolate_writable)
+  def store_inline_batch(self, request):
+    """Stores many relatively small entities in the datastore in one call.
+
+    Like store_inline, the content is verified synchronously so no
+    verification task is needed.
+    """
+    if len(request.items) > MAX_ITEMS_PER_BATCH:
+      raise endpoints.BadRequestException(
+          'Only up to %d items can be stored at once' % MAX_ITEMS_PER_BATCH)
+    entries = [self.entry_from_request(item, False) for item in request.items]
+    ndb.put_multi(entries)
+    stats.add_entry(
+        stats.STORE, sum(e.compressed_size for e in entries),
+        'inline; batch %d' % len(entries))
+    return PushPing(ok=True)
+
   @auth.endpoints_method(FinalizeRequest, PushPing)
   @auth.require(acl.isolate_writable)
   def finalize_gs_upload(self, request):
@@ -312,6 +367,44 @@ class IsolateService(remote.Service):
         filename=key.id(),
         expiration=DEFAULT_LINK_EXPIRATION))
 
+  @auth.endpoints_method(RetrieveBatchRequest, RetrievedBatch)
+  @auth.require(acl.isolate_readable)
+  def retrieve_batch(self, request):
+    """Retrieves the content of many small entries in one call."""
+    if len(request.digests) > MAX_ITEMS_PER_BATCH:
+      raise endpoints.BadRequestException(
+          'Only up to %d items can be retrieved at once' % MAX_ITEMS_PER_BATCH)
+    namespace = request.namespace.namespace
+    keys = dict(
+        (digest, entry_key_or_error(namespace, digest))
+        for digest in request.digests)
+
+    # Look in memcache first, then fetch the rest from the DB in one call.
+    contents = memcache.get_multi(
+        request.digests, namespace='table_%s' % namespace)
+    missing = [d for d in request.digests if d not in contents]
+    for digest, stored in zip(
+        missing, ndb.get_multi([keys[d] for d in missing])):
+      # content is None if the entity is in GCS.
+      if stored is not None and stored.content is not None:
+        contents[digest] = stored.content
+
+    out = []
+    returned = 0
+    total = 0
+    for digest in request.digests:
+      content = contents.get(digest)
+      if content is None or total + len(content) > MAX_BATCH_SIZE:
+        out.append(struct.pack('>I', BATCH_NOT_INLINE))
+        continue
+      out.append(struct.pack('>I', len(content)))
+      out.append(content)
+      returned += 1
+      total += len(content)
+    logging.debug('Returning %d of %d entries', returned, len(request.digests))
+    stats.add_entry(stats.RETURN, total, 'batch; %d' % returned)
+    return RetrievedBatch(content=''.join(out))
+
   @auth.endpoints_method(message_types.VoidMessage, ServerDetails)
   @auth.require(acl.isolate_readable)
   def server_details(self, _request):
@@ -319,14 +412,43 @@ class IsolateService(remote.Service):
 
   ### Utility
 
-  @staticmethod
-  def storage_helper(request, uploaded_to_gs):
+  @classmethod
+  def storage_helper(cls, request, uploaded_to_gs):
     """Implement shared logic between store_inline and finalize_gs.
 
     Arguments:
       request: either StorageRequest or FinalizeRequest.
       uploaded_to_gs: bool.
     """
+    entry = cls.entry_from_request(request, uploaded_to_gs)
+    if not uploaded_to_gs:
+      entry.put()
+    else:
+      # Enqueue verification task transactionally as the entity is stored.
+      try:
+        store_and_enqueue_verify_task(entry, utils.get_task_queue_host())
+      except (
+          datastore_errors.Error,
+          runtime.apiproxy_errors.CancelledError,
+          runtime.apiproxy_errors.DeadlineExceededError,
+          runtime.apiproxy_errors.OverQuotaError,
+          runtime.DeadlineExceededError,
+          taskqueue.Error) as e:
+        raise endpoints.InternalServerErrorException(
+            'Unable to store the entity: %s.' % e.__class__.__name__)
+
+    stats.add_entry(
+        stats.STORE, entry.compressed_size,
+        'GS; %s' % entry.key.id() if uploaded_to_gs else 'inline')
+    return PushPing(ok=True)
+
+  @staticmethod
+  def entry_from_request(request, uploaded_to_gs):
+    """Returns the unsaved ContentEntry described by a StorageRequest or
+    FinalizeRequest.
+
+    The ticket is validated and the content of an inline entry is verified.
+    """
     if not request.upload_ticket:
       raise endpoints.BadRequestException(
           'Upload ticket was empty or not provided.')
@@ -379,25 +501,7 @@ class IsolateService(remote.Service):
             'Embedded digest does not match provided data: '
             '(digest, size): (%r, %r); expected: %r' % (
                 digest, size, hash_content(content, namespace)))
-      entry.put()
-    else:
-      # Enqueue verification task transactionally as the entity is stored.
-      try:
-        store_and_enqueue_verify_task(entry, utils.get_task_queue_host())
-      except (
-          datastore_errors.Error,
-          runtime.apiproxy_errors.CancelledError,
-          runtime.apiproxy_errors.DeadlineExceededError,
-          runtime.apiproxy_errors.OverQuotaError,
-          runtime.DeadlineExceededError,
-          taskqueue.Error) as e:
-        raise endpoints.InternalServerErrorException(
-            'Unable to store the entity: %s.' % e.__class__.__name__)
-
-    stats.add_entry(
-        stats.STORE, entry.compressed_size,
-        'GS; %s' % entry.key.id() if uploaded_to_gs else 'inline')
-    return PushPing(ok=True)
+    return entry
 
   @classmethod
   def generate_ticket(cls, digest, namespace):
@@ -431,35 +535,70 @@ class IsolateService(remote.Service):
 
   @staticmethod
   def check_entries_exist(entries):
-    """Assess which entities already exist in the datastore.
+    """Assess which entities already exist.
+
+    The entries found in the existence filter with the expected size are not
+    looked up in the datastore. The entries found in the datastore are added
+    to the filter.
 
     Arguments:
       entries: a DigestCollection to be posted
 
     Yields:
-      (Digest, ContentEntry or None)
+      (Digest, bool exists, expanded size, next_tag_ts), the last two being None
+      for the missing entries.
 
     Raises:
       BadRequestException if any digest is not a valid hexadecimal number.
     """
+    keys = [
+      (digest, entry_key_or_error(entries.namespace.namespace, digest.digest))
+      for digest in entries.items
+    ]
+    cached = model.get_existence_filter([key.id() for _, key in keys])
+
     # Kick off all queries in parallel. Build mapping Future -> digest.
     futures = {}
-    for digest in entries.items:
-      # check for error conditions
-      key = entry_key_or_error(entries.namespace.namespace, digest.digest)
-      futures[key.get_async(use_cache=False)] = digest
+    hits = []
+    for digest, key in keys:
+      value = cached.get(key.id())
+      if value and value[0] == digest.size:
+        hits.append((digest, value[1]))
+      else:
+        futures[key.get_async(use_cache=False)] = digest
+
+    for digest, next_tag_ts in hits:
+      yield digest, True, digest.size, next_tag_ts
 
     # Pick first one that finishes and yield it, rinse, repeat.
+    found = []
     while futures:
       future = ndb.Future.wait_any(futures)
-      yield futures.pop(future), future.get_result()
+      digest = futures.pop(future)
+      obj = future.get_result()
+      if obj:
+        found.append(obj)
+        yield digest, True, obj.expanded_size, obj.next_tag_ts
+      else:
+        yield digest, False, None, None
+    model.add_to_existence_filter(found)
+    logging.debug(
+        'Existence filter: %d hits, %d misses', len(hits),
+        len(keys) - len(hits))
 
   @classmethod
   def partition_collection(cls, entries):
-    """Create sets of existent and new digests."""
+    """Create sets of new digests, existent digests and existent digests to
+    tag, i.e. whose next_tag_ts passed.
+    """
     seen_unseen = [set(), set()]
-    for digest, obj in cls.check_entries_exist(entries):
-      if obj and obj.expanded_size != digest.size:
+    to_tag = set()
+    now = utils.utcnow()
+    for digest, exists, expanded_size, next_tag_ts in cls.check_entries_exist(
+        entries):
+      if exists and (not next_tag_ts or next_tag_ts < now):
+        to_tag.add(digest)
+      if exists and expanded_size != digest.size:
         # It is important to note that when a file is uploaded to GCS,
         # ContentEntry is only stored in the finalize call, which is (supposed)
         # to be called only after the GCS upload completed successfuly.
@@ -487,15 +626,15 @@ class IsolateService(remote.Service):
         logging.error(
             'Upload race.\n%s is not yet fully uploaded.', digest.digest)
         # TODO(maruel): Force the client to upload.
-        #obj = None
-      seen_unseen[bool(obj)].add(digest)
+        #exists = False
+      seen_unseen[exists].add(digest)
     logging.debug(
         'Hit:%s',
         ''.join(sorted('\n%s' % d.digest for d in seen_unseen[True])))
     logging.debug(
         'Missing:%s',
         ''.join(sorted('\n%s' % d.digest for d in seen_unseen[False])))
-    return seen_unseen
+    return seen_unseen[False], seen_unseen[True], to_tag
 
   @staticmethod
   def should_push_to_gs(digest):
@@ -521,16 +660,35 @@ class IsolateService(remote.Service):
   def tag_existing(collection):
     """Tag existing digests with new timestamp.
 
+    The digests already enqueued for tagging in the last TAG_COALESCING_TIME
+    seconds are skipped, so a popular digest is tagged once per period instead
+    of once per lookup.
+
     Arguments:
       collection: a DigestCollection containing existing digests
 
     Returns:
-      the enqueued task if there were existing entries; None otherwise
+      True if the task was enqueued, False if it failed, None if there were no
+      digests to tag.
     """
-    if collection.items:
-      url = '/internal/taskqueue/tag/%s/%s' % (
-          collection.namespace.namespace,
-          utils.datetime_to_timestamp(utils.utcnow()))
-      payload = ''.join(
-          binascii.unhexlify(digest.digest) for digest in collection.items)
-      return utils.enqueue_task(url, 'tag', payload=payload)
+    if not collection.items:
+      return None
+    namespace = collection.namespace.namespace
+    memcache_namespace = 'tagged_%s' % namespace
+    digests = sorted(set(d.digest for d in collection.items))
+    already_tagged = memcache.get_multi(digests, namespace=memcache_namespace)
+    digests = [d for d in digests if d not in already_tagged]
+    if not digests:
+      return None
+    url = '/internal/taskqueue/tag/%s/%s' % (
+        namespace, utils.datetime_to_timestamp(utils.utcnow()))
+    payload = ''.join(binascii.unhexlify(d) for d in digests)
+    if not utils.enqueue_task(url, 'tag', payload=payload):
+      return False
+    # Only mark the digests once the task is enqueued, otherwise a failure
+    # would skip tagging them for TAG_COALESCING_TIME. Concurrent requests may
+    # still both enqueue a task, tagging twice is harmless.
+    memcache.set_multi(
+        dict.fromkeys(digests, True), time=TAG_COALESCING_TIME,
+        namespace=memcache_namespace)
+    return True
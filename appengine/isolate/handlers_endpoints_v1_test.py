@@ -7,6 +7,7 @@ import base64
 import hashlib
 import json
 import logging
+import struct
 import sys
 import unittest
 from Crypto.PublicKey import RSA
@@ -220,7 +221,7 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     response = self.call_api(
         'preupload', self.message_to_dict(collection), 200)
 
-    # we should see one enqueued task and two new URLs in the response
+    # we should see two new URLs in the response
     items = response.json['items']
     self.assertEqual(2, len(items))
     self.assertEqual([1, 2], [int(item['index']) for item in items])
@@ -238,8 +239,10 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     key = model.get_entry_key(
         collection.namespace.namespace, collection.items[0].digest)
 
-    # guarantee that one digest already exists in the datastore
-    model.new_content_entry(key).put()
+    # guarantee that one digest already exists in the datastore, due for a tag
+    entry = model.new_content_entry(key)
+    entry.next_tag_ts = utils.utcnow()
+    entry.put()
     self.call_api(
         'preupload', self.message_to_dict(collection), 200)
 
@@ -247,6 +250,102 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     enqueued_tasks = self.execute_tasks()
     self.assertEqual(1, enqueued_tasks)
 
+  def test_check_existing_coalesces_tags(self):
+    """Assert that an entity is tagged at most once per period."""
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    entry = model.new_content_entry(key)
+    entry.next_tag_ts = utils.utcnow()
+    entry.put()
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(1, self.execute_tasks())
+
+  def test_check_existing_retags_after_enqueue_failure(self):
+    """Assert that an entity is tagged again if the task couldn't be enqueued.
+    """
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    entry = model.new_content_entry(key)
+    entry.next_tag_ts = utils.utcnow()
+    entry.put()
+    old_enqueue_task = utils.enqueue_task
+    self.mock(utils, 'enqueue_task', lambda *_args, **_kwargs: False)
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.mock(utils, 'enqueue_task', old_enqueue_task)
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(1, self.execute_tasks())
+
+  def test_check_existing_skips_tag_not_due(self):
+    """Assert that entities whose next_tag_ts is in the future are not
+    tagged.
+    """
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(key).put()
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(0, self.execute_tasks())
+
+  def test_check_existing_uses_existence_filter(self):
+    """Assert that verified entities found once are then found in memcache."""
+    collection = generate_collection(['verified content', 'other content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(
+        key, expanded_size=collection.items[0].size).put()
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([1], [int(i['index']) for i in response.json['items']])
+    entry = key.get()
+    self.assertEqual(
+        {key.id(): (collection.items[0].size, entry.next_tag_ts)},
+        model.get_existence_filter([key.id()]))
+
+    # The datastore is not read again for this entry.
+    key.delete()
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([1], [int(i['index']) for i in response.json['items']])
+
+    # Deleting it properly removes it from the filter.
+    self.mock(gcs, 'delete_file', lambda *_args, **_kwargs: None)
+    model.delete_entry_and_gs_entry([key])
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(
+        [0, 1], [int(i['index']) for i in response.json['items']])
+    _ = self.execute_tasks()
+
+  def test_check_existing_uses_old_existence_filter(self):
+    """Assert that the entries added by the previous version are still used."""
+    collection = generate_collection(['verified content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    memcache.set(
+        key.id(), collection.items[0].size,
+        namespace=model.EXISTENCE_MEMCACHE_NAMESPACE)
+    self.assertEqual(
+        {key.id(): (collection.items[0].size, None)},
+        model.get_existence_filter([key.id()]))
+    # The entry is not in the datastore but is found in the filter.
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([], response.json.get('items', []))
+    _ = self.execute_tasks()
+
+  def test_check_existing_skips_existence_filter_for_unverified(self):
+    """Assert that unverified entities are always read from the datastore."""
+    collection = generate_collection(['unverified content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(key, expanded_size=-1).put()
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual({}, model.get_existence_filter([key.id()]))
+    _ = self.execute_tasks()
+
   def test_store_inline_ok(self):
     """Assert that inline content storage completes successfully."""
     request = self.store_request('sibilance')
@@ -291,6 +390,37 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'store_inline', self.message_to_dict(request), 200)
 
+  def test_store_inline_batch_ok(self):
+    """Assert that many inline entries are stored at once."""
+    requests = [self.store_request(c) for c in ('Ozymandias', 'Mont Blanc')]
+    batch = handlers_endpoints_v1.StorageBatchRequest(items=requests)
+    self.call_api('store_inline_batch', self.message_to_dict(batch), 200)
+    for request in requests:
+      embedded = validate(
+          request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+      stored = model.get_entry_key(embedded['n'], embedded['d']).get()
+      self.assertEqual(request.content, stored.content)
+      self.assertTrue(stored.is_verified)
+
+  def test_store_inline_batch_bad_content(self):
+    """Assert that nothing is stored when one entry of a batch is invalid."""
+    good = self.store_request('Adonais')
+    bad = self.store_request('Alastor')
+    bad.content = 'Hellas'
+    batch = handlers_endpoints_v1.StorageBatchRequest(items=[good, bad])
+    with self.call_should_fail('400'):
+      self.call_api('store_inline_batch', self.message_to_dict(batch), 200)
+    embedded = validate(
+        good.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+    self.assertIsNone(model.get_entry_key(embedded['n'], embedded['d']).get())
+
+  def test_store_inline_batch_too_many(self):
+    request = self.store_request('Queen Mab')
+    batch = handlers_endpoints_v1.StorageBatchRequest(
+        items=[request] * (handlers_endpoints_v1.MAX_ITEMS_PER_BATCH + 1))
+    with self.call_should_fail('400'):
+      self.call_api('store_inline_batch', self.message_to_dict(batch), 200)
+
   def test_store_inline_no_upload_ticket(self):
     """Assert that inline content storage fails when there is no ticket."""
     request = self.store_request('silence')
@@ -524,6 +654,52 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'retrieve', self.message_to_dict(retrieve_request), 200)
 
+  def test_retrieve_batch_ok(self):
+    """Assert that inline entries are retrieved at once."""
+    contents = ['Ode to a Nightingale', 'To Autumn']
+    digests = []
+    for content in contents:
+      request = self.store_request(content)
+      self.call_api('store_inline', self.message_to_dict(request), 200)
+      digests.append(hash_content(content))
+    # One entry is only in the DB.
+    memcache.flush_all()
+    self.call_api(
+        'store_inline', self.message_to_dict(self.store_request('Lamia')), 200)
+    digests.append(hash_content('Lamia'))
+    contents.append('Lamia')
+    # Missing entries are not returned.
+    digests.insert(1, hash_content('Endymion'))
+    contents.insert(1, None)
+
+    retrieve_request = handlers_endpoints_v1.RetrieveBatchRequest(
+        digests=digests, namespace=handlers_endpoints_v1.Namespace())
+    response = self.call_api(
+        'retrieve_batch', self.message_to_dict(retrieve_request), 200)
+    data = base64.b64decode(response.json[u'content'])
+    actual = []
+    offset = 0
+    while offset < len(data):
+      size, = struct.unpack_from('>I', data, offset)
+      offset += 4
+      if size == handlers_endpoints_v1.BATCH_NOT_INLINE:
+        actual.append(None)
+        continue
+      actual.append(data[offset:offset+size])
+      offset += size
+    self.assertEqual(contents, actual)
+
+  def test_retrieve_batch_too_many(self):
+    digests = [
+      hash_content(str(i))
+      for i in xrange(handlers_endpoints_v1.MAX_ITEMS_PER_BATCH + 1)
+    ]
+    retrieve_request = handlers_endpoints_v1.RetrieveBatchRequest(
+        digests=digests, namespace=handlers_endpoints_v1.Namespace())
+    with self.call_should_fail('400'):
+      self.call_api(
+          'retrieve_batch', self.message_to_dict(retrieve_request), 200)
+
   def test_server_details_ok(self):
     """Assert that server_details returns the correct version."""
     response = self.call_api('server_details', {}, 200).json
@@ -5,6 +5,7 @@
 """This module defines Isolate Server frontend url handlers."""
 
 import datetime
+import itertools
 import json
 import re
 
@@ -40,6 +41,12 @@ _GVIZ_DESCRIPTION = {
   'contains_lookups': ('number', 'Items looked up'),
 }
 
+# Content up to this size is formatted when it is JSON.
+MAX_FORMATTED_CONTENT_SIZE = 10*1024*1024
+
+# Content is truncated past this size, the response size limit is 32mb.
+MAX_CONTENT_SIZE = 30*1024*1024
+
 # Warning: modifying the order here requires updating templates/stats.html.
 _GVIZ_COLUMNS_ORDER = (
   'key',
@@ -173,55 +180,86 @@ class ContentHandler(auth.AuthenticatingHandler):
   def get(self):
     namespace = self.request.get('namespace', 'default-gzip')
     digest = self.request.get('digest', '')
-    content = None
 
-    if digest and namespace:
-      try:
-        raw_data, entity = model.get_content(namespace, digest)
-      except ValueError:
-        self.abort(400, 'Invalid key')
-      except LookupError:
-        self.abort(404, 'Unable to retrieve the entry')
+    if not digest or not namespace:
+      self.response.write(None)
+      return
+
+    try:
+      raw_data, entity = model.get_content(namespace, digest)
+    except ValueError:
+      self.abort(400, 'Invalid key')
+    except LookupError:
+      self.abort(404, 'Unable to retrieve the entry')
+
+    if not raw_data:
+      source = gcs.read_file(config.settings().gs_bucket, entity.key.id())
+    else:
+      source = [raw_data]
+    # The content is decompressed and written as it is read, only the beginning
+    # of it is buffered to check whether it is JSON.
+    stream = model.expand_content(namespace, source)
+    head = []
+    head_size = 0
+    for data in stream:
+      head.append(data)
+      head_size += len(data)
+      if head_size > MAX_FORMATTED_CONTENT_SIZE:
+        break
+
+    self.response.headers['X-Frame-Options'] = 'SAMEORIGIN'
+    # We delete Content-Type before storing to it to avoid having two (yes,
+    # two) Content-Type headers.
+    del self.response.headers['Content-Type']
+    # Apparently, setting the content type to text/plain encourages the
+    # browser (Chrome, at least) to sniff the mime type and display
+    # things like images.  Images are autowrapped in <img> and text is
+    # wrapped in <pre>.
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.headers['Content-Disposition'] = str('filename=%s' % digest)
+    if (head_size <= MAX_FORMATTED_CONTENT_SIZE and head and
+        head[0].startswith('{')):
+      formatted = self.format_json(namespace, ''.join(head))
+      if formatted is not None:
+        self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        self.response.write(formatted)
+        return
+
+    written = 0
+    for data in itertools.chain(head, stream):
+      if written + len(data) > MAX_CONTENT_SIZE:
+        self.response.write(data[:MAX_CONTENT_SIZE - written])
+        self.response.write(
+            '\n\n[Truncated at %d bytes, use the isolateserver.py client to '
+            'download the whole content]' % MAX_CONTENT_SIZE)
+        break
+      self.response.write(data)
+      written += len(data)
+      del data
 
-      if not raw_data:
-        stream = gcs.read_file(config.settings().gs_bucket, entity.key.id())
-      else:
-        stream = [raw_data]
-      content = ''.join(model.expand_content(namespace, stream))
-
-      self.response.headers['X-Frame-Options'] = 'SAMEORIGIN'
-      # We delete Content-Type before storing to it to avoid having two (yes,
-      # two) Content-Type headers.
-      del self.response.headers['Content-Type']
-      # Apparently, setting the content type to text/plain encourages the
-      # browser (Chrome, at least) to sniff the mime type and display
-      # things like images.  Images are autowrapped in <img> and text is
-      # wrapped in <pre>.
-      self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-      self.response.headers['Content-Disposition'] = str('filename=%s' % digest)
-      if content.startswith('{'):
-        # Try to format as JSON.
-        try:
-          content = json.dumps(
-              json.loads(content), sort_keys=True, indent=2,
-              separators=(',', ': '))
-          # If we don't wrap this in html, browsers will put content in a pre
-          # tag which is also styled with monospace/pre-wrap.  We can't use
-          # anchor tags in <pre>, so we force it to be a <div>, which happily
-          # accepts links.
-          content = (
-            '<div style="font-family:monospace;white-space:pre-wrap;">%s</div>'
-             % content)
-          # Linkify things that look like hashes
-          content = re.sub(r'([0-9a-f]{40})',
-            r'<a target="_blank" href="/browse?namespace=%s' % namespace +
-              r'&digest=\1">\1</a>',
-            content)
-          self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
-        except ValueError:
-          pass
-
-    self.response.write(content)
+  @staticmethod
+  def format_json(namespace, content):
+    """Returns |content| formatted as HTML with links to the hashes, or None
+    if it is not JSON.
+    """
+    try:
+      content = json.dumps(
+          json.loads(content), sort_keys=True, indent=2,
+          separators=(',', ': '))
+    except ValueError:
+      return None
+    # If we don't wrap this in html, browsers will put content in a pre
+    # tag which is also styled with monospace/pre-wrap.  We can't use
+    # anchor tags in <pre>, so we force it to be a <div>, which happily
+    # accepts links.
+    content = (
+      '<div style="font-family:monospace;white-space:pre-wrap;">%s</div>'
+       % content)
+    # Linkify things that look like hashes
+    return re.sub(r'([0-9a-f]{40})',
+      r'<a target="_blank" href="/browse?namespace=%s' % namespace +
+        r'&digest=\1">\1</a>',
+      content)
 
 
 class StatsHandler(webapp2.RequestHandler):
@@ -9,6 +9,7 @@ import logging
 import os
 import sys
 import unittest
+import zlib
 
 import test_env
 test_env.setup_test_env()
@@ -156,6 +157,34 @@ class MainTest(test_case.TestCase):
     self.app_frontend.get(
         '/browse?namespace=default&hash=%s' % hashhex, status=404)
 
+  def test_content(self):
+    self.set_as_reader()
+    hashhex = self.gen_content(content='Foo')
+    resp = self.app_frontend.get(
+        '/content?namespace=default&digest=%s' % hashhex)
+    self.assertEqual('Foo', resp.body)
+    self.assertEqual('text/plain', resp.content_type)
+
+  def test_content_json(self):
+    self.set_as_reader()
+    hashhex = self.gen_content(content='{"a":"%s"}' % ('1' * 40))
+    resp = self.app_frontend.get(
+        '/content?namespace=default&digest=%s' % hashhex)
+    self.assertEqual('text/html', resp.content_type)
+    self.assertIn('href="/browse?namespace=default&digest=%s"' % ('1' * 40),
+        resp.body)
+
+  def test_content_truncated(self):
+    self.set_as_reader()
+    self.mock(handlers_frontend, 'MAX_FORMATTED_CONTENT_SIZE', 2)
+    self.mock(handlers_frontend, 'MAX_CONTENT_SIZE', 4)
+    hashhex = self.gen_content(
+        namespace='default-gzip', content=zlib.compress('{"a":1}'))
+    resp = self.app_frontend.get(
+        '/content?namespace=default-gzip&digest=%s' % hashhex)
+    self.assertEqual('text/plain', resp.content_type)
+    self.assertTrue(resp.body.startswith('{"a"\n\n[Truncated at 4 bytes'))
+
   def test_config(self):
     self.set_as_admin()
     resp = self.app_frontend.get('/restricted/config')
@@ -17,6 +17,7 @@ from mapreduce import mapreduce_pipeline
 
 import config
 import gcs
+import model
 
 
 # Base path to the mapreduce pipeline.
@@ -102,4 +103,5 @@ def delete_broken_entries(entry):
     # to cleanup memcache, otherwise the rest of the isolate service will still
     # think that entity exists.
     entry.key.delete(use_memcache=True)
+    model.remove_from_existence_filter([entry.key])
     logging.error('MR: deleted bad entry\n%s', entry.key.id())
@@ -33,6 +33,17 @@ MAX_MEMCACHE_ISOLATED = 500*1024
 NAMESPACE_RE = r'[a-z0-9A-Z\-._]+'
 
 
+# Memcache namespace of the existence filter, which maps the key id of the
+# ContentEntry known to exist to their expanded size and next_tag_ts.
+EXISTENCE_MEMCACHE_NAMESPACE = 'exists'
+
+
+# Seconds a ContentEntry is kept in the existence filter. Only the entries
+# expiring later than that are added, so the filter never outlives an entry
+# deleted by the cleanup cron job.
+EXISTENCE_MEMCACHE_TIME = 60*60
+
+
 #### Models
 
 
@@ -174,19 +185,24 @@ def expand_content(namespace, source):
   # TODO(maruel): Add bzip2.
   # TODO(maruel): Remove '-gzip' since it's a misnomer.
   if namespace.endswith(('-deflate', '-gzip')):
+    # At most gcs.CHUNK_SIZE bytes are decompressed at a time, so highly
+    # compressed content doesn't expand in memory.
     zlib_state = zlib.decompressobj()
     for i in source:
       data = zlib_state.decompress(i, gcs.CHUNK_SIZE)
-      yield data
+      if data:
+        yield data
       del data
       while zlib_state.unconsumed_tail:
         data = zlib_state.decompress(
             zlib_state.unconsumed_tail, gcs.CHUNK_SIZE)
-        yield data
+        if data:
+          yield data
         del data
       del i
     data = zlib_state.flush()
-    yield data
+    if data:
+      yield data
     del data
     # Forcibly delete the state.
     del zlib_state
@@ -214,6 +230,44 @@ def save_in_memcache(namespace, hash_key, content, async=False):
     logging.error(e)
 
 
+def get_existence_filter(key_ids):
+  """Returns dict(key id: (expanded size, next_tag_ts)) of the ContentEntry in
+  the existence filter.
+  """
+  values = memcache.get_multi(key_ids, namespace=EXISTENCE_MEMCACHE_NAMESPACE)
+  for key_id, value in values.iteritems():
+    if not isinstance(value, tuple):
+      # Added by a previous version, which only saved the expanded size. It
+      # stays until it expires, possibly past a rolling deploy.
+      values[key_id] = (value, None)
+  return values
+
+
+def add_to_existence_filter(entries):
+  """Adds the verified ContentEntry not expiring soon to the existence filter.
+
+  Returns the number of entries added.
+  """
+  cutoff = utils.utcnow() + datetime.timedelta(seconds=EXISTENCE_MEMCACHE_TIME)
+  values = {}
+  for e in entries:
+    # expanded_size is -1 until the content is verified.
+    if (e.expanded_size is not None and e.expanded_size >= 0 and
+        e.expiration_ts and e.expiration_ts > cutoff):
+      values[e.key.id()] = (e.expanded_size, e.next_tag_ts)
+  if values:
+    memcache.set_multi(
+        values, time=EXISTENCE_MEMCACHE_TIME,
+        namespace=EXISTENCE_MEMCACHE_NAMESPACE)
+  return len(values)
+
+
+def remove_from_existence_filter(keys):
+  """Removes the ContentEntry keys from the existence filter."""
+  memcache.delete_multi(
+      [k.id() for k in keys], namespace=EXISTENCE_MEMCACHE_NAMESPACE)
+
+
 def new_content_entry(key, **kwargs):
   """Generates a new ContentEntry for the request.
 
@@ -236,6 +290,7 @@ def delete_entry_and_gs_entry(keys_to_delete):
   futures = {}
   exc = None
   bucket = config.settings().gs_bucket
+  remove_from_existence_filter(keys_to_delete)
   # Note that some content entries may NOT have corresponding GS files. That
   # happens for small entries stored inline in the datastore or memcache. Since
   # this function operates only on keys, it can't distinguish "large" entries
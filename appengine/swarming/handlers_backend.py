@@ -18,6 +18,7 @@ from components import machine_provider
 from server import lease_management
 from server import stats
 from server import task_scheduler
+from server import task_to_run
 
 
 class CronBotDiedHandler(webapp2.RequestHandler):
@@ -44,6 +45,23 @@ class CronAbortExpiredShardToRunHandler(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class CronUpdateActiveDimensionsHandler(webapp2.RequestHandler):
+  """Rebuilds the set of dimensions having reapable tasks."""
+
+  @decorators.require_cronjob
+  def get(self):
+    try:
+      task_to_run.rebuild_active_dimensions_hashes()
+    except datastore_errors.NeedIndexError as e:
+      # See CronBotDiedHandler. In the meantime, the bots search the whole
+      # backlog.
+      if not str(e).startswith(
+          'NeedIndexError: The index for this query is not ready to serve.'):
+        raise
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class CronTriggerCleanupDataHandler(webapp2.RequestHandler):
   """Triggers task to delete orphaned blobs."""
 
@@ -123,6 +141,8 @@ def get_routes():
     ('/internal/cron/handle_bot_died', CronBotDiedHandler),
     ('/internal/cron/abort_expired_task_to_run',
         CronAbortExpiredShardToRunHandler),
+    ('/internal/cron/update_active_dimensions',
+        CronUpdateActiveDimensionsHandler),
 
     ('/internal/cron/stats/update', stats.InternalStatsUpdateHandler),
     ('/internal/cron/trigger_cleanup_data', CronTriggerCleanupDataHandler),
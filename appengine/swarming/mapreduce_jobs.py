@@ -23,6 +23,7 @@ from components import utils
 
 from server import task_pack
 from server import task_result  # Needed for entity.get()
+from server import task_to_run
 
 
 # Base path to the mapreduce pipeline.
@@ -47,6 +48,13 @@ MAPREDUCE_JOBS = {
       'entity_kind': 'server.task_result.TaskResultSummary',
     },
   },
+  'backfill_task_to_run': {
+    'job_name': 'Backfill TaskToRun',
+    'mapper_spec': 'mapreduce_jobs.backfill_task_to_run',
+    'mapper_params': {
+      'entity_kind': 'server.task_to_run.TaskToRun',
+    },
+  },
   'delete_old': {
     'job_name': 'delete_old',
     'mapper_spec': 'mapreduce_jobs.delete_old',
@@ -135,6 +143,31 @@ def fix_tags(entity):
     yield operation.db.Put(entity)
 
 
+def backfill_task_to_run(entity):
+  """Backfills dimensions_hash and max_runtime_secs of the TaskToRun saved
+  before they were added, so they are found in their dimensions_hash queue.
+  """
+  # Already handled? The expired ones can't be reaped nor retried anymore.
+  if entity.dimensions_hash or entity.expiration_ts < utils.utcnow():
+    return
+
+  # TaskRequest is immutable, can be fetched outside the transaction.
+  request = entity.request_key.get(use_cache=False, use_memcache=False)
+  if not request:
+    return
+  fresh = task_to_run.new_task_to_run(request)
+
+  # The task can be reaped concurrently, use a transaction.
+  def fix_task_to_run():
+    to_run = entity.key.get()
+    if to_run and not to_run.dimensions_hash:
+      to_run.dimensions_hash = fresh.dimensions_hash
+      to_run.max_runtime_secs = fresh.max_runtime_secs
+      to_run.put()
+
+  ndb.transaction(fix_task_to_run, use_cache=False, use_memcache=False)
+
+
 def delete_old(entity):
   key_to_delete = None
   if entity.key.parent():
@@ -493,6 +493,10 @@ def schedule_request(request):
     # Check for failures, it would raise in this case, aborting the call.
     future.get_result()
 
+  if task.queue_number:
+    # Make sure bots look into this task's dimensions queue.
+    task_to_run.set_lookup_cache(task.key, True)
+
   stats.add_task_entry(
       'task_enqueued', result_summary.key,
       dimensions=request.properties.dimensions,
@@ -513,34 +517,46 @@ def bot_reap_task(dimensions, bot_id, bot_version, deadline):
   assert bot_id
   q = task_to_run.yield_next_available_task_to_dispatch(dimensions, deadline)
   # When a large number of bots try to reap hundreds of tasks simultaneously,
-  # they'll constantly fail to call reap_task_to_run() as they'll get preempted
-  # by other bots. So randomly jump farther in the queue when the number of
-  # failures is too large.
+  # they all see the same tasks at the head of the queue. Each task is claimed
+  # in memcache before running the reaping transaction, so only one bot runs
+  # the transaction on a task. The bots failing to claim a task jump ahead of
+  # the pack by a number of tasks that depends on their bot id, so concurrent
+  # bots spread across the queue instead of fighting for the next task. The
+  # skipped tasks are tried last.
+  offset = hash(bot_id) & 0xffff
   failures = 0
   to_skip = 0
   total_skipped = 0
-  for request, to_run in q:
-    if to_skip:
+  skipped = []
+
+  def candidates():
+    for item in q:
+      yield item, True
+    for item in skipped:
+      yield item, False
+
+  for (request, to_run), can_skip in candidates():
+    if to_skip and can_skip:
       to_skip -= 1
       total_skipped += 1
+      skipped.append((request, to_run))
       continue
 
-    run_result = _reap_task(
-        to_run.key, request, bot_id, bot_version, dimensions)
+    run_result = None
+    if task_to_run.claim_task_to_run(to_run.key, bot_id):
+      run_result = _reap_task(
+          to_run.key, request, bot_id, bot_version, dimensions)
+      if not run_result:
+        task_to_run.release_task_to_run(to_run.key)
     if not run_result:
       failures += 1
-      # Every 3 failures starting on the very first one, jump randomly ahead of
-      # the pack. This reduces the contention where hundreds of bots fight for
-      # exactly the same task while there's many ready to be run waiting in the
-      # queue.
-      if (failures % 3) == 1:
-        # TODO(maruel): Choose curve that makes the most sense. The tricky part
-        # is finding a good heuristic to guess the load without much information
-        # available in this content. When 'failures' is high, this means a lot
-        # of bots are reaping tasks like crazy, which means there is a good flow
-        # of tasks going on. On the other hand, skipping too much is useless. So
-        # it should have an initial bump but then slow down on skipping.
-        to_skip = min(int(round(random.gammavariate(3, 1))), 30)
+      # TODO(maruel): Choose curve that makes the most sense. The tricky part
+      # is finding a good heuristic to guess the load without much information
+      # available in this content. When 'failures' is high, this means a lot
+      # of bots are reaping tasks like crazy, which means there is a good flow
+      # of tasks going on. On the other hand, skipping too much is useless. So
+      # it should have an initial bump but then slow down on skipping.
+      to_skip = (offset + failures) % min(4 * failures, 32)
       continue
 
     # Try to optimize these values but do not add as formal stats (yet).
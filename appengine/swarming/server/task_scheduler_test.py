@@ -199,6 +199,25 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual('localhost', run_result.bot_id)
     self.failIf(task_to_run.TaskToRun.query().get().queue_number)
 
+  def test_bot_reap_task_claimed(self):
+    # The first task is claimed by another bot, so the second one is reaped.
+    request_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    requests = []
+    for i in xrange(2):
+      self.mock_now(self.now, i)
+      requests.append(task_request.make_request(
+          _gen_request(properties={'dimensions': request_dimensions}), True))
+      task_scheduler.schedule_request(requests[-1])
+    to_run_key = task_to_run.request_to_task_to_run_key(requests[0])
+    self.assertEqual(
+        True, task_to_run.claim_task_to_run(to_run_key, 'other'))
+
+    actual_request, run_result = task_scheduler.bot_reap_task(
+        request_dimensions, 'localhost', 'abc', None)
+    self.assertEqual(requests[1], actual_request)
+    self.assertEqual('localhost', run_result.bot_id)
+    self.assertEqual(True, to_run_key.get().is_reapable)
+
   def test_exponential_backoff(self):
     self.mock(
         task_scheduler.random, 'random',
@@ -27,9 +27,11 @@ Graph of the schema:
 
 import datetime
 import hashlib
+import heapq
 import itertools
 import logging
 import struct
+import threading
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
@@ -41,6 +43,29 @@ from server import task_request
 # Maximum product search space for dimensions for a bot.
 MAX_DIMENSIONS = 16384
 
+# Lifetime in seconds of the lock held by rebuild_active_dimensions_hashes(). It
+# is longer than the 10 minutes deadline of a cron job.
+REBUILD_LOCK_TIME = 11*60
+
+# Lifetime in seconds of a claim on a TaskToRun, see claim_task_to_run(). It
+# only needs to cover the reaping transaction.
+CLAIM_LIFETIME = 10
+
+# Lifetime in seconds of the memoized set of dimensions_hash accepted by a bot
+# in memcache. The value for a given set of bot dimensions never changes.
+ACCEPTED_HASHES_CACHE_TIME = 24*60*60
+
+# Maximum number of dimensions_hash kept in the process memory cache of
+# _get_accepted_dimensions_hash(), across all bots. That's a few MB.
+_ACCEPTED_HASHES_MAX_SIZE = 200000
+
+
+# Process memory cache of _get_accepted_dimensions_hash(). Maps the digest of
+# the bot dimensions to the frozenset of dimensions_hash.
+_accepted_hashes = {}
+_accepted_hashes_size = 0
+_accepted_hashes_lock = threading.Lock()
+
 
 class TaskToRun(ndb.Model):
   """Defines a TaskRequest ready to be scheduled on a bot.
@@ -62,6 +87,17 @@ class TaskToRun(ndb.Model):
   # TaskRequest.expiration_ts to enable queries when cleaning up stale jobs.
   expiration_ts = ndb.DateTimeProperty(required=True)
 
+  # Copy of the key id, which is the hash of TaskRequest.properties.dimensions.
+  # It is needed to query the queue of a single dimensions set ordered by
+  # queue_number, since the key id cannot be filtered on across entity groups.
+  dimensions_hash = ndb.IntegerProperty()
+
+  # Maximum duration of the task in seconds, including the overheads. See
+  # _gen_max_runtime_secs() for details. 0 if the task never times out. It is
+  # used to filter the tasks for bots with a deadline without loading the
+  # TaskRequest. None only for the entities saved before it was added.
+  max_runtime_secs = ndb.IntegerProperty()
+
   # Everything above is immutable, everything below is mutable.
 
   # priority and request creation timestamp are mixed together to allow queries
@@ -123,6 +159,40 @@ def _gen_queue_number(
   return value + priority * scale_factor_us
 
 
+def _gen_max_runtime_secs(request):
+  """Returns the value to use for TaskToRun.max_runtime_secs.
+
+  We have to assume the task takes the theoretical maximum amount of time
+  possible, which is governed by execution_timeout_secs. An isolated task's
+  download phase is not subject to this limit, so we need to add
+  io_timeout_secs. When a task is signalled that it's about to be killed, it
+  receives a grace period as well. grace_period_secs is given by run_isolated to
+  the task execution process, by task_runner to run_isolated, and by bot_main
+  to the task_runner. Lastly, add a few seconds to account for any overhead.
+
+  Returns:
+    Number of seconds or 0 if the task never times out.
+  """
+  props = request.properties
+  if not props.execution_timeout_secs:
+    return 0
+  return (
+      props.execution_timeout_secs +
+      (props.io_timeout_secs or 600) +
+      3 * (props.grace_period_secs or 30) +
+      10)
+
+
+def _is_runnable_before(deadline, max_runtime_secs):
+  """Returns True if a task with this TaskToRun.max_runtime_secs is guaranteed
+  to complete before the deadline, as an UTC timestamp.
+  """
+  # A task that never times out cannot be accepted.
+  return bool(
+      max_runtime_secs and
+      utils.time_time() + max_runtime_secs < deadline)
+
+
 def _explode_list(values):
   """Yields all the combinations in the dict values for items which are list.
 
@@ -160,6 +230,57 @@ def _powerset(dimensions):
       yield i
 
 
+def _powerset_json(dimensions):
+  """Yields the json encoding of each item of _powerset(dimensions).
+
+  Each yielded value is exactly utils.encode_to_json() of the matching
+  dictionary, but each key:value pair is only encoded once and the subsets are
+  built with string joins. This is much faster than encoding each subset.
+  """
+  # Do not assume the str and unicode keys sort the same way, order as the json
+  # encoder does.
+  pairs = []
+  for k in sorted(dimensions, key=utils.to_json_encodable):
+    v = dimensions[k]
+    key = utils.encode_to_json(k) + ':'
+    values = v if isinstance(v, list) else [v]
+    pairs.append([key + utils.encode_to_json(i) for i in values])
+  for r in xrange(len(pairs), -1, -1):
+    for subset in itertools.combinations(pairs, r):
+      for i in itertools.product(*subset):
+        yield '{%s}' % ','.join(i)
+
+
+def _get_accepted_dimensions_hash(bot_dimensions):
+  """Returns the frozenset of dimensions_hash that the bot can match.
+
+  The bot dimensions rarely change between polls, so the set is memoized in
+  process memory and in memcache, keyed by the digest of the bot dimensions.
+  """
+  global _accepted_hashes_size
+  digest = hashlib.md5(utils.encode_to_json(bot_dimensions)).hexdigest()
+  hashes = _accepted_hashes.get(digest)
+  if hashes is not None:
+    return hashes
+
+  hashes = memcache.get(digest, namespace='task_to_run_accepted')
+  if hashes is None:
+    hashes = frozenset(
+        _hash_dimensions(i) for i in _powerset_json(bot_dimensions))
+    memcache.set(
+        digest, hashes, time=ACCEPTED_HASHES_CACHE_TIME,
+        namespace='task_to_run_accepted')
+
+  with _accepted_hashes_lock:
+    if digest not in _accepted_hashes:
+      if _accepted_hashes_size + len(hashes) > _ACCEPTED_HASHES_MAX_SIZE:
+        _accepted_hashes.clear()
+        _accepted_hashes_size = 0
+      _accepted_hashes[digest] = hashes
+      _accepted_hashes_size += len(hashes)
+  return hashes
+
+
 def _hash_dimensions(dimensions_json):
   """Returns a 32 bits int that is a hash of the dimensions specified.
 
@@ -182,9 +303,227 @@ def _memcache_to_run_key(task_key):
 
 def _lookup_cache_is_taken(task_key):
   """Queries the quick lookup cache to reduce DB operations."""
+  return bool(_lookup_cache_get_taken([task_key]))
+
+
+def _lookup_cache_get_taken(task_keys):
+  """Queries the quick lookup cache for multiple tasks.
+
+  The tasks claimed by a bot with claim_task_to_run() are also considered
+  taken. Both lookups are done concurrently.
+
+  Returns:
+    frozenset of the TaskToRun keys that are known to be taken.
+  """
   assert not ndb.in_transaction()
-  key = _memcache_to_run_key(task_key)
-  return bool(memcache.get(key, namespace='task_to_run'))
+  if not task_keys:
+    return frozenset()
+  keys = {_memcache_to_run_key(task_key): task_key for task_key in task_keys}
+  client = memcache.Client()
+  rpcs = [
+    client.get_multi_async(keys.keys(), namespace=namespace)
+    for namespace in ('task_to_run', 'task_to_run_claim')
+  ]
+  taken = set()
+  for rpc in rpcs:
+    # get_result() returns None on RPC error.
+    taken.update(k for k, v in (rpc.get_result() or {}).iteritems() if v)
+  return frozenset(keys[k] for k in taken)
+
+
+def _yield_pages(iterator, size, max_size):
+  """Yields lists of items from iterator, doubling the page size each time up
+  to max_size.
+  """
+  while True:
+    page = list(itertools.islice(iterator, size))
+    if not page:
+      return
+    yield page
+    size = min(size * 2, max_size)
+
+
+def _active_hash_key(dimensions_hash):
+  """Returns the memcache key of the counter of reapable tasks for a
+  dimensions_hash.
+  """
+  return 'h%x' % dimensions_hash
+
+
+def _add_active_hash(dimensions_hash):
+  """Adds a dimensions_hash to the set of active ones in memcache."""
+  client = memcache.Client()
+  for _ in xrange(10):
+    state = client.gets('active_state', namespace='task_to_run_hashes')
+    if state is None:
+      # It is incomplete until the next rebuild_active_dimensions_hashes(),
+      # which keeps the hash added here.
+      state = {
+        'hashes': frozenset([dimensions_hash]),
+        'legacy': False,
+        'stale': {},
+        'ts': 0,
+      }
+      if client.add('active_state', state, namespace='task_to_run_hashes'):
+        return
+      continue
+    if dimensions_hash in state['hashes']:
+      return
+    state = state.copy()
+    state['hashes'] = state['hashes'] | frozenset([dimensions_hash])
+    if client.cas('active_state', state, namespace='task_to_run_hashes'):
+      return
+  logging.warning('Failed to add %d to the active dimensions', dimensions_hash)
+
+
+def _rebuild_active_hashes():
+  """Does the scan for rebuild_active_dimensions_hashes()."""
+  old = memcache.get('active_state', namespace='task_to_run_hashes')
+
+  # Start both queries before consuming them.
+  opts = ndb.QueryOptions(batch_size=500, keys_only=True)
+  q_all = TaskToRun.query(default_options=opts).filter(
+      TaskToRun.queue_number > 0).iter()
+  opts = ndb.QueryOptions(batch_size=500)
+  q_hashed = TaskToRun.query(
+      projection=[TaskToRun.dimensions_hash], default_options=opts).filter(
+          TaskToRun.queue_number > 0).iter()
+  counts = {}
+  for task_key in q_all:
+    # integer_id() == dimensions_hash.
+    h = task_key.integer_id()
+    counts[h] = counts.get(h, 0) + 1
+  hashed = sum(1 for task in q_hashed if task.dimensions_hash)
+
+  old = old or {'hashes': frozenset(), 'stale': {}}
+  keys = {
+    _active_hash_key(h): h for h in frozenset(counts) | old['hashes']
+  }
+  current = memcache.get_multi(keys.keys(), namespace='task_to_run_hashes')
+  current = {keys[k]: int(v) for k, v in current.iteritems()}
+
+  offsets = {}
+  hashes = set(counts)
+  stale = {}
+  for h, count in counts.iteritems():
+    if current.get(h, 0) < count:
+      offsets[_active_hash_key(h)] = count - current.get(h, 0)
+  for h in old['hashes'] - frozenset(counts):
+    if h in old['stale']:
+      # Forget the tasks counted by the previous scan.
+      offsets[_active_hash_key(h)] = -old['stale'][h]
+    else:
+      hashes.add(h)
+      stale[h] = current.get(h, 0)
+  if offsets:
+    result = memcache.offset_multi(
+        offsets, namespace='task_to_run_hashes', initial_value=0)
+    for k, v in (result or {}).iteritems():
+      h = keys[k]
+      if h in old['stale'] and h not in counts and v:
+        # Tasks were added since the previous scan.
+        hashes.add(h)
+        stale[h] = v
+
+  state = {
+    'hashes': frozenset(hashes),
+    'legacy': hashed < sum(counts.itervalues()),
+    'stale': stale,
+    'ts': utils.time_time(),
+  }
+  # Keep the dimensions_hash added concurrently by _add_active_hash().
+  client = memcache.Client()
+  for _ in xrange(10):
+    existing = client.gets('active_state', namespace='task_to_run_hashes')
+    if existing is None:
+      if client.add('active_state', state, namespace='task_to_run_hashes'):
+        break
+      continue
+    added = existing['hashes'] - old['hashes']
+    if added - state['hashes']:
+      state = state.copy()
+      state['hashes'] = state['hashes'] | added
+    if client.cas('active_state', state, namespace='task_to_run_hashes'):
+      break
+  if state['legacy']:
+    logging.warning(
+        '%d reapable TaskToRun are missing dimensions_hash',
+        sum(counts.itervalues()) - hashed)
+  return state
+
+
+def _get_active_dimensions_hashes(accepted_dimensions_hash):
+  """Returns the dimensions_hash having reapable TaskToRun among the ones
+  accepted by the bot.
+
+  The set of dimensions_hash is kept in memcache along a counter of reapable
+  tasks per dimensions_hash. Both are maintained by set_lookup_cache(), so
+  there is no scan when polling. The set is rebuilt by a cron job with
+  rebuild_active_dimensions_hashes().
+
+  Returns:
+    tuple(frozenset of dimensions_hash, True if the legacy queue must be
+    searched too).
+  """
+  state = memcache.get('active_state', namespace='task_to_run_hashes')
+  if not state or not state['ts']:
+    # It was never built or it was evicted. Search the whole backlog until the
+    # cron job rebuilds it.
+    return frozenset(), True
+
+  candidates = accepted_dimensions_hash & state['hashes']
+  keys = {_active_hash_key(h): h for h in candidates}
+  counts = memcache.get_multi(keys.keys(), namespace='task_to_run_hashes')
+  # A missing counter was evicted, the dimensions_hash must be searched.
+  hashes = frozenset(
+      h for k, h in keys.iteritems() if int(counts.get(k, 1)) > 0)
+  return hashes, state['legacy']
+
+
+def _yield_queue(dimensions_hash, opts):
+  """Returns an iterator of (queue_number, TaskToRun key, max_runtime_secs) of
+  the reapable tasks with this dimensions_hash in queue_number order.
+
+  The query is started right away.
+  """
+  q = TaskToRun.query(
+      projection=[TaskToRun.queue_number, TaskToRun.max_runtime_secs],
+      default_options=opts).filter(
+          TaskToRun.dimensions_hash == dimensions_hash,
+          TaskToRun.queue_number > 0).order(TaskToRun.queue_number).iter()
+  return (
+    (task.queue_number, task.key, task.max_runtime_secs) for task in q
+  )
+
+
+def _yield_legacy_queue(accepted_dimensions_hash, opts):
+  """Returns an iterator of (queue_number, TaskToRun key, None) of all the
+  reapable tasks the bot can match in queue_number order.
+
+  This is the scan of the whole backlog that was done before per
+  dimensions_hash queues were used. It is only needed for the TaskToRun saved
+  without dimensions_hash, until mapreduce_jobs.backfill_task_to_run is run, and
+  when the set of active dimensions_hash is not in memcache.
+  """
+  q = TaskToRun.query(
+      projection=[TaskToRun.queue_number], default_options=opts).filter(
+          TaskToRun.queue_number > 0).order(TaskToRun.queue_number).iter()
+  return (
+    (task.queue_number, task.key, None) for task in q
+    if task.key.integer_id() in accepted_dimensions_hash
+  )
+
+
+def _dedupe_queues(items):
+  """Yields (TaskToRun key, max_runtime_secs) once per TaskToRun out of the
+  merged queues.
+
+  When the legacy queue is used, the tasks having dimensions_hash are in two
+  queues. The copy with max_runtime_secs set sorts last.
+  """
+  for _, group in itertools.groupby(items, key=lambda i: i[:2]):
+    item = list(group)[-1]
+    yield item[1:]
 
 
 ### Public API.
@@ -216,8 +555,11 @@ def new_task_to_run(request):
   Returns:
     Unsaved TaskToRun entity.
   """
+  key = request_to_task_to_run_key(request)
   return TaskToRun(
-      key=request_to_task_to_run_key(request),
+      key=key,
+      dimensions_hash=key.integer_id(),
+      max_runtime_secs=_gen_max_runtime_secs(request),
       queue_number=gen_queue_number(request),
       expiration_ts=request.expiration_ts)
 
@@ -265,6 +607,35 @@ def match_dimensions(request_dimensions, bot_dimensions):
   return True
 
 
+def rebuild_active_dimensions_hashes():
+  """Rebuilds the set of dimensions_hash having reapable TaskToRun by scanning
+  them.
+
+  It is called by a cron job. The set is otherwise maintained incrementally by
+  set_lookup_cache(), the scan corrects the drift caused by memcache evictions.
+
+  The counters maintained by set_lookup_cache() are raised to the number of
+  tasks found, to fix the ones that were evicted. A dimensions_hash absent from
+  two consecutive scans is dropped, minus the tasks added since the first scan.
+  Two scans are used since the index is eventually consistent.
+
+  It also detects the reapable TaskToRun saved before dimensions_hash was added
+  and which are thus not in any queue, see mapreduce_jobs.backfill_task_to_run.
+
+  Returns:
+    The new state or None if another cron job is rebuilding it.
+  """
+  # The lock outlives the cron job deadline, so only one scan can run at a
+  # time.
+  if not memcache.add(
+      'rebuild', True, time=REBUILD_LOCK_TIME, namespace='task_to_run_hashes'):
+    return None
+  try:
+    return _rebuild_active_hashes()
+  finally:
+    memcache.delete('rebuild', namespace='task_to_run_hashes')
+
+
 def set_lookup_cache(task_key, is_available_to_schedule):
   """Updates the quick lookup cache to mark an item as available or not.
 
@@ -274,6 +645,10 @@ def set_lookup_cache(task_key, is_available_to_schedule):
   tasks simultaneously. In this case, there is a high likelihood that multiple
   concurrent HTTP handlers are trying to reap the exact same task
   simultaneously. This blacklist helps reduce the contention.
+
+  It also maintains the number of reapable tasks per dimensions_hash, so
+  yield_next_available_task_to_dispatch() only searches the dimensions_hash
+  having reapable tasks.
   """
   # Set the expiration time for items in the negative cache as 2 minutes. This
   # copes with significant index inconsistency but do not clog the memcache
@@ -282,11 +657,63 @@ def set_lookup_cache(task_key, is_available_to_schedule):
 
   assert not ndb.in_transaction()
   key = _memcache_to_run_key(task_key)
+  # integer_id() == dimensions_hash.
+  hash_key = _active_hash_key(task_key.integer_id())
   if is_available_to_schedule:
     # The item is now available, so remove it from memcache.
     memcache.delete(key, namespace='task_to_run')
+    # The marker ensures the task is counted once even if this function is
+    # called multiple times.
+    if memcache.add(key, True, namespace='task_to_run_active'):
+      count = memcache.incr(
+          hash_key, namespace='task_to_run_hashes', initial_value=0)
+      if count == 1:
+        _add_active_hash(task_key.integer_id())
   else:
     memcache.set(key, True, time=cache_lifetime, namespace='task_to_run')
+    if (memcache.delete(key, namespace='task_to_run_active') ==
+        memcache.DELETE_SUCCESSFUL):
+      memcache.decr(hash_key, namespace='task_to_run_hashes')
+
+
+def claim_task_to_run(task_key, bot_id):
+  """Claims a TaskToRun for a bot before trying to reap it.
+
+  When many bots with the same dimensions poll simultaneously, they all see
+  the same tasks at the head of the queue. Only the bot that added the claim to
+  memcache should run the reaping DB transaction, the other ones should move
+  on to the next task instead of colliding on the same entity group.
+
+  memcache.add() also returns False when memcache is unavailable, which would
+  make every task look claimed during an outage. The status of each key is used
+  instead, so on error the bot proceeds with the reaping DB transaction, which
+  is what happened before claims were used.
+
+  Returns:
+    False if another bot holds the claim.
+  """
+  assert not ndb.in_transaction()
+  key = _memcache_to_run_key(task_key)
+  rpc = memcache.Client().add_multi_async(
+      {key: bot_id}, time=CLAIM_LIFETIME, namespace='task_to_run_claim')
+  # get_result() returns None on RPC error.
+  status = (rpc.get_result() or {}).get(key)
+  if status == memcache.NOT_STORED:
+    return False
+  if status != memcache.STORED:
+    logging.warning('Failed to claim %s, memcache status %s', key, status)
+  return True
+
+
+def release_task_to_run(task_key):
+  """Releases a claim taken with claim_task_to_run().
+
+  It must be called when the task couldn't be reaped, so another bot can try
+  without waiting for the claim to expire.
+  """
+  assert not ndb.in_transaction()
+  key = _memcache_to_run_key(task_key)
+  memcache.delete(key, namespace='task_to_run_claim')
 
 
 def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
@@ -305,144 +732,155 @@ def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
       complete the task by. None if there is no such deadline.
   """
   # List of all the valid dimensions hashed.
-  accepted_dimensions_hash = frozenset(
-      _hash_dimensions(utils.encode_to_json(i))
-      for i in _powerset(bot_dimensions))
+  accepted_dimensions_hash = _get_accepted_dimensions_hash(bot_dimensions)
   now = utils.utcnow()
   broken = 0
   cache_lookup = 0
   expired = 0
-  hash_mismatch = 0
   ignored = 0
   no_queue = 0
   real_mismatch = 0
   too_long = 0
   total = 0
-  # Be very aggressive in fetching the largest amount of items as possible. Note
-  # that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
+  # Each dimensions_hash is its own queue ordered by queue_number. Only the
+  # queues that this bot can match and that have reapable tasks are queried,
+  # then merged by queue_number so the global priority ordering is kept. This
+  # way the query time depends on the number of tasks this bot could run, not
+  # on the total number of pending tasks. The legacy queue, which scans the
+  # whole backlog, is used for the TaskToRun saved before dimensions_hash was
+  # added until they are backfilled, and until the cron job builds the set of
+  # active dimensions_hash.
+  #
+  # Note that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
   # returned. It's handled specifically.
-  # - 100/200 gives 2s~40s of query time for 1275 items.
-  # - 250/500 gives 2s~50s of query time for 1275 items.
-  # - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
-  #   variance). Spikes in 20s~40s are rarer.
-  # The problem here are:
-  # - Outliers, some shards are simply slower at executing the query.
-  # - Median time, which we should optimize.
-  # - Abusing batching will slow down this query.
+  #
+  # The processing is pipelined page by page: the keys are weeded out with a
+  # single memcache RPC, then the TaskToRun and TaskRequest entities of the
+  # survivors are fetched with ndb.get_multi_async() while the next page of keys
+  # is being loaded from the queues. The first page is small since the bot will
+  # likely reap one of the first tasks, then the pages grow. The reason
+  # use_cache=False is otherwise it'll create a buffer bloat. Using get_multi()
+  # also returns fresher entities than what is returned by the query.
   #
   # TODO(maruel): Measure query performance with stats_framework!!
-  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
-  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
-  # the effect of latency on the total duration of this function. I also suspect
-  # using ndb.get_multi() will return fresher objects than what is returned by
-  # the query.
-  opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
+  hashes, legacy = _get_active_dimensions_hashes(accepted_dimensions_hash)
+  opts = ndb.QueryOptions(batch_size=50)
   try:
-    # Interestingly, the filter on .queue_number>0 is required otherwise all the
-    # None items are returned first.
-    q = TaskToRun.query(default_options=opts).order(
-        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
-    for task_key in q:
+    # All the queries are started before merging them.
+    queues = [_yield_queue(h, opts) for h in sorted(hashes)]
+    if legacy:
+      queues.append(_yield_legacy_queue(accepted_dimensions_hash, opts))
+    pages = _yield_pages(_dedupe_queues(heapq.merge(*queues)), 8, 64)
+    page = next(pages, None)
+    while page:
       duration = (utils.utcnow() - now).total_seconds()
       if duration > 40.:
-        # Stop searching after too long, since the odds of the request blowing
-        # up right after succeeding in reaping a task is not worth the dangling
-        # task request that will stay in limbo until the cron job reaps it and
-        # retry it. The current handlers are given 60s to complete. By using
-        # 40s, it gives 20s to complete the reaping and complete the HTTP
-        # request.
+        # Stop searching after too long, since the odds of the request
+        # blowing up right after succeeding in reaping a task is not worth the
+        # dangling task request that will stay in limbo until the cron job
+        # reaps it and retry it. The current handlers are given 60s to
+        # complete. By using 40s, it gives 20s to complete the reaping and
+        # complete the HTTP request.
         return
 
-      total += 1
-      # Verify TaskToRun is what is expected. Play defensive here.
-      try:
-        validate_to_run_key(task_key)
-      except ValueError as e:
-        logging.error(str(e))
-        broken += 1
-        continue
-
-      # integer_id() == dimensions_hash.
-      if task_key.integer_id() not in accepted_dimensions_hash:
-        hash_mismatch += 1
-        continue
-
-      # Do this after the basic weeding out but before fetching TaskRequest.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # Ok, it's now worth taking a real look at the entity.
-      task = task_key.get(use_cache=False)
-
-      # DB operations are slow, double check memcache again.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # It is possible for the index to be inconsistent since it is not executed
-      # in a transaction, no problem.
-      if not task.queue_number:
-        no_queue += 1
-        continue
-
-      # It expired. A cron job will cancel it eventually. Since 'now' is saved
-      # before the query, an expired task may still be reaped even if
-      # technically expired if the query is very slow. This is on purpose so
-      # slow queries do not cause exagerate expirations.
-      if task.expiration_ts < now:
-        expired += 1
-        continue
-
-      # The hash may have conflicts. Ensure the dimensions actually match by
-      # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
-      # which is low enough for our purpose. The reason use_cache=False is
-      # otherwise it'll create a buffer bloat.
-      request = task.request_key.get(use_cache=False)
-      if not match_dimensions(request.properties.dimensions, bot_dimensions):
-        real_mismatch += 1
-        continue
-
-      # If the bot has a deadline, don't allow it to reap the task unless it can
-      # be completed before the deadline. We have to assume the task takes the
-      # theoretical maximum amount of time possible, which is governed by
-      # execution_timeout_secs. An isolated task's download phase is not subject
-      # to this limit, so we need to add io_timeout_secs. When a task is
-      # signalled that it's about to be killed, it receives a grace period as
-      # well. grace_period_secs is given by run_isolated to the task execution
-      # process, by task_runner to run_isolated, and by bot_main to the
-      # task_runner. Lastly, add a few seconds to account for any overhead.
-      if deadline is not None:
-        if not request.properties.execution_timeout_secs:
-          # Task never times out, so it cannot be accepted.
-          too_long += 1
+      total += len(page)
+      task_keys = []
+      for task_key, max_runtime_secs in page:
+        # Verify TaskToRun is what is expected. Play defensive here.
+        try:
+          validate_to_run_key(task_key)
+        except ValueError as e:
+          logging.error(str(e))
+          broken += 1
           continue
-        max_task_time = (utils.time_time() +
-                         request.properties.execution_timeout_secs +
-                         (request.properties.io_timeout_secs or 600) +
-                         3 * (request.properties.grace_period_secs or 30) +
-                         10)
-        if deadline <= max_task_time:
+
+        # If the bot has a deadline, don't allow it to reap the task unless it
+        # can be completed before the deadline. This is checked with the value
+        # returned by the query, before fetching any entity. It is None for the
+        # TaskToRun saved before max_runtime_secs was added and in the legacy
+        # queue, these are checked once the entities are loaded.
+        if (deadline is not None and max_runtime_secs is not None and
+            not _is_runnable_before(deadline, max_runtime_secs)):
           too_long += 1
           continue
 
-      # It's a valid task! Note that in the meantime, another bot may have
-      # reaped it.
-      yield request, task
-      ignored += 1
+        task_keys.append(task_key)
+
+      # Do this after the basic weeding out but before fetching the entities.
+      taken = _lookup_cache_get_taken(task_keys)
+      cache_lookup += len(taken)
+      task_keys = [k for k in task_keys if k not in taken]
+
+      # Ok, it's now worth taking a real look at the entities.
+      futures = ndb.get_multi_async(
+          task_keys + [task_key.parent() for task_key in task_keys],
+          use_cache=False)
+      # Load the next page of keys while the entities are being fetched.
+      page = next(pages, None)
+      entities = [f.get_result() for f in futures]
+
+      for task_key, task, request in zip(
+          task_keys, entities[:len(task_keys)], entities[len(task_keys):]):
+        # It is possible for the index to be inconsistent since it is not
+        # executed in a transaction, no problem.
+        if not task or not task.queue_number:
+          no_queue += 1
+          continue
+
+        # It expired. A cron job will cancel it eventually. Since 'now' is saved
+        # before the query, an expired task may still be reaped even if
+        # technically expired if the query is very slow. This is on purpose so
+        # slow queries do not cause exagerate expirations.
+        if task.expiration_ts < now:
+          expired += 1
+          continue
+
+        if not request:
+          logging.error('TaskRequest for %s is missing', task_key)
+          broken += 1
+          continue
+
+        if deadline is not None:
+          max_runtime_secs = task.max_runtime_secs
+          if max_runtime_secs is None:
+            max_runtime_secs = _gen_max_runtime_secs(request)
+          if not _is_runnable_before(deadline, max_runtime_secs):
+            too_long += 1
+            continue
+
+        # The hash may have conflicts. Ensure the dimensions actually match by
+        # verifying the TaskRequest. There's a probability of 2**-31 of
+        # conflicts, which is low enough for our purpose.
+        if not match_dimensions(request.properties.dimensions, bot_dimensions):
+          real_mismatch += 1
+          continue
+
+        # The caller may have spent a while reaping the previously yielded
+        # tasks, see above.
+        if (utils.utcnow() - now).total_seconds() > 40.:
+          return
+
+        # DB operations are slow and each yield can take a while, double check
+        # memcache again right before yielding.
+        if _lookup_cache_is_taken(task_key):
+          cache_lookup += 1
+          continue
+
+        # It's a valid task! Note that in the meantime, another bot may have
+        # reaped it.
+        yield request, task
+        ignored += 1
   finally:
     duration = (utils.utcnow() - now).total_seconds()
     logging.info(
-        '%d/%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
+        '%d queues in %5.2fs: %d total, %d exp %d no_queue, '
         '%d cache negative, %d dimensions mismatch, %d ignored, %d broken, '
         '%d not executable by deadline (UTC %s)',
-        opts.batch_size,
-        opts.prefetch_size,
+        len(hashes),
         duration,
         total,
         expired,
         no_queue,
-        hash_mismatch,
         cache_lookup,
         real_mismatch,
         ignored,
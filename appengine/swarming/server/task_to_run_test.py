@@ -14,6 +14,7 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import auth_testing
@@ -137,6 +138,37 @@ class TaskToRunPrivateTest(TestCase):
       actual = list(task_to_run._powerset(inputs))
       self.assertEquals(expected, actual)
 
+  def test_powerset_json(self):
+    data = [
+      {},
+      {u'OS': u'Windows'},
+      {u'OS': [u'Windows', u'Windows-6.1'], 'hostname': 'foo', 'bar': [2, 3]},
+      {u'\xe9t\xe9': u'\u2603', u'a': u'b"\\c'},
+    ]
+    for dimensions in data:
+      expected = sorted(
+          utils.encode_to_json(i) for i in task_to_run._powerset(dimensions))
+      actual = sorted(task_to_run._powerset_json(dimensions))
+      self.assertEqual(expected, actual)
+
+  def test_get_accepted_dimensions_hash(self):
+    self.mock(task_to_run, '_accepted_hashes', {})
+    self.mock(task_to_run, '_accepted_hashes_size', 0)
+    dimensions = {u'OS': [u'Windows', u'Windows-6.1'], u'pool': u'default'}
+    expected = frozenset(
+        _hash_dimensions(i) for i in task_to_run._powerset(dimensions))
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(dimensions))
+    self.assertEqual(6, task_to_run._accepted_hashes_size)
+
+    # It is now memoized, both in memory and in memcache.
+    self.mock(task_to_run, '_powerset_json', self.fail)
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(dimensions))
+    task_to_run._accepted_hashes.clear()
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(dimensions))
+
   def test_timeit_generation(self):
     # The hash table generation is done once per poll request, so it's a cost
     # latency wise and CPU wise.
@@ -205,6 +237,17 @@ class TaskToRunPrivateTest(TestCase):
     # Enable to get actual numbers on your workstation:
     #print('\ntuple: %.4fs  frozenset: %.4fs' % (perf_tuple, perf_frozenset))
 
+  def test_yield_pages(self):
+    actual = list(task_to_run._yield_pages(iter(xrange(20)), 2, 8))
+    expected = [
+      [0, 1],
+      [2, 3, 4, 5],
+      [6, 7, 8, 9, 10, 11, 12, 13],
+      [14, 15, 16, 17, 18, 19],
+    ]
+    self.assertEqual(expected, actual)
+    self.assertEqual([], list(task_to_run._yield_pages(iter([]), 2, 8)))
+
   def test_hash_dimensions(self):
     dimensions = 'this is not json'
     as_hex = hashlib.md5(dimensions).digest()[:4].encode('hex')
@@ -346,6 +389,7 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.now + datetime.timedelta(seconds=31),
+        'max_runtime_secs': 730,
         'request_key': '0x7e296460f77ffdce',
         # Lower priority value means higher priority.
         'queue_number': '0x00060dc5849f1346',
@@ -353,6 +397,7 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.now + datetime.timedelta(seconds=31),
+        'max_runtime_secs': 730,
         'request_key': '0x7e296460f77ffede',
         'queue_number': '0x00072c96fd65d346',
       },
@@ -438,6 +483,7 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
@@ -461,6 +507,7 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
@@ -478,6 +525,7 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
@@ -501,6 +549,7 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
@@ -531,11 +580,13 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions_1),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
       {
         'dimensions_hash': _hash_dimensions(request_dimensions_2),
         'expiration_ts': self.expiration_ts + datetime.timedelta(seconds=1),
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67c95586',
       },
     ]
@@ -571,11 +622,13 @@ class TaskToRunApiTest(TestCase):
         'dimensions_hash': _hash_dimensions(request_dimensions_2),
         # Due to time being late on the second requester frontend.
         'expiration_ts': self.expiration_ts - datetime.timedelta(seconds=1),
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67aad106',
       },
       {
         'dimensions_hash': _hash_dimensions(request_dimensions_1),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
@@ -597,11 +650,13 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions_1),
         'expiration_ts': datetime.datetime(2014, 1, 2, 3, 6, 5, 6),
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x00060dc588329a46',
       },
       {
         'dimensions_hash': _hash_dimensions(request_dimensions_2),
         'expiration_ts': datetime.datetime(2014, 1, 2, 3, 5, 5, 6),
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
@@ -613,6 +668,162 @@ class TaskToRunApiTest(TestCase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions, None)
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_dispatch_merge_queues(self):
+    # Tasks from multiple dimensions queues are interleaved by queue_number.
+    request_dimensions_1 = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    request_dimensions_2 = {u'hostname': u'localhost', u'pool': u'default'}
+    request_dimensions_3 = {u'OS': u'Amiga', u'pool': u'default'}
+    for i, dimensions in enumerate((
+        request_dimensions_1, request_dimensions_2, request_dimensions_3,
+        request_dimensions_1)):
+      self.mock_now(self.now, i)
+      _gen_new_task_to_run(properties=dict(dimensions=dimensions))
+
+    bot_dimensions = {
+      u'OS': u'Windows-3.1.1',
+      u'hostname': u'localhost',
+      u'pool': u'default',
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions, None)
+    expected = [
+      (_hash_dimensions(request_dimensions_1), '0x000a890b67ba1346'),
+      (_hash_dimensions(request_dimensions_2), '0x000a890b67c95586'),
+      (_hash_dimensions(request_dimensions_1), '0x000a890b67e7da06'),
+    ]
+    self.assertEqual(
+        expected, [(i['dimensions_hash'], i['queue_number']) for i in actual])
+
+  def test_yield_next_available_task_to_dispatch_pages(self):
+    # More tasks than the first page, some of them already taken.
+    request_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    to_runs = []
+    for i in xrange(20):
+      self.mock_now(self.now, i)
+      to_runs.append(
+          _gen_new_task_to_run(properties=dict(dimensions=request_dimensions)))
+    for to_run in to_runs[5:12]:
+      task_to_run.set_lookup_cache(to_run.key, False)
+
+    actual = [
+      to_run.key
+      for _request, to_run in task_to_run.yield_next_available_task_to_dispatch(
+          request_dimensions, None)
+    ]
+    self.assertEqual([i.key for i in to_runs[:5] + to_runs[12:]], actual)
+
+  def test_yield_next_available_task_to_dispatch_claimed_meanwhile(self):
+    # A task claimed by another bot while the previous one was being yielded is
+    # skipped, even if it is in the same page.
+    request_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    to_runs = []
+    for i in xrange(3):
+      self.mock_now(self.now, i)
+      to_runs.append(
+          _gen_new_task_to_run(properties=dict(dimensions=request_dimensions)))
+
+    actual = []
+    for _request, to_run in task_to_run.yield_next_available_task_to_dispatch(
+        request_dimensions, None):
+      actual.append(to_run.key)
+      if len(actual) == 1:
+        self.assertEqual(
+            True, task_to_run.claim_task_to_run(to_runs[1].key, 'bot2'))
+    self.assertEqual([to_runs[0].key, to_runs[2].key], actual)
+
+  def test_yield_next_available_task_to_dispatch_new_queue(self):
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    _gen_new_task_to_run(properties=dict(dimensions={u'pool': u'default'}))
+    task_to_run.rebuild_active_dimensions_hashes()
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+
+    # The set of queues having tasks is cached, a task in a new queue is only
+    # visible once it is marked as available.
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions=bot_dimensions))
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    task_to_run.set_lookup_cache(to_run.key, True)
+    self.assertEqual(
+        2, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+
+  def test_yield_next_available_task_to_dispatch_legacy(self):
+    # A TaskToRun saved before dimensions_hash was added is still found.
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'pool': u'default'}
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'pool': u'default'}))
+    _gen_new_task_to_run(properties=dict(dimensions=bot_dimensions))
+    to_run.dimensions_hash = None
+    to_run.max_runtime_secs = None
+    to_run.put()
+    self.assertEqual(
+        True, task_to_run.rebuild_active_dimensions_hashes()['legacy'])
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions, None)
+    self.assertEqual(2, len(actual))
+
+  def test_get_active_dimensions_hashes(self):
+    to_run = _gen_new_task_to_run()
+    h = to_run.key.integer_id()
+    accepted = frozenset([h, 1])
+    # The whole backlog is searched until the cron job builds the set.
+    self.assertEqual(
+        (frozenset(), True),
+        task_to_run._get_active_dimensions_hashes(accepted))
+    # The task is counted once.
+    task_to_run.set_lookup_cache(to_run.key, True)
+    task_to_run.set_lookup_cache(to_run.key, True)
+    self.assertEqual(
+        (frozenset(), True),
+        task_to_run._get_active_dimensions_hashes(accepted))
+    task_to_run.rebuild_active_dimensions_hashes()
+    self.assertEqual(
+        (frozenset([h]), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+
+    # The counter is maintained without scanning.
+    to_run.queue_number = None
+    to_run.put()
+    task_to_run.set_lookup_cache(to_run.key, False)
+    task_to_run.set_lookup_cache(to_run.key, False)
+    self.assertEqual(
+        (frozenset(), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+    task_to_run.set_lookup_cache(to_run.key, True)
+    self.assertEqual(
+        (frozenset([h]), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+
+  def test_rebuild_active_dimensions_hashes(self):
+    to_run = _gen_new_task_to_run()
+    h = to_run.key.integer_id()
+    accepted = frozenset([h])
+    task_to_run.rebuild_active_dimensions_hashes()
+    self.assertEqual(
+        (frozenset([h]), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+
+    # The task is reaped without updating the counter, e.g. it was evicted.
+    to_run.queue_number = None
+    to_run.put()
+    self.assertEqual(
+        (frozenset([h]), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+
+    # The dimensions_hash is only dropped once absent from two scans.
+    task_to_run.rebuild_active_dimensions_hashes()
+    self.assertEqual(
+        (frozenset([h]), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+    state = task_to_run.rebuild_active_dimensions_hashes()
+    self.assertEqual(frozenset(), state['hashes'])
+    self.assertEqual(
+        (frozenset(), False),
+        task_to_run._get_active_dimensions_hashes(accepted))
+
+    # Only one scan runs at a time.
+    memcache.add('rebuild', True, namespace='task_to_run_hashes')
+    self.assertEqual(None, task_to_run.rebuild_active_dimensions_hashes())
+
   def test_yield_next_available_task_to_run_task_exceeds_deadline(self):
     request_dimensions = {
       u'OS': u'Windows-3.1.1',
@@ -627,6 +838,25 @@ class TaskToRunApiTest(TestCase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions, 0)
     self.failIf(actual)
 
+  def test_yield_next_available_task_to_run_task_no_timeout(self):
+    # A task that never times out is never given to a bot with a deadline.
+    to_run = _gen_new_task_to_run(properties=dict(execution_timeout_secs=0))
+    self.assertEqual(0, to_run.max_runtime_secs)
+    task_to_run.rebuild_active_dimensions_hashes()
+    bot_dimensions = {u'pool': u'default'}
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    # It is rejected with the value returned by the query, without loading any
+    # entity.
+    def get_multi_async(keys, **_kwargs):
+      self.assertEqual([], keys)
+      return []
+    self.mock(ndb, 'get_multi_async', get_multi_async)
+    self.assertEqual(
+        [],
+        _yield_next_available_task_to_dispatch(
+            bot_dimensions, utils.time_time() + 10*24*60*60))
+
   def test_yield_next_available_task_to_run_task_meets_deadline(self):
     request_dimensions = {
       u'OS': u'Windows-3.1.1',
@@ -644,11 +874,27 @@ class TaskToRunApiTest(TestCase):
       {
         'dimensions_hash': _hash_dimensions(request_dimensions),
         'expiration_ts': self.expiration_ts,
+        'max_runtime_secs': 24*60*60 + 600 + 3*30 + 10,
         'queue_number': '0x000a890b67ba1346',
       },
     ]
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_run_task_no_max_runtime_secs(self):
+    # A TaskToRun saved before max_runtime_secs was added is checked against
+    # the TaskRequest.
+    to_run = _gen_new_task_to_run()
+    to_run.max_runtime_secs = None
+    to_run.put()
+    bot_dimensions = {u'pool': u'default'}
+    deadline = utils.time_time() + 86400 + 600 + 3 * 30 + 10
+    self.assertEqual(
+        [], _yield_next_available_task_to_dispatch(bot_dimensions, deadline))
+    self.assertEqual(
+        1,
+        len(_yield_next_available_task_to_dispatch(
+            bot_dimensions, deadline + 1)))
+
   def test_yield_expired_task_to_run(self):
     now = utils.utcnow()
     _gen_new_task_to_run(
@@ -685,6 +931,29 @@ class TaskToRunApiTest(TestCase):
     to_run.put()
     self.assertEqual(False, to_run.is_reapable)
 
+  def test_claim_task_to_run(self):
+    to_run = _gen_new_task_to_run()
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+    self.assertEqual(False, task_to_run.claim_task_to_run(to_run.key, 'bot2'))
+    self.assertEqual(False, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+
+  def test_claim_task_to_run_memcache_error(self):
+    to_run = _gen_new_task_to_run()
+    class Rpc(object):
+      def get_result(self):
+        return None
+    self.mock(
+        memcache.Client, 'add_multi_async', lambda *_args, **_kwargs: Rpc())
+    # The bot proceeds with the DB transaction.
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot2'))
+
+  def test_release_task_to_run(self):
+    to_run = _gen_new_task_to_run()
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+    task_to_run.release_task_to_run(to_run.key)
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot2'))
+
   def test_set_lookup_cache(self):
     to_run = _gen_new_task_to_run(
         properties={
@@ -566,11 +566,12 @@ class CompleteState(object):
     self.saved_state.update_isolated(command, infiles, read_only, relative_cwd)
     logging.debug(self)
 
-  def files_to_metadata(self, subdir):
+  def files_to_metadata(self, subdir, fingerprint_cache=None):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
-    file is tainted.
+    file is tainted. |fingerprint_cache| is an optional
+    isolated_format.FingerprintCache.
 
     See isolated_format.file_to_metadata() for more information.
     """
@@ -583,7 +584,8 @@ class CompleteState(object):
             filepath,
             self.saved_state.files[infile],
             self.saved_state.read_only,
-            self.saved_state.algo)
+            self.saved_state.algo,
+            fingerprint_cache)
 
   def save_files(self):
     """Saves self.saved_state and creates a .isolated file."""
@@ -618,7 +620,8 @@ class CompleteState(object):
     return out
 
 
-def load_complete_state(options, cwd, subdir, skip_update):
+def load_complete_state(
+    options, cwd, subdir, skip_update, fingerprint_cache=None):
   """Loads a CompleteState.
 
   This includes data from .isolate and .isolated.state files. Never reads the
@@ -633,6 +636,8 @@ def load_complete_state(options, cwd, subdir, skip_update):
             to CompleteState.root_dir.
     skip_update: Skip trying to load the .isolate file and processing the
                  dependencies. It is useful when not needed, like when tracing.
+    fingerprint_cache: optional isolated_format.FingerprintCache used to skip
+                       hashing unmodified files.
   """
   assert not options.isolate or os.path.isabs(options.isolate)
   assert not options.isolated or os.path.isabs(options.isolated)
@@ -692,7 +697,7 @@ def load_complete_state(options, cwd, subdir, skip_update):
     subdir = subdir.replace('/', os.path.sep)
 
   if not skip_update:
-    complete_state.files_to_metadata(subdir)
+    complete_state.files_to_metadata(subdir, fingerprint_cache)
   return complete_state
 
 
@@ -727,10 +732,10 @@ def create_isolate_tree(outdir, root_dir, files, relative_cwd, read_only):
 
 
 @tools.profile
-def prepare_for_archival(options, cwd):
+def prepare_for_archival(options, cwd, fingerprint_cache=None):
   """Loads the isolated file and create 'infiles' for archival."""
   complete_state = load_complete_state(
-      options, cwd, options.subdir, False)
+      options, cwd, options.subdir, False, fingerprint_cache)
   # Make sure that complete_state isn't modified until save_files() is
   # called, because any changes made to it here will propagate to the files
   # created (which is probably not intended).
@@ -760,7 +765,8 @@ def prepare_for_archival(options, cwd):
   return complete_state, infiles, isolated_hash
 
 
-def isolate_and_archive(trees, isolate_server, namespace):
+def isolate_and_archive(
+    trees, isolate_server, namespace, fingerprint_cache=None):
   """Isolates and uploads a bunch of isolated trees.
 
   Args:
@@ -768,6 +774,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
         to isolate. Options are processed by 'process_isolate_options'.
     isolate_server: URL of Isolate Server to upload to.
     namespace: namespace to upload to.
+    fingerprint_cache: optional isolated_format.FingerprintCache used to skip
+        hashing files that were not modified since the last run.
 
   Returns a dict {target name -> isolate hash or None}, where target name is
   a name of *.isolated file without an extension (e.g. 'base_unittests').
@@ -797,7 +805,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
-        complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
+        complete_state, files, isolated_hash = prepare_for_archival(
+            opts, cwd, fingerprint_cache)
         files_generators.append(emit_files(complete_state.root_dir, files))
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
@@ -850,6 +859,7 @@ def CMDarchive(parser, args):
   add_isolate_options(parser)
   add_subdir_option(parser)
   isolateserver.add_isolate_server_options(parser)
+  isolateserver.add_fingerprint_cache_options(parser)
   auth.add_auth_options(parser)
   options, args = parser.parse_args(args)
   if args:
@@ -857,10 +867,16 @@ def CMDarchive(parser, args):
   process_isolate_options(parser, options)
   auth.process_auth_options(parser, options)
   isolateserver.process_isolate_server_options(parser, options, True)
-  result = isolate_and_archive(
-      [(options, unicode(os.getcwd()))],
-      options.isolate_server,
-      options.namespace)
+  fingerprint_cache = isolateserver.process_fingerprint_cache_options(options)
+  try:
+    result = isolate_and_archive(
+        [(options, unicode(os.getcwd()))],
+        options.isolate_server,
+        options.namespace,
+        fingerprint_cache)
+  finally:
+    if fingerprint_cache is not None:
+      fingerprint_cache.save()
   if result is None:
     return EXIT_CODE_UPLOAD_ERROR
   assert len(result) == 1, result
@@ -888,6 +904,7 @@ def CMDbatcharchive(parser, args):
   """
   isolateserver.add_isolate_server_options(parser)
   isolateserver.add_archive_options(parser)
+  isolateserver.add_fingerprint_cache_options(parser)
   auth.add_auth_options(parser)
   parser.add_option(
       '--dump-json',
@@ -919,8 +936,14 @@ def CMDbatcharchive(parser, args):
     work_units.append((parse_archive_command_line(args, cwd), cwd))
 
   # Perform the archival, all at once.
-  isolated_hashes = isolate_and_archive(
-      work_units, options.isolate_server, options.namespace)
+  fingerprint_cache = isolateserver.process_fingerprint_cache_options(options)
+  try:
+    isolated_hashes = isolate_and_archive(
+        work_units, options.isolate_server, options.namespace,
+        fingerprint_cache)
+  finally:
+    if fingerprint_cache is not None:
+      fingerprint_cache.save()
 
   # TODO(vadimsh): isolate_and_archive returns None on upload failure, there's
   # no way currently to figure out what *.isolated file from a batch were
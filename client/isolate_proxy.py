@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Local caching proxy for an Isolate Server.
+
+It serves the subset of the isolate server API used by isolateserver.py, so
+the bots of a host can use it as their --isolate-server. The items fetched are
+kept in a single content addressed cache shared by all the bots and concurrent
+fetches of the same item are coalesced into a single upstream fetch. Uploads
+are forwarded as is.
+
+The proxy doesn't authenticate its clients: it serves the cached content to
+anyone who can connect and forwards the uploads with its own credentials. As
+such it only listens on a loopback interface.
+"""
+
+__version__ = '0.1.0'
+
+import BaseHTTPServer
+import base64
+import json
+import logging
+import os
+import re
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from third_party.depot_tools import fix_encoding
+
+from utils import logging_utils
+from utils import net
+from utils import tools
+
+import auth
+import isolated_format
+import isolateserver
+
+
+# Prefix of the isolate server API endpoints.
+API_PREFIX = '/_ah/api/isolateservice/v1/'
+
+
+# Endpoints that are forwarded to the upstream server without caching.
+FORWARDED_METHODS = frozenset((
+  'finalize_gs_upload',
+  'preupload',
+  'server_details',
+  'store_inline',
+  'store_inline_batch',
+))
+
+
+# Items up to this size are returned inline by /retrieve and /retrieve_batch,
+# the others are returned as an URL to /content so they are not base64 encoded
+# in the JSON response. Matches the server, which stores the items smaller than
+# MIN_SIZE_FOR_GS inline.
+MAX_INLINE_SIZE = 500
+
+
+# Minimum delay in seconds between two trimmings of the caches.
+TRIM_INTERVAL = 60
+
+
+# Valid namespace names, they are used as directory names.
+NAMESPACE_RE = re.compile(r'^[a-z0-9A-Z\-._]+$')
+
+
+def _verified(namespace, digest, stream):
+  """Yields the chunks of |stream| and verifies they match |digest|.
+
+  The chunks are yielded as fetched from the server, i.e. compressed in
+  compressed namespaces, but the digest is computed on the uncompressed data.
+
+  Raises IOError on mismatch, before the last chunk is yielded so the item is
+  not saved in the cache.
+  """
+  h = isolated_format.get_hash_algo(namespace)()
+  decompressor = None
+  if isolated_format.is_namespace_with_compression(namespace):
+    decompressor = zlib.decompressobj()
+  pending = None
+  try:
+    for chunk in stream:
+      if pending is not None:
+        yield pending
+      if decompressor:
+        data = decompressor.decompress(chunk, isolated_format.DISK_FILE_CHUNK)
+        while data:
+          h.update(data)
+          data = decompressor.decompress(
+              decompressor.unconsumed_tail, isolated_format.DISK_FILE_CHUNK)
+      else:
+        h.update(chunk)
+      pending = chunk
+    if decompressor:
+      h.update(decompressor.flush())
+  except zlib.error as e:
+    raise IOError('Corrupted %s / %s: %s' % (namespace, digest, e))
+  if h.hexdigest() != digest:
+    raise IOError('Hash mismatch for %s / %s' % (namespace, digest))
+  if pending is not None:
+    yield pending
+
+
+class ProxyStore(object):
+  """Items cached by the proxy, one DiskCache per namespace.
+
+  The items are kept as returned by the upstream server, i.e. compressed in
+  compressed namespaces, so they can be served without recompressing them. As
+  such DiskCache.cleanup() must not be called, it would see them as corrupted.
+  """
+
+  def __init__(self, cache_dir, policies, get_storage_api):
+    """
+    Arguments:
+      cache_dir: directory where to keep a cache per namespace.
+      policies: isolateserver.CachePolicies used by each cache.
+      get_storage_api: callable(namespace) returning the upstream StorageApi.
+    """
+    self._cache_dir = cache_dir
+    self._policies = policies
+    self._get_storage_api = get_storage_api
+    self._lock = threading.Lock()
+    # dict(namespace: (DiskCache, StorageApi)).
+    self._namespaces = {}
+    # Items being fetched, dict((namespace, digest): threading.Event).
+    self._fetching = {}
+    self._last_trim = time.time()
+    self.stats = {'coalesced': 0, 'hits': 0, 'misses': 0}
+
+  def close(self):
+    """Saves the state of all the caches."""
+    with self._lock:
+      namespaces, self._namespaces = self._namespaces, {}
+    for cache, _ in namespaces.itervalues():
+      cache.__exit__(None, None, None)
+
+  def open(self, namespace, digest):
+    """Returns a file object to read the item from, fetching it if needed.
+
+    Raises IOError if the item can't be fetched.
+    """
+    cache, api = self._get(namespace, digest)
+    key = (namespace, digest)
+    while True:
+      try:
+        f = cache.getfileobj(digest)
+        with self._lock:
+          self.stats['hits'] += 1
+        return f
+      except IOError:
+        pass
+      with self._lock:
+        event = self._fetching.get(key)
+        leader = event is None
+        if leader:
+          event = self._fetching[key] = threading.Event()
+          self.stats['misses'] += 1
+        else:
+          self.stats['coalesced'] += 1
+      if not leader:
+        # Try the cache again once the other fetch completed. If it failed,
+        # this thread becomes the leader of the next attempt.
+        event.wait()
+        continue
+      try:
+        cache.write(digest, _verified(namespace, digest, api.fetch(digest)))
+      finally:
+        with self._lock:
+          del self._fetching[key]
+        event.set()
+      self._maybe_trim()
+      return cache.getfileobj(digest)
+
+  def read_batch(self, namespace, digests):
+    """Returns the content of the small items that can be fetched cheaply.
+
+    Returns:
+      dict(digest: content) for the items whose content is returned.
+    """
+    cache, api = self._get(namespace)
+    out = {}
+    missing = []
+    for digest in digests:
+      self._check_digest(namespace, digest)
+      if not self._read_small(cache, digest, out):
+        missing.append(digest)
+    # Like in open(), only one upstream fetch runs per item. The items being
+    # fetched by another request are read once it completed.
+    fetch = []
+    waiting = []
+    with self._lock:
+      self.stats['hits'] += len(digests) - len(missing)
+      for digest in missing:
+        event = self._fetching.get((namespace, digest))
+        if event is None:
+          self._fetching[(namespace, digest)] = threading.Event()
+          fetch.append(digest)
+        else:
+          waiting.append((digest, event))
+      self.stats['misses'] += len(fetch)
+      self.stats['coalesced'] += len(waiting)
+    if fetch:
+      try:
+        for digest, data in api.fetch_batch(fetch).iteritems():
+          try:
+            cache.write(digest, _verified(namespace, digest, [data]))
+          except IOError as e:
+            logging.error('%s', e)
+            continue
+          out[digest] = data
+      finally:
+        with self._lock:
+          events = [self._fetching.pop((namespace, d)) for d in fetch]
+        for event in events:
+          event.set()
+      self._maybe_trim()
+    for digest, event in waiting:
+      # If the other fetch failed, the client falls back to /retrieve.
+      event.wait()
+      self._read_small(cache, digest, out)
+    return out
+
+  @staticmethod
+  def _read_small(cache, digest, out):
+    """Sets out[digest] to the content of the cached item if it is small.
+
+    Returns False if the item is not cached.
+    """
+    try:
+      with cache.getfileobj(digest) as f:
+        data = f.read(MAX_INLINE_SIZE + 1)
+    except IOError:
+      return False
+    if len(data) <= MAX_INLINE_SIZE:
+      out[digest] = data
+    return True
+
+  def _check_digest(self, namespace, digest):
+    if not isolated_format.is_valid_hash(
+        digest, isolated_format.get_hash_algo(namespace)):
+      raise ValueError('Invalid digest %r' % digest)
+
+  def _get(self, namespace, digest=None):
+    """Returns the (DiskCache, StorageApi) for |namespace|."""
+    if not NAMESPACE_RE.match(namespace):
+      raise ValueError('Invalid namespace %r' % namespace)
+    if digest is not None:
+      self._check_digest(namespace, digest)
+    with self._lock:
+      if namespace not in self._namespaces:
+        cache = isolateserver.DiskCache(
+            os.path.join(self._cache_dir, namespace), self._policies,
+            isolated_format.get_hash_algo(namespace))
+        self._namespaces[namespace] = (
+            cache, self._get_storage_api(namespace))
+      return self._namespaces[namespace]
+
+  def _maybe_trim(self):
+    """Trims the caches every TRIM_INTERVAL seconds.
+
+    The large items are evicted and the profiling values of the caches, which
+    are not used, are reset so they don't grow forever.
+    """
+    with self._lock:
+      now = time.time()
+      if now - self._last_trim < TRIM_INTERVAL:
+        return
+      self._last_trim = now
+      caches = [cache for cache, _ in self._namespaces.itervalues()]
+    for cache in caches:
+      cache.trim()
+      cache.reset_stats()
+
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the isolate server API from a ProxyServer."""
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    match = re.match(r'^/content/([^/]+)/([0-9a-f]+)$', self.path)
+    if not match:
+      self._send(404, 'text/plain', 'Not found')
+      return
+    namespace, digest = match.groups()
+    try:
+      f = self.server.store.open(namespace, digest)
+    except ValueError as e:
+      self._send(400, 'text/plain', str(e))
+      return
+    except IOError as e:
+      logging.error('%s', e)
+      self._send(404, 'text/plain', 'Not found')
+      return
+    with f:
+      f.seek(0, os.SEEK_END)
+      size = f.tell()
+      start, end = 0, size - 1
+      status = 200
+      headers = {}
+      range_header = self.headers.get('Range')
+      if range_header:
+        match = re.match(r'^bytes=(\d+)-(\d*)$', range_header)
+        if match:
+          start = int(match.group(1))
+          if match.group(2):
+            end = min(end, int(match.group(2)))
+        if not match or start >= size or end < start:
+          self._send(
+              416, 'text/plain', 'Invalid range',
+              {'Content-Range': 'bytes */%d' % size})
+          return
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+      self._send_headers(
+          status, 'application/octet-stream', end - start + 1, headers)
+      f.seek(start)
+      remaining = end - start + 1
+      while remaining:
+        chunk = f.read(min(remaining, isolateserver.NET_IO_FILE_CHUNK))
+        if not chunk:
+          break
+        self.wfile.write(chunk)
+        remaining -= len(chunk)
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    if not self.path.startswith(API_PREFIX):
+      self._send(404, 'text/plain', 'Not found')
+      return
+    method = self.path[len(API_PREFIX):].split('?', 1)[0]
+    try:
+      request = json.loads(body or '{}')
+      if method == 'retrieve':
+        response = self._retrieve(request)
+      elif method == 'retrieve_batch':
+        response = self._retrieve_batch(request)
+      elif method in FORWARDED_METHODS:
+        response = net.url_read_json(
+            self.server.upstream + self.path, data=request)
+        if response is None:
+          self._send(502, 'text/plain', 'Upstream request failed')
+          return
+      else:
+        self._send(404, 'text/plain', 'Not found')
+        return
+    except (KeyError, TypeError, ValueError) as e:
+      self._send(400, 'text/plain', str(e))
+      return
+    except IOError as e:
+      logging.error('%s', e)
+      self._send(404, 'text/plain', 'Not found')
+      return
+    self._send(200, 'application/json', json.dumps(response))
+
+  def log_message(self, fmt, *args):
+    logging.debug(
+        '%s - - [%s] %s', self.address_string(), self.log_date_time_string(),
+        fmt % args)
+
+  def _retrieve(self, request):
+    namespace = request['namespace']['namespace']
+    digest = str(request['digest'])
+    offset = int(request.get('offset') or 0)
+    with self.server.store.open(namespace, digest) as f:
+      f.seek(0, os.SEEK_END)
+      if f.tell() <= MAX_INLINE_SIZE:
+        f.seek(offset)
+        return {'content': base64.b64encode(f.read())}
+    return {
+      'url': 'http://%s/content/%s/%s' % (
+          self.headers.get('Host') or '%s:%d' % self.server.server_address,
+          namespace, digest),
+    }
+
+  def _retrieve_batch(self, request):
+    namespace = request['namespace']['namespace']
+    digests = [str(d) for d in request['digests']]
+    found = self.server.store.read_batch(namespace, digests)
+    out = []
+    for digest in digests:
+      data = found.get(digest)
+      if data is None:
+        out.append(struct.pack('>I', 0xffffffff))
+      else:
+        out.append(struct.pack('>I', len(data)) + data)
+    return {'content': base64.b64encode(''.join(out))}
+
+  def _send(self, status, content_type, data, headers=None):
+    self._send_headers(status, content_type, len(data), headers)
+    self.wfile.write(data)
+
+  def _send_headers(self, status, content_type, length, headers=None):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(length))
+    for key, value in sorted((headers or {}).iteritems()):
+      self.send_header(key, value)
+    self.end_headers()
+
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Serves a ProxyStore over HTTP, one thread per connection."""
+  daemon_threads = True
+
+  def __init__(self, address, upstream, store):
+    BaseHTTPServer.HTTPServer.__init__(self, address, ProxyHandler)
+    self.upstream = upstream.rstrip('/')
+    self.store = store
+
+  @property
+  def url(self):
+    return 'http://%s:%d' % self.server_address
+
+
+def is_loopback(host):
+  """Returns True if |host| resolves to a loopback address."""
+  try:
+    infos = socket.getaddrinfo(host, None)
+  except socket.error:
+    return False
+  for info in infos:
+    address = info[4][0]
+    if not (address.startswith('127.') or address == '::1'):
+      return False
+  return bool(infos)
+
+
+def main(args):
+  parser = logging_utils.OptionParserWithLogging(
+      usage='%prog <options>', version=__version__, description=__doc__)
+  parser.add_option(
+      '--host', default='127.0.0.1',
+      help='Loopback interface to listen on, default: %default')
+  parser.add_option(
+      '--port', type='int', default=0,
+      help='Port to listen on, default to a random port')
+  isolateserver.add_isolate_server_options(parser)
+  isolateserver.add_cache_options(parser)
+  parser.set_defaults(cache='proxy_cache')
+  auth.add_auth_options(parser)
+  options, args = parser.parse_args(args)
+  if args:
+    parser.error('Unsupported argument: %s' % args)
+  if not is_loopback(options.host):
+    parser.error(
+        '--host %s is not a loopback interface, the proxy doesn\'t '
+        'authenticate its clients.' % options.host)
+  auth.process_auth_options(parser, options)
+  isolateserver.process_isolate_server_options(parser, options, True)
+
+  policies = isolateserver.CachePolicies(
+      options.max_cache_size, options.min_free_space, options.max_items,
+      options.cache_policy, options.max_admitted_size)
+  cache_dir = unicode(os.path.abspath(options.cache))
+  store = ProxyStore(
+      cache_dir, policies,
+      lambda namespace: isolateserver.get_storage_api(
+          options.isolate_server, namespace))
+  server = ProxyServer(
+      (options.host, options.port), options.isolate_server, store)
+  print('Serving %s on %s' % (options.isolate_server, server.url))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    store.close()
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  tools.disable_buffering()
+  sys.exit(main(sys.argv[1:]))
@@ -11,9 +11,12 @@ import os
 import re
 import stat
 import sys
+import threading
+import time
 
 from utils import file_path
 from utils import fs
+from utils import lru
 from utils import tools
 
 
@@ -38,6 +41,17 @@ SUPPORTED_ALGOS = {
 SUPPORTED_ALGOS_REVERSE = dict((v, k) for k, v in SUPPORTED_ALGOS.iteritems())
 
 
+# Maximum number of file fingerprints kept by FingerprintCache. The least
+# recently used ones are evicted.
+FINGERPRINT_CACHE_MAX_ITEMS = 200000
+
+
+# Files modified less than this number of seconds ago are not added to
+# FingerprintCache, since they may still be modified without their timestamp
+# changing.
+FINGERPRINT_CACHE_MIN_AGE = 2
+
+
 class IsolatedError(ValueError):
   """Generic failure to load a .isolated file."""
   pass
@@ -65,11 +79,106 @@ def is_namespace_with_compression(namespace):
   return namespace.endswith(('-gzip', '-deflate'))
 
 
-def hash_file(filepath, algo):
+class FingerprintCache(object):
+  """Persistent mapping of file fingerprints to file content digests.
+
+  The fingerprint of a file is made of its device, inode, size, modification
+  time and status change time, so it changes whenever the file content is
+  modified. A hit saves reading and hashing the whole file.
+
+  Stores its state as a json file. Thread safe.
+  """
+
+  def __init__(self, state_file, max_items=FINGERPRINT_CACHE_MAX_ITEMS):
+    """
+    Arguments:
+      state_file: path to the file to load and save the state from and to.
+      max_items: maximum number of fingerprints to keep.
+    """
+    self.state_file = state_file
+    self.max_items = max_items
+    self._lock = threading.Lock()
+    # Fingerprint -> hex digest.
+    self._lru = lru.LRUDict()
+    self._dirty = False
+    if fs.isfile(state_file):
+      try:
+        self._lru = lru.LRUDict.load(state_file)
+      except ValueError as e:
+        logging.warning('Ignoring fingerprint cache: %s', e)
+
+  def __len__(self):
+    with self._lock:
+      return len(self._lru)
+
+  @staticmethod
+  def fingerprint(filestats, algo):
+    """Returns the fingerprint of a file as a str from its os.stat() result."""
+    mtime_ns = getattr(
+        filestats, 'st_mtime_ns', int(filestats.st_mtime * 1000000000))
+    ctime_ns = getattr(
+        filestats, 'st_ctime_ns', int(filestats.st_ctime * 1000000000))
+    return '%s:%d:%d:%d:%d:%d' % (
+        SUPPORTED_ALGOS_REVERSE.get(algo) or algo().name,
+        filestats.st_dev, filestats.st_ino, filestats.st_size,
+        mtime_ns, ctime_ns)
+
+  def get(self, filestats, algo):
+    """Returns the cached hex digest of a file or None."""
+    key = self.fingerprint(filestats, algo)
+    with self._lock:
+      digest = self._lru.get(key)
+      if digest is not None:
+        self._lru.touch(key)
+      return digest
+
+  def add(self, filestats, algo, digest):
+    """Stores the hex digest of a file, evicting old fingerprints if needed."""
+    if time.time() - filestats.st_mtime < FINGERPRINT_CACHE_MIN_AGE:
+      return
+    key = self.fingerprint(filestats, algo)
+    with self._lock:
+      self._lru.add(key, digest)
+      while len(self._lru) > self.max_items:
+        self._lru.pop_oldest()
+      self._dirty = True
+
+  def save(self):
+    """Saves the state if it was modified. Returns True on success."""
+    with self._lock:
+      if not self._dirty:
+        return True
+      try:
+        self._lru.save(self.state_file)
+        self._dirty = False
+        return True
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save fingerprint cache: %s', e)
+        return False
+
+
+def hash_file(filepath, algo, fingerprint_cache=None):
   """Calculates the hash of a file without reading it all in memory at once.
 
   |algo| should be one of hashlib hashing algorithm.
+
+  If |fingerprint_cache| is a FingerprintCache, it is used to skip hashing files
+  that were not modified since they were last hashed.
   """
+  cache = fingerprint_cache
+  if cache is not None:
+    filestats = fs.stat(filepath)
+    digest = cache.get(filestats, algo)
+    if digest:
+      return digest
+  digest = _hash_file_content(filepath, algo)
+  if cache is not None:
+    cache.add(filestats, algo, digest)
+  return digest
+
+
+def _hash_file_content(filepath, algo):
+  """Reads and hashes the content of a file."""
   digest = algo()
   with fs.open(filepath, 'rb') as f:
     while True:
@@ -104,8 +213,12 @@ class IsolatedFile(object):
     data.
     """
     logging.debug('IsolatedFile.load(%s)' % self.obj_hash)
+    self.load_data(load_isolated(content, self.algo))
+
+  def load_data(self, data):
+    """Loads this object with data already verified by load_isolated()."""
     assert not self._is_loaded
-    self.data = load_isolated(content, self.algo)
+    self.data = data
     self.children = [
         IsolatedFile(i, self.algo) for i in self.data.get('includes', [])
     ]
@@ -307,7 +420,8 @@ def expand_directories_and_symlinks(
 
 
 @tools.profile
-def file_to_metadata(filepath, prevdict, read_only, algo):
+def file_to_metadata(
+    filepath, prevdict, read_only, algo, fingerprint_cache=None):
   """Processes an input file, a dependency, and return meta data about it.
 
   Behaviors:
@@ -324,6 +438,8 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
                windows, mode is not set since all files are 'executable' by
                default.
     algo:      Hashing algorithm used.
+    fingerprint_cache: optional FingerprintCache used to skip hashing files
+                       that were not modified since they were last hashed.
 
   Returns:
     The necessary dict to create a entry in the 'files' section of an .isolated
@@ -372,7 +488,7 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
       # Reuse the previous hash if available.
       out['h'] = prevdict.get('h')
     if not out.get('h'):
-      out['h'] = hash_file(filepath, algo)
+      out['h'] = hash_file(filepath, algo, fingerprint_cache)
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
@@ -9,11 +9,14 @@ __version__ = '0.4.7'
 
 import base64
 import functools
+import heapq
 import logging
+import marshal
 import optparse
 import os
 import re
 import signal
+import struct
 import sys
 import tempfile
 import threading
@@ -69,6 +72,14 @@ DEADLOCK_TIMEOUT = 5 * 60
 ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
 
 
+# Past the ITEMS_PER_CONTAINS_QUERIES ramp, Storage adapts the number of files
+# per /pre-upload query between ITEMS_PER_CONTAINS_QUERIES[0] and this value:
+# it grows while the queries take less than CONTAINS_QUERY_TARGET_DURATION
+# seconds and is halved when one fails or is slower.
+MAX_ITEMS_PER_CONTAINS_QUERY = 1000
+CONTAINS_QUERY_TARGET_DURATION = 5.
+
+
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
@@ -86,6 +97,35 @@ NET_IO_FILE_CHUNK = 16 * 1024
 DOWNLOAD_READ_TIMEOUT = 60
 
 
+# Minimum size of an item in an uncompressed namespace to be downloaded as
+# multiple concurrent byte ranges, when enabled with --download-ranges. Smaller
+# items are not worth the overhead of additional HTTP requests.
+MIN_SIZE_FOR_RANGED_FETCH = 64 * 1024 * 1024
+
+
+# Items up to this size are stored inline by the server, so FetchQueue fetches
+# them ITEMS_PER_FETCH_BATCH at a time instead of one HTTP round trip per item.
+MAX_SIZE_FOR_BATCH_FETCH = 500
+ITEMS_PER_FETCH_BATCH = 100
+
+
+# Missing items up to this size are uploaded ITEMS_PER_PUSH_BATCH at a time by
+# upload_items() when the server stores them inline.
+MAX_SIZE_FOR_BATCH_PUSH = 500
+ITEMS_PER_PUSH_BATCH = 100
+
+
+# Items seen on the server are not checked again for this long, in seconds.
+# /preupload is also what extends the expiration of the existing items, so this
+# must remain well below the server expiration delay (7 days by default).
+EXISTENCE_CACHE_TTL = 24 * 60 * 60
+
+
+# Maximum number of items remembered by ExistenceCache. The oldest are
+# forgotten first.
+EXISTENCE_CACHE_MAX_ITEMS = 200000
+
+
 # The delay (in seconds) to wait between logging statements when retrieving
 # the required files. This is intended to let the user (or buildbot) know that
 # the program is still running.
@@ -191,6 +231,23 @@ def zip_decompress(
     raise IOError('Not all data was decompressed')
 
 
+class RestartableContent(object):
+  """Iterable that restarts a content stream each time it is iterated over.
+
+  Used to stream an upload as its chunks are produced, e.g. by zip_compress(),
+  and to retry it without ever buffering the whole content in memory.
+  """
+
+  def __init__(self, content_factory):
+    """Arguments:
+      content_factory: callable that returns a new iterable of str chunks.
+    """
+    self._content_factory = content_factory
+
+  def __iter__(self):
+    return iter(self._content_factory())
+
+
 def get_zip_compression_level(filename):
   """Given a filename calculates the ideal zip compression level to use."""
   file_ext = os.path.splitext(filename)[1].lower()
@@ -233,7 +290,13 @@ def is_valid_file(path, size):
   """
   if size == UNKNOWN_FILE_SIZE:
     return fs.isfile(path)
-  actual_size = fs.stat(path).st_size
+  try:
+    actual_size = fs.stat(path).st_size
+  except OSError as e:
+    logging.warning(
+        'Can\'t read item %s, assuming it\'s invalid: %s',
+        os.path.basename(path), e)
+    return False
   if size != actual_size:
     logging.warning(
         'Found invalid item %s; %d != %d',
@@ -313,6 +376,88 @@ class BufferItem(Item):
     return [self.buffer]
 
 
+class ExistenceCache(object):
+  """Persistent set of the items known to be present on isolate servers.
+
+  Items are keyed by server, namespace and digest and are remembered for |ttl|
+  seconds after the server last reported them as present or they were
+  uploaded, so get_missing_items() doesn't have to check them again.
+
+  Stores its state as a json file. Thread safe.
+  """
+
+  def __init__(
+      self, state_file, ttl=EXISTENCE_CACHE_TTL,
+      max_items=EXISTENCE_CACHE_MAX_ITEMS):
+    """
+    Arguments:
+      state_file: path to the file to load and save the state from and to.
+      ttl: number of seconds an item is assumed to remain present.
+      max_items: maximum number of items to remember.
+    """
+    self.state_file = state_file
+    self.ttl = ttl
+    self.max_items = max_items
+    self._lock = threading.Lock()
+    # Key -> timestamp of the last time the item was seen on the server, oldest
+    # first.
+    self._lru = lru.LRUDict()
+    self._dirty = False
+    if fs.isfile(state_file):
+      try:
+        self._lru = lru.LRUDict.load(state_file)
+      except ValueError as e:
+        logging.warning('Ignoring existence cache: %s', e)
+
+  def __len__(self):
+    with self._lock:
+      return len(self._lru)
+
+  @staticmethod
+  def key(location, namespace, digest):
+    return '%s %s %s' % (location, namespace, digest)
+
+  def is_present(self, location, namespace, digest):
+    """True if the item was seen on the server less than |ttl| seconds ago."""
+    key = self.key(location, namespace, digest)
+    with self._lock:
+      timestamp = self._lru.get(key)
+      if timestamp is None:
+        return False
+      if time.time() - timestamp < self.ttl:
+        return True
+      self._lru.pop(key)
+      self._dirty = True
+      return False
+
+  def add(self, location, namespace, digests):
+    """Remembers that the items |digests| are present on the server now."""
+    now = int(time.time())
+    with self._lock:
+      for digest in digests:
+        self._lru.add(self.key(location, namespace, digest), now)
+        self._dirty = True
+      while len(self._lru) > self.max_items:
+        self._lru.pop_oldest()
+
+  def save(self):
+    """Saves the state if it was modified. Returns True on success."""
+    with self._lock:
+      if not self._dirty:
+        return True
+      # Do not save the items that already expired.
+      now = time.time()
+      while self._lru and now - self._lru.get_oldest()[1] >= self.ttl:
+        self._lru.pop_oldest()
+      try:
+        self._lru.save(self.state_file)
+        self._dirty = False
+        return True
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save existence cache: %s', e)
+        return False
+
+
 class Storage(object):
   """Efficiently downloads or uploads large set of files via StorageApi.
 
@@ -333,8 +478,30 @@ class Storage(object):
     self._hash_algo = isolated_format.get_hash_algo(storage_api.namespace)
     self._cpu_thread_pool = None
     self._net_thread_pool = None
+    # The number of concurrent network operations and the number of items per
+    # 'contains' query adapt to the observed errors and latency.
+    self._net_concurrency = threading_utils.AdaptiveConcurrency(
+        threading_utils.IOAutoRetryThreadPool.INITIAL_WORKERS, 1,
+        threading_utils.IOAutoRetryThreadPool.MAX_WORKERS)
+    self._contains_batch_size = threading_utils.AdaptiveLimit(
+        ITEMS_PER_CONTAINS_QUERIES[-1], ITEMS_PER_CONTAINS_QUERIES[0],
+        MAX_ITEMS_PER_CONTAINS_QUERY, ITEMS_PER_CONTAINS_QUERIES[0])
     self._aborted = False
     self._prev_sig_handlers = {}
+    # Number of concurrent byte ranges to download large uncompressed items
+    # with. 1 disables ranged downloads.
+    self.download_ranges = 1
+    # Order of the network operations of the same priority. The transfers are
+    # described with their TaskChannel as flow and their size in bytes. FIFO by
+    # default, so large items are not delayed until the end; use
+    # threading_utils.SizeScheduler when the goal is the number of files per
+    # second.
+    self.net_scheduler = threading_utils.Scheduler
+    # Scheduler stats of the last closed net_thread_pool.
+    self._net_scheduler_stats = None
+    # ExistenceCache of the items known to be present on the server, which are
+    # not checked again by get_missing_items().
+    self.existence_cache = None
 
   @property
   def hash_algo(self):
@@ -372,7 +539,11 @@ class Storage(object):
   def net_thread_pool(self):
     """AutoRetryThreadPool for IO-bound tasks, retries IOError."""
     if self._net_thread_pool is None:
-      self._net_thread_pool = threading_utils.IOAutoRetryThreadPool()
+      self._net_thread_pool = threading_utils.IOAutoRetryThreadPool(
+          self._net_concurrency, self.net_scheduler)
+      # Keep a connection alive for each worker, to the isolate server and to
+      # Google Storage.
+      net.ensure_connection_pool_size(self._net_thread_pool.MAX_WORKERS)
     return self._net_thread_pool
 
   def close(self):
@@ -385,9 +556,28 @@ class Storage(object):
     if self._net_thread_pool:
       self._net_thread_pool.join()
       self._net_thread_pool.close()
+      self._net_scheduler_stats = self._net_thread_pool.get_scheduler_stats()
       self._net_thread_pool = None
+      stats = net.get_connection_stats()
+      logging.info(
+          '%d HTTP requests sent over %d connections',
+          stats['requests'], stats['connections'])
+      logging.info('Network: %s', self.get_network_stats())
     logging.info('Done.')
 
+  def get_network_stats(self):
+    """Returns the state of the adaptive network concurrency control and the
+    queue depth and wait time histograms of the network operations.
+    """
+    scheduler = self._net_scheduler_stats
+    if self._net_thread_pool:
+      scheduler = self._net_thread_pool.get_scheduler_stats()
+    return {
+      'concurrency': self._net_concurrency.get_stats(),
+      'contains_batch_size': self._contains_batch_size.get_stats(),
+      'scheduler': scheduler,
+    }
+
   def abort(self):
     """Cancels any pending or future operations."""
     # This is not strictly theadsafe, but in the worst case the logging message
@@ -419,36 +609,53 @@ class Storage(object):
     It figures out what items are missing from the server and uploads only them.
 
     Arguments:
-      items: list of Item instances that represents data to upload.
+      items: list of Item instances that represents data to upload. It can also
+             be a generator, in which case the existence checks and uploads
+             start while it is still yielding items.
 
     Returns:
       List of items that were uploaded. All other items are already there.
     """
-    logging.info('upload_items(items=%d)', len(items))
-
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    logging.info('upload_items()')
 
     # For each digest keep only first Item that matches it. All other items
     # are just indistinguishable copies from the point of view of isolate
     # server (it doesn't care about paths at all, only content and digests).
     seen = {}
-    duplicates = 0
-    for item in items:
-      if seen.setdefault(item.digest, item) is not item:
-        duplicates += 1
-    items = seen.values()
-    if duplicates:
-      logging.info('Skipped %d files with duplicated content', duplicates)
-
-    # Enqueue all upload tasks.
+    counts = {'total': 0}
+    def unique_items():
+      for item in items:
+        counts['total'] += 1
+        item.prepare(self._hash_algo)
+        if seen.setdefault(item.digest, item) is item:
+          yield item
+
+    unique = unique_items()
+    if isinstance(items, list):
+      # All the items are known upfront, let get_missing_items() sort them.
+      unique = list(unique)
+
+    # Enqueue all upload tasks. Small items are grouped in batches.
     missing = set()
     uploaded = []
+    batch = []
     channel = threading_utils.TaskChannel()
-    for missing_item, push_state in self.get_missing_items(items):
+    for missing_item, push_state in self.get_missing_items(unique):
       missing.add(missing_item)
-      self.async_push(channel, missing_item, push_state)
+      if missing_item.size <= MAX_SIZE_FOR_BATCH_PUSH:
+        batch.append((missing_item, push_state))
+        if len(batch) >= ITEMS_PER_PUSH_BATCH:
+          self.async_push_batch(channel, batch)
+          batch = []
+      else:
+        self.async_push(channel, missing_item, push_state)
+    if batch:
+      self.async_push_batch(channel, batch)
+
+    items = seen.values()
+    duplicates = counts['total'] - len(items)
+    if duplicates:
+      logging.info('Skipped %d files with duplicated content', duplicates)
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -460,6 +667,9 @@ class Storage(object):
           uploaded.append(item)
           logging.debug(
               'Uploaded %d / %d: %s', len(uploaded), len(missing), item.digest)
+      if self.existence_cache is not None:
+        self.existence_cache.add(
+            self.location, self.namespace, [i.digest for i in uploaded])
     logging.info('All files are uploaded')
 
     # Print stats.
@@ -517,28 +727,59 @@ class Storage(object):
       self._storage_api.push(item, push_state, content)
       return item
 
-    # If zipping is not required, just start a push task.
-    if not self._use_zip:
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, item.content())
-      return
+    # If zipping is enabled, the content is compressed on the fly while it is
+    # being uploaded. The compression is restarted if the push is retried, so
+    # the compressed file is never assembled in memory.
+    content = None
+    if self._use_zip:
+      content = RestartableContent(
+          lambda: zip_compress(item.content(), item.compression_level))
+    self.net_thread_pool.add_task_with_channel_and_hints(
+        channel, priority,
+        threading_utils.TaskHints(flow=channel, size=item.size),
+        push, content)
 
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
-      try:
-        if self._aborted:
-          raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        data = ''.join(stream)
-      except Exception as exc:
-        logging.error('Failed to zip \'%s\': %s', item, exc)
-        channel.send_exception()
-        return
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+  def async_push_batch(self, channel, items):
+    """Starts asynchronous push of many small items at once.
+
+    The items not pushed by StorageApi.push_batch() are then pushed one by one
+    with async_push().
+
+    Arguments:
+      channel: TaskChannel that receives back each item when its upload ends.
+      items: list of (item, push_state) tuples, see async_push().
+    """
+    priority = (
+        threading_utils.PRIORITY_HIGH
+        if any(item.high_priority for item, _ in items)
+        else threading_utils.PRIORITY_MED)
+
+    def push():
+      # Every item must be reported to |channel| so nothing can be raised.
+      pushed = []
+      if not self._aborted:
+        batch = []
+        for item, push_state in items:
+          content = None
+          if self._use_zip:
+            content = ''.join(
+                zip_compress(item.content(), item.compression_level))
+          batch.append((item, push_state, content))
+        try:
+          pushed = set(self._storage_api.push_batch(batch))
+        except Exception as e:
+          logging.warning('Failed to push %d items at once: %s', len(items), e)
+      for item, push_state in items:
+        if item in pushed:
+          channel.send_result(item)
+        else:
+          self.async_push(channel, item, push_state)
+
+    self.net_thread_pool.add_task_with_hints(
+        priority,
+        threading_utils.TaskHints(
+            flow=channel, size=sum(item.size for item, _ in items)),
+        push)
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -560,20 +801,37 @@ class Storage(object):
       assert pushed is item
     return item
 
-  def async_fetch(self, channel, priority, digest, size, sink):
+  def async_fetch(self, channel, priority, digest, size, sink, cache=None):
     """Starts asynchronous fetch from the server in a parallel thread.
 
+    A fetch interrupted after it made some progress, e.g. because of a dropped
+    connection, is resumed from the first byte not yet received instead of
+    being restarted from scratch.
+
+    Items of an uncompressed namespace larger than MIN_SIZE_FOR_RANGED_FETCH
+    are fetched as |download_ranges| concurrent byte ranges.
+
     Arguments:
       channel: TaskChannel that receives back |digest| when download ends.
       priority: thread pool task priority for the fetch.
       digest: hex digest of an item to download.
       size: expected size of the item (after decompression).
       sink: function that will be called as sink(generator).
+      cache: LocalCache that |sink| writes to, if any. When it supports
+          LocalCache.allocate(), the byte ranges are written directly in a file
+          of the cache that is then adopted, instead of going through |sink|.
     """
+    if (self.download_ranges > 1 and
+        not self._use_zip and
+        size != UNKNOWN_FILE_SIZE and
+        size >= MIN_SIZE_FOR_RANGED_FETCH):
+      self._async_fetch_ranges(channel, priority, digest, size, sink, cache)
+      return
+
     def fetch():
       try:
         # Prepare reading pipeline.
-        stream = self._storage_api.fetch(digest)
+        stream = self._fetch_resumable(digest)
         if self._use_zip:
           stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
         # Run |stream| through verifier that will assert its size.
@@ -587,15 +845,183 @@ class Storage(object):
 
     # Don't bother with zip_thread_pool for decompression. Decompression is
     # really fast and most probably IO bound anyway.
-    self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
+    self.net_thread_pool.add_task_with_channel_and_hints(
+        channel, priority, threading_utils.TaskHints(flow=channel, size=size),
+        fetch)
+
+  def async_fetch_batch(self, channel, priority, items):
+    """Starts asynchronous fetch of many small items at once.
+
+    The items not returned by StorageApi.fetch_batch(), or returned corrupted,
+    are then fetched one by one with async_fetch().
+
+    Arguments:
+      channel: TaskChannel that receives back each digest when its download
+          ends.
+      priority: thread pool task priority for the fetch.
+      items: list of (digest, size, sink) tuples, see async_fetch().
+    """
+    def fetch():
+      # Every item must be reported to |channel| so nothing can be raised.
+      try:
+        fetched = self._storage_api.fetch_batch([i[0] for i in items])
+      except Exception as e:
+        logging.warning('Failed to fetch %d items at once: %s', len(items), e)
+        fetched = {}
+      for digest, size, sink in items:
+        content = fetched.get(digest)
+        if content is None:
+          self.async_fetch(channel, priority, digest, size, sink)
+          continue
+        stream = [content]
+        if self._use_zip:
+          stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+        try:
+          sink(FetchStreamVerifier(stream, size).run())
+        except isolated_format.MappingError:
+          # The cache failed, fetching it again won't help.
+          logging.error('Failed to fetch %s', digest)
+          channel.send_exception()
+        except IOError as e:
+          # Corrupted content.
+          logging.warning('Fetching %s again: %s', digest, e)
+          self.async_fetch(channel, priority, digest, size, sink)
+        except Exception:
+          logging.error('Failed to fetch %s', digest)
+          channel.send_exception()
+        else:
+          channel.send_result(digest)
+
+    self.net_thread_pool.add_task_with_hints(
+        priority,
+        threading_utils.TaskHints(
+            flow=channel, size=sum(i[1] for i in items)),
+        fetch)
+
+  def _fetch_resumable(self, digest, offset=0, length=None):
+    """Yields the content of |digest| as returned by StorageApi.fetch().
+
+    When the stream breaks after having made some progress, the fetch is resumed
+    at the offset of the first byte not yet received. A fetch failing without
+    any progress raises IOError so the retry is left to the caller.
+
+    Since offsets are in the stored representation, it works the same for
+    compressed namespaces, the decompressor simply sees a continuous stream.
+    """
+    end = None if length is None else offset + length
+    while True:
+      start = offset
+      try:
+        if end is None:
+          stream = self._storage_api.fetch(digest, offset)
+        else:
+          stream = self._storage_api.fetch(digest, offset, end - offset)
+        for chunk in stream:
+          if self._aborted:
+            raise Aborted()
+          offset += len(chunk)
+          yield chunk
+        return
+      except IOError as e:
+        if offset == start:
+          raise
+        logging.warning(
+            'Resuming fetch of %s at offset %d: %s', digest, offset, e)
+
+  def _async_fetch_ranges(self, channel, priority, digest, size, sink, cache):
+    """Fetches |digest| as concurrent byte ranges into a preallocated file.
+
+    Each range is written at its offset in the file as it is received. The file
+    is allocated in |cache| when possible and adopted by it once all ranges are
+    done, so the item is written only once. Otherwise it is a temporary file
+    that is verified and sent to |sink|.
+    """
+    path = cache.allocate(size) if cache else None
+    adopt = path is not None
+    if not adopt:
+      handle, path = tempfile.mkstemp(prefix=u'isolateserver')
+      os.close(handle)
+      with fs.open(path, 'r+b') as f:
+        f.truncate(size)
+
+    range_size = -(-size // self.download_ranges)
+    ranges = [
+      (offset, min(range_size, size - offset))
+      for offset in xrange(0, size, range_size)
+    ]
+    lock = threading.Lock()
+    # Number of ranges still being fetched and first failure, if any.
+    state = {'remaining': len(ranges), 'exc_info': None}
+
+    def finish():
+      try:
+        if state['exc_info']:
+          logging.error(
+              'Failed to fetch %s: %s', digest, state['exc_info'][1])
+          channel.send_exception(state['exc_info'])
+          return
+        try:
+          if adopt:
+            cache.adopt(digest, path)
+          else:
+            sink(FetchStreamVerifier(file_read(path), size).run())
+        except Exception as err:
+          logging.error('Failed to fetch %s: %s', digest, err)
+          channel.send_exception()
+          return
+        channel.send_result(digest)
+      finally:
+        file_path.try_remove(path)
+
+    def fetch_range(offset, length):
+      # Never raises, the failure is reported once all ranges are done.
+      exc_info = None
+      try:
+        with fs.open(path, 'r+b') as f:
+          for attempt in xrange(threading_utils.IOAutoRetryThreadPool.RETRIES):
+            f.seek(offset)
+            received = 0
+            try:
+              for chunk in self._fetch_resumable(digest, offset, length):
+                f.write(chunk)
+                received += len(chunk)
+              if received != length:
+                raise IOError(
+                    'Incorrect range size at offset %d: expected %d, got %d' %
+                    (offset, length, received))
+              break
+            except IOError as e:
+              if attempt == threading_utils.IOAutoRetryThreadPool.RETRIES - 1:
+                raise
+              logging.warning(
+                  'Retrying range at offset %d of %s: %s', offset, digest, e)
+      except Exception:
+        exc_info = sys.exc_info()
+      with lock:
+        state['remaining'] -= 1
+        if exc_info and not state['exc_info']:
+          state['exc_info'] = exc_info
+        if state['remaining']:
+          return
+      finish()
+
+    logging.info('Fetching %s in %d ranges', digest, len(ranges))
+    for offset, length in ranges:
+      self.net_thread_pool.add_task_with_hints(
+          priority, threading_utils.TaskHints(flow=channel, size=length),
+          fetch_range, offset, length)
 
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
-    Issues multiple parallel queries via StorageApi's 'contains' method.
+    Issues multiple parallel queries via StorageApi's 'contains' method. The
+    items in |existence_cache|, if set, are assumed present and not checked.
 
     Arguments:
-      items: a list of Item objects to check.
+      items: a list of Item objects to check. It can also be a generator, in
+             which case queries are sent as soon as a batch of items is ready
+             and the results already available are yielded while |items| is
+             still being consumed.
 
     Yields:
       For each missing item it yields a pair (item, push_state), where:
@@ -608,52 +1034,100 @@ class Storage(object):
     channel = threading_utils.TaskChannel()
     pending = 0
 
+    existence_cache = self.existence_cache
+
     # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    def prepared(items):
+      for item in items:
+        item.prepare(self._hash_algo)
+        if existence_cache is None or not existence_cache.is_present(
+            self.location, self.namespace, item.digest):
+          yield item
+    if isinstance(items, list):
+      items = list(prepared(items))
+    else:
+      items = prepared(items)
 
     def contains(batch):
       if self._aborted:
         raise Aborted()
-      return self._storage_api.contains(batch)
-
-    # Enqueue all requests.
-    for batch in batch_items_for_check(items):
+      epoch = self._contains_batch_size.epoch
+      start = time.time()
+      try:
+        missing = self._storage_api.contains(batch)
+      except Exception:
+        self._contains_batch_size.on_failure(epoch)
+        raise
+      if time.time() - start > CONTAINS_QUERY_TARGET_DURATION:
+        self._contains_batch_size.on_failure(epoch)
+      else:
+        self._contains_batch_size.on_success()
+      if existence_cache is not None:
+        existence_cache.add(
+            self.location, self.namespace,
+            [i.digest for i in batch if i not in missing])
+      return missing
+
+    # Enqueue the requests as the batches are ready, yielding the results that
+    # are already in without waiting for the rest of |items|.
+    batches = batch_items_for_check(
+        items, lambda: self._contains_batch_size.value)
+    for batch in batches:
       self.net_thread_pool.add_task_with_channel(
           channel, threading_utils.PRIORITY_HIGH, contains, batch)
       pending += 1
-
-    # Yield results as they come in.
+      while pending:
+        try:
+          result = channel.pull(timeout=0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        for missing_item, push_state in result.iteritems():
+          yield missing_item, push_state
+
+    # Yield the remaining results as they come in.
     for _ in xrange(pending):
       for missing_item, push_state in channel.pull().iteritems():
         yield missing_item, push_state
 
 
-def batch_items_for_check(items):
+def batch_items_for_check(items, batch_size_limit=None):
   """Splits list of items to check for existence on the server into batches.
 
   Each batch corresponds to a single 'exists?' query to the server via a call
   to StorageApi's 'contains' method.
 
   Arguments:
-    items: a list of Item objects.
+    items: a list of Item objects, largest items are checked first. It can also
+           be a generator, in which case each batch is yielded as soon as it is
+           full and only the items within a batch are sorted.
+    batch_size_limit: optional function returning the size of the next batch
+           once past the ITEMS_PER_CONTAINS_QUERIES ramp.
 
   Yields:
     Batches of items to query for existence in a single operation,
     each batch is a list of Item objects.
   """
+  if isinstance(items, list):
+    items = sorted(items, key=lambda x: x.size, reverse=True)
   batch_count = 0
-  batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
+  batch_size = ITEMS_PER_CONTAINS_QUERIES[0]
   next_queries = []
-  for item in sorted(items, key=lambda x: x.size, reverse=True):
+  for item in items:
     next_queries.append(item)
-    if len(next_queries) == batch_size_limit:
+    if len(next_queries) >= batch_size:
+      next_queries.sort(key=lambda x: x.size, reverse=True)
       yield next_queries
       next_queries = []
       batch_count += 1
-      batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[
-          min(batch_count, len(ITEMS_PER_CONTAINS_QUERIES) - 1)]
+      if batch_count < len(ITEMS_PER_CONTAINS_QUERIES):
+        batch_size = ITEMS_PER_CONTAINS_QUERIES[batch_count]
+      elif batch_size_limit:
+        batch_size = batch_size_limit()
+      else:
+        batch_size = ITEMS_PER_CONTAINS_QUERIES[-1]
   if next_queries:
+    next_queries.sort(key=lambda x: x.size, reverse=True)
     yield next_queries
 
 
@@ -672,6 +1146,10 @@ class FetchQueue(object):
     self._pending = set()
     self._accessed = set()
     self._fetched = cache.cached_set()
+    # Small items not yet requested, they are fetched in batches, list of
+    # (digest, size, sink).
+    self._batch = []
+    self._batch_priority = None
 
   def add(
       self,
@@ -706,9 +1184,23 @@ class FetchQueue(object):
 
     # Start fetching.
     self._pending.add(digest)
+    sink = functools.partial(self.cache.write, digest)
+    if size != UNKNOWN_FILE_SIZE and size <= MAX_SIZE_FOR_BATCH_FETCH:
+      self._batch.append((digest, size, sink))
+      self._batch_priority = min(self._batch_priority or priority, priority)
+      if len(self._batch) >= ITEMS_PER_FETCH_BATCH:
+        self._flush_batch()
+      return
     self.storage.async_fetch(
-        self._channel, priority, digest, size,
-        functools.partial(self.cache.write, digest))
+        self._channel, priority, digest, size, sink, self.cache)
+
+  def _flush_batch(self):
+    """Starts fetching the small items accumulated by add()."""
+    if self._batch:
+      self.storage.async_fetch_batch(
+          self._channel, self._batch_priority, self._batch)
+      self._batch = []
+      self._batch_priority = None
 
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
@@ -723,6 +1215,7 @@ class FetchQueue(object):
     # Ensure all requested items are being fetched now.
     assert all(digest in self._pending for digest in digests), (
         digests, self._pending)
+    self._flush_batch()
 
     # Wait for some requested item to finish fetching.
     while self._pending:
@@ -826,18 +1319,48 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
-  def fetch(self, digest, offset=0):
+  def fetch(self, digest, offset=0, length=None):
     """Fetches an object and yields its content.
 
     Arguments:
       digest: hash digest of item to download.
       offset: offset (in bytes) from the start of the file to resume fetch from.
+      length: number of bytes to fetch starting at |offset|, None to fetch up to
+          the end of the file.
 
     Yields:
       Chunks of downloaded item (as str objects).
     """
     raise NotImplementedError()
 
+  def fetch_batch(self, digests):
+    """Fetches many small objects at once.
+
+    Only the objects that can be returned cheaply are, the others have to be
+    fetched with fetch(). The default implementation returns none.
+
+    Arguments:
+      digests: list of hash digests of the items to download.
+
+    Returns:
+      dict(digest: content) of the items fetched.
+    """
+    return {}
+
+  def push_batch(self, items):
+    """Uploads many small items at once.
+
+    Only the items that can be uploaded cheaply are, the others have to be
+    uploaded with push(). The default implementation uploads none.
+
+    Arguments:
+      items: list of (item, push_state, content) tuples, see push().
+
+    Returns:
+      List of the Item objects uploaded.
+    """
+    return []
+
   def push(self, item, push_state, content=None):
     """Uploads an |item| with content generated by |content| generator.
 
@@ -855,10 +1378,13 @@ class StorageApi(object):
     a source of original uncompressed data). This is implemented by Storage
     class.
 
+    |content| may be iterated more than once, e.g. when an upload is restarted.
+    Each iteration must yield the whole content from the beginning.
+
     Arguments:
       item: Item object that holds information about an item being pushed.
       push_state: push state object as returned by 'contains' call.
-      content: a generator that yields chunks to push, item.content() if None.
+      content: an iterable that yields chunks to push, item.content() if None.
 
     Returns:
       None.
@@ -918,7 +1444,11 @@ class IsolateServer(StorageApi):
     }
     self._lock = threading.Lock()
     self._server_caps = None
-    self._memory_use = 0
+    # Set once /retrieve_batch is known to be unsupported, i.e. the server
+    # returned a 404 or a malformed response.
+    self._no_fetch_batch = False
+    # Same for /store_inline_batch.
+    self._no_push_batch = False
 
   @property
   def _server_capabilities(self):
@@ -948,8 +1478,9 @@ class IsolateServer(StorageApi):
   def namespace(self):
     return self._namespace
 
-  def fetch(self, digest, offset=0):
+  def fetch(self, digest, offset=0, length=None):
     assert offset >= 0
+    assert length is None or length > 0
     source_url = '%s/_ah/api/isolateservice/v1/retrieve' % (
         self._base_url)
     logging.debug('download_file(%s, %d)', source_url, offset)
@@ -963,16 +1494,25 @@ class IsolateServer(StorageApi):
     # for DB uploads
     content = response.get('content')
     if content is not None:
-      yield base64.b64decode(content)
+      content = base64.b64decode(content)
+      yield content if length is None else content[:length]
       return
 
     # for GS entities
-    connection = net.url_open(response['url'])
+    kwargs = {}
+    ranged = bool(offset or length is not None)
+    if ranged:
+      kwargs['headers'] = {
+        'Range': 'bytes=%d-%s' % (
+            offset, '' if length is None else offset + length - 1),
+      }
+    connection = net.url_open(response['url'], **kwargs)
     if not connection:
       raise IOError('Failed to download %s / %s' % (self._namespace, digest))
 
-    # If |offset|, verify server respects it by checking Content-Range.
-    if offset:
+    # If a range was requested, verify server respects it by checking
+    # Content-Range.
+    if ranged:
       content_range = connection.get_header('Content-Range')
       if not content_range:
         raise IOError('Missing Content-Range header')
@@ -995,13 +1535,62 @@ class IsolateServer(StorageApi):
         raise IOError('Expecting offset %d, got %d (Content-Range is %s)' % (
             offset, content_offset, content_range))
 
-      # Ensure entire tail of the file is returned.
-      if size is not None and last_byte_index + 1 != size:
+      # Ensure the entire range or tail of the file is returned.
+      if length is not None:
+        if last_byte_index + 1 != offset + length:
+          raise IOError(
+              'Incomplete response. Content-Range: %s' % content_range)
+      elif size is not None and last_byte_index + 1 != size:
         raise IOError('Incomplete response. Content-Range: %s' % content_range)
 
     for data in connection.iter_content(NET_IO_FILE_CHUNK):
       yield data
 
+  def fetch_batch(self, digests):
+    if self._no_fetch_batch:
+      return {}
+    try:
+      response = net.url_read_json(
+          url='%s/_ah/api/isolateservice/v1/retrieve_batch' % self._base_url,
+          data={
+            'digests': [d.encode('utf-8') for d in digests],
+            'namespace': self._namespace_dict,
+          },
+          read_timeout=DOWNLOAD_READ_TIMEOUT,
+          raise_http_error=True)
+    except net.HttpError as e:
+      if e.code == 404:
+        # The server doesn't support it, use fetch() for the rest of the run.
+        logging.warning('Disabling /retrieve_batch: %s', e)
+        self._no_fetch_batch = True
+      return {}
+    if response is None:
+      # Transient error, only this batch is fetched with fetch().
+      return {}
+    try:
+      data = base64.b64decode(response.get('content') or '')
+      # A 32 bits big endian length followed by the content for each digest,
+      # 0xffffffff without content for the ones not returned.
+      out = {}
+      offset = 0
+      for digest in digests:
+        size, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        if size == 0xffffffff:
+          continue
+        if offset + size > len(data):
+          raise ValueError('truncated')
+        out[digest] = data[offset:offset+size]
+        offset += size
+      if offset != len(data):
+        raise ValueError('trailing data')
+    except (AttributeError, struct.error, TypeError, ValueError) as e:
+      # Do not retry it, use fetch() for the rest of the run.
+      logging.warning('Disabling /retrieve_batch: %s', e)
+      self._no_fetch_batch = True
+      return {}
+    return out
+
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
     assert item.digest is not None
@@ -1009,81 +1598,84 @@ class IsolateServer(StorageApi):
     assert isinstance(push_state, _IsolateServerPushState)
     assert not push_state.finalized
 
-    # Default to item.content().
-    content = item.content() if content is None else content
-    logging.info('Push state size: %d', push_state.size)
-    if isinstance(content, (basestring, list)):
-      # Memory is already used, too late.
-      with self._lock:
-        self._memory_use += push_state.size
+    # Default to item.content(). Unlike a generator returned by item.content(),
+    # RestartableContent can be iterated again when the upload is retried.
+    if content is None:
+      content = RestartableContent(item.content)
+
+    # This push operation may be a retry after failed finalization call below,
+    # no need to reupload contents in that case.
+    if not push_state.uploaded:
+      # PUT file to |upload_url|.
+      success = self.do_push(push_state, content)
+      if not success:
+        raise IOError('Failed to upload file with hash %s to URL %s' % (
+            item.digest, push_state.upload_url))
+      push_state.uploaded = True
     else:
-      # TODO(vadimsh): Do not read from |content| generator when retrying push.
-      # If |content| is indeed a generator, it can not be re-winded back to the
-      # beginning of the stream. A retry will find it exhausted. A possible
-      # solution is to wrap |content| generator with some sort of caching
-      # restartable generator. It should be done alongside streaming support
-      # implementation.
-      #
-      # In theory, we should keep the generator, so that it is not serialized in
-      # memory. Sadly net.HttpService.request() requires the body to be
-      # serialized.
-      assert isinstance(content, types.GeneratorType), repr(content)
-      slept = False
-      # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
-      # One byte less than 512mb. This is to cope with incompressible content.
-      max_size = int(sys.maxsize * 0.25)
-      while True:
-        with self._lock:
-          # This is due to 32 bits python when uploading very large files. The
-          # problem is that it's comparing uncompressed sizes, while we care
-          # about compressed sizes since it's what is serialized in memory.
-          # The first check assumes large files are compressible and that by
-          # throttling one upload at once, we can survive. Otherwise, kaboom.
-          memory_use = self._memory_use
-          if ((push_state.size >= max_size and not memory_use) or
-              (memory_use + push_state.size <= max_size)):
-            self._memory_use += push_state.size
-            memory_use = self._memory_use
-            break
-        time.sleep(0.1)
-        slept = True
-      if slept:
-        logging.info('Unblocked: %d %d', memory_use, push_state.size)
-
+      logging.info(
+          'A file %s already uploaded, retrying finalization only',
+          item.digest)
+
+    # Optionally notify the server that it's done.
+    if push_state.finalize_url:
+      # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
+      # send it to isolated server. That way isolate server can verify that
+      # the data safely reached Google Storage (GS provides MD5 and CRC32C of
+      # stored files).
+      # TODO(maruel): Fix the server to accept properly data={} so
+      # url_read_json() can be used.
+      response = net.url_read_json(
+          url='%s/%s' % (self._base_url, push_state.finalize_url),
+          data={
+              'upload_ticket': push_state.preupload_status['upload_ticket'],
+          })
+      if not response or not response['ok']:
+        raise IOError('Failed to finalize file with hash %s.' % item.digest)
+    push_state.finalized = True
+
+  def push_batch(self, items):
+    if self._no_push_batch:
+      return []
+    # Only the entries stored in the DB can be sent at once.
+    inline = [
+      (item, push_state, content) for item, push_state, content in items
+      if not push_state.finalize_url and not push_state.uploaded
+    ]
+    if not inline:
+      return []
     try:
-      # This push operation may be a retry after failed finalization call below,
-      # no need to reupload contents in that case.
-      if not push_state.uploaded:
-        # PUT file to |upload_url|.
-        success = self.do_push(push_state, content)
-        if not success:
-          raise IOError('Failed to upload file with hash %s to URL %s' % (
-              item.digest, push_state.upload_url))
-        push_state.uploaded = True
-      else:
-        logging.info(
-            'A file %s already uploaded, retrying finalization only',
-            item.digest)
-
-      # Optionally notify the server that it's done.
-      if push_state.finalize_url:
-        # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
-        # send it to isolated server. That way isolate server can verify that
-        # the data safely reached Google Storage (GS provides MD5 and CRC32C of
-        # stored files).
-        # TODO(maruel): Fix the server to accept properly data={} so
-        # url_read_json() can be used.
-        response = net.url_read_json(
-            url='%s/%s' % (self._base_url, push_state.finalize_url),
-            data={
+      response = net.url_read_json(
+          url='%s/_ah/api/isolateservice/v1/store_inline_batch' %
+              self._base_url,
+          data={
+            'items': [
+              {
                 'upload_ticket': push_state.preupload_status['upload_ticket'],
-            })
-        if not response or not response['ok']:
-          raise IOError('Failed to finalize file with hash %s.' % item.digest)
+                'content': base64.b64encode(
+                    ''.join(item.content() if content is None else content)),
+              } for item, push_state, content in inline
+            ],
+          },
+          raise_http_error=True)
+    except net.HttpError as e:
+      if e.code == 404:
+        # The server doesn't support it, use push() for the rest of the run.
+        logging.warning('Disabling /store_inline_batch: %s', e)
+        self._no_push_batch = True
+      return []
+    if response is None:
+      # Transient error, only this batch is pushed with push().
+      return []
+    if not isinstance(response, dict) or not response.get('ok'):
+      # Do not retry it, use push() for the rest of the run.
+      logging.warning('Disabling /store_inline_batch: %r', response)
+      self._no_push_batch = True
+      return []
+    for _, push_state, _ in inline:
+      push_state.uploaded = True
       push_state.finalized = True
-    finally:
-      with self._lock:
-        self._memory_use -= push_state.size
+    return [item for item, _, _ in inline]
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -1159,34 +1751,39 @@ class IsolateServer(StorageApi):
     subclasses.
 
     Args:
-      url: URL to upload the data to.
       push_state: an _IsolateServicePushState instance
-      item: the original Item to be uploaded
-      content: an iterable that yields 'str' chunks.
+      content: an iterable that yields 'str' chunks. If it is not a generator,
+          it may be iterated multiple times to retry the upload.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = ''.join(content)
+    if isinstance(content, basestring):
+      content = [content]
+    elif isinstance(content, types.GeneratorType):
+      # A generator can't be rewound to retry the upload, assemble it.
+      content = [''.join(content)]
 
     # DB upload
     if not push_state.finalize_url:
+      # Entries stored in the DB are small, it is fine to assemble them.
       url = '%s/%s' % (self._base_url, push_state.upload_url)
-      content = base64.b64encode(content)
       data = {
           'upload_ticket': push_state.preupload_status['upload_ticket'],
-          'content': content,
+          'content': base64.b64encode(''.join(content)),
       }
       response = net.url_read_json(url=url, data=data)
       return response is not None and response['ok']
 
     # upload to GS
+    if isinstance(content, list) and len(content) == 1:
+      # Already in memory, avoid a chunked upload.
+      data = content[0]
+    else:
+      # Stream the chunks as they are generated. Each retry by net.url_read()
+      # restarts the stream from the beginning.
+      data = lambda: iter(content)
     url = push_state.upload_url
     response = net.url_read(
         content_type='application/octet-stream',
-        data=content,
+        data=data,
         method='PUT',
         headers={'Cache-Control': 'public, max-age=31536000'},
         url=url)
@@ -1208,7 +1805,10 @@ class LocalCache(object):
     self._initial_number_items = 0
     self._initial_size = 0
     self._evicted = []
+    self._hits = []
     self._linked = []
+    # Parsed .isolated files, dict(digest: data).
+    self._parsed = {}
 
   def __enter__(self):
     """Context manager interface."""
@@ -1234,10 +1834,38 @@ class LocalCache(object):
   def initial_size(self):
     return self._initial_size
 
+  @property
+  def hits(self):
+    """Sizes of the items that were found in the cache."""
+    return self._hits[:]
+
   @property
   def linked(self):
     return self._linked[:]
 
+  def reset_stats(self):
+    """Forgets the profiling values accumulated so far.
+
+    For long running processes, which would otherwise keep them growing.
+    """
+    with self._lock:
+      self._added = []
+      self._evicted = []
+      self._hits = []
+      self._linked = []
+
+  @property
+  def eviction_policy(self):
+    """Name of the EvictionPolicy used, None if the cache never evicts."""
+    return None
+
+  @property
+  def copy_on_write(self):
+    """True if the mapped files are writeable and don't share the file node of
+    the cached items.
+    """
+    return False
+
   def cached_set(self):
     """Returns a set of all cached digests (always a new object)."""
     raise NotImplementedError()
@@ -1273,6 +1901,32 @@ class LocalCache(object):
     """
     raise NotImplementedError()
 
+  def allocate(self, size):
+    """Returns the path of a new file of |size| bytes to be filled in place,
+    then added to the cache with adopt().
+
+    Returns None if the cache doesn't store its items as files.
+    """
+    return None
+
+  def adopt(self, digest, path):
+    """Moves the file |path| returned by allocate() into the cache as |digest|.
+    """
+    raise NotImplementedError()
+
+  def read_parsed(self, digest):
+    """Returns the data of a parsed and validated .isolated file or None.
+
+    .isolated files are immutable so their data can be memoized by digest.
+    """
+    with self._lock:
+      return self._parsed.get(digest)
+
+  def write_parsed(self, digest, data):
+    """Memoizes the data of a parsed and validated .isolated file."""
+    with self._lock:
+      self._parsed[digest] = data
+
   def hardlink(self, digest, dest, file_mode):
     """Ensures file at |dest| has same content as cached |digest|.
 
@@ -1303,7 +1957,10 @@ class MemoryCache(LocalCache):
 
   def touch(self, digest, size):
     with self._lock:
-      return digest in self._contents
+      if digest not in self._contents:
+        return False
+      self._hits.append(len(self._contents[digest]))
+      return True
 
   def evict(self, digest):
     with self._lock:
@@ -1334,7 +1991,9 @@ class MemoryCache(LocalCache):
 
 
 class CachePolicies(object):
-  def __init__(self, max_cache_size, min_free_space, max_items):
+  def __init__(
+      self, max_cache_size, min_free_space, max_items, eviction='lru',
+      max_admitted_size=0):
     """
     Arguments:
     - max_cache_size: Trim if the cache gets larger than this value. If 0, the
@@ -1343,25 +2002,235 @@ class CachePolicies(object):
                       0, it unconditionally fill the disk.
     - max_items: Maximum number of items to keep in the cache. If 0, do not
                  enforce a limit.
+    - eviction: name of the EvictionPolicy deciding which items are trimmed
+                first, one of EVICTION_POLICIES.
+    - max_admitted_size: Items larger than this value are evicted once they
+                         were mapped instead of being kept in the cache. If 0,
+                         every item is kept.
     """
     self.max_cache_size = max_cache_size
     self.min_free_space = min_free_space
     self.max_items = max_items
+    self.eviction = eviction
+    self.max_admitted_size = max_admitted_size
 
 
-class DiskCache(LocalCache):
-  """Stateful LRU cache in a flat hash table in a directory.
+class EvictionPolicy(object):
+  """Decides in which order DiskCache evicts its items.
+
+  This base class evicts the least recently used item first, which is the
+  order DiskCache keeps its items in.
 
-  Saves its state as json file.
+  Subclasses keep access statistics for each item in self.stats, a
+  LRUDict(digest: (access count, last access, previous access, priority)) that
+  DiskCache saves along its state.
   """
-  STATE_FILE = u'state.json'
+  name = 'lru'
+
+  def __init__(self):
+    self.stats = lru.LRUDict()
+
+  def load(self, stats, items):
+    """Sets the statistics loaded from disk, |items| are the cached items."""
 
-  def __init__(self, cache_dir, policies, hash_algo):
+  def accessed(self, digest, size):
+    """Called when an item is added to the cache or used from it."""
+
+  def removed(self, digest):
+    """Called when an item is removed from the cache."""
+
+  def next_victim(self, items, protected):
+    """Returns the digest of the next item to evict.
+
+    Arguments:
+      items: LRUDict(digest: size) of the cached items, oldest first.
+      protected: set of digests that must not be evicted.
+
+    Raises Error if no item can be evicted.
+    """
+    try:
+      digest, _ = items.get_oldest()
+    except KeyError:
+      raise Error('Nothing to remove')
+    if digest in protected:
+      raise Error('Not enough space to map the whole isolated tree')
+    return digest
+
+
+class _StatsEvictionPolicy(EvictionPolicy):
+  """Evicts the item with the lowest priority() first.
+
+  Keeps a heap of (priority, digest), lazily built on the first eviction. Stale
+  entries are left in the heap and skipped when they reach the top.
+  """
+
+  # Statistics (access count, last access, second to last access, priority) of
+  # an item never accessed.
+  _DEFAULT_STATS = (0, 0, 0, None)
+  # Items cached before the policy was used are considered accessed once, a
+  # long time ago.
+  _UNKNOWN_STATS = (1, 0, 0, None)
+
+  def __init__(self):
+    super(_StatsEvictionPolicy, self).__init__()
+    self._heap = None
+
+  def priority(self, size, stats):
+    """Returns the priority of an item, a comparable value."""
+    raise NotImplementedError()
+
+  def load(self, stats, items):
+    self.stats = stats
+    for digest in self.stats.keys_set() - items.keys_set():
+      self.stats.pop(digest)
+
+  def accessed(self, digest, size):
+    count, last, _, _ = self.stats.get(digest) or self._DEFAULT_STATS
+    now = time.time()
+    stats = (count + 1, now, last, 0)
+    stats = stats[:3] + (self.priority(size, stats),)
+    self.stats.add(digest, stats)
+    if self._heap is not None:
+      heapq.heappush(self._heap, (stats[3], digest))
+
+  def removed(self, digest):
+    if digest in self.stats:
+      self.stats.pop(digest)
+
+  def next_victim(self, items, protected):
+    if self._heap is None:
+      self._heap = []
+      for digest in items:
+        stats = self.stats.get(digest)
+        if stats:
+          priority = stats[3]
+        else:
+          priority = self.priority(items[digest], self._UNKNOWN_STATS)
+        self._heap.append((priority, digest))
+      heapq.heapify(self._heap)
+    skipped = []
+    try:
+      while self._heap:
+        priority, digest = self._heap[0]
+        stats = self.stats.get(digest)
+        if digest not in items or (stats and stats[3] != priority):
+          # Stale entry.
+          heapq.heappop(self._heap)
+          continue
+        if digest in protected:
+          skipped.append(heapq.heappop(self._heap))
+          continue
+        return digest
+    finally:
+      for entry in skipped:
+        heapq.heappush(self._heap, entry)
+    if skipped:
+      raise Error('Not enough space to map the whole isolated tree')
+    raise Error('Nothing to remove')
+
+
+
+class LRUKEvictionPolicy(_StatsEvictionPolicy):
+  """LRU-2: evicts the item whose second to last access is the oldest.
+
+  Items accessed only once go first, so a single scan through large items
+  doesn't flush the items that are used repeatedly.
+  """
+  name = 'lru-2'
+
+  def priority(self, size, stats):
+    return (stats[2], stats[1])
+
+
+class LFUEvictionPolicy(_StatsEvictionPolicy):
+  """Size weighted LFU: evicts the item with the lowest access count per byte.
+  """
+  name = 'lfu'
+
+  def priority(self, size, stats):
+    return (float(stats[0]) / max(size, 1), stats[1])
+
+
+class GDSFEvictionPolicy(_StatsEvictionPolicy):
+  """Greedy Dual Size Frequency.
+
+  The priority of an item is L + access count / size, where L is the priority
+  of the last evicted item. L ages the items that are not accessed anymore. It
+  is saved in the statistics under the key u''.
+  """
+  name = 'gdsf'
+  _CLOCK_KEY = u''
+
+  def __init__(self):
+    super(GDSFEvictionPolicy, self).__init__()
+    self._clock = 0.
+
+  def load(self, stats, items):
+    clock = stats.get(self._CLOCK_KEY)
+    super(GDSFEvictionPolicy, self).load(stats, items)
+    if clock:
+      self._clock = clock[3]
+      self.stats.add(self._CLOCK_KEY, clock)
+
+  def priority(self, size, stats):
+    return self._clock + float(stats[0]) / max(size, 1)
+
+  def next_victim(self, items, protected):
+    digest = super(GDSFEvictionPolicy, self).next_victim(items, protected)
+    self._clock = self._heap[0][0]
+    self.stats.add(self._CLOCK_KEY, (0, 0, 0, self._clock))
+    return digest
+
+
+# Eviction policies selectable with --cache-policy.
+EVICTION_POLICIES = dict(
+    (cls.name, cls) for cls in (
+        EvictionPolicy, LRUKEvictionPolicy, LFUEvictionPolicy,
+        GDSFEvictionPolicy))
+
+
+class DiskCache(LocalCache):
+  """Stateful LRU cache in a hash table in a directory.
+
+  Items are sharded by the first two characters of their digest, e.g. item
+  'abcdef...' is stored as 'ab/cdef...'. Items stored in the flat layout used by
+  previous versions are moved to their shard on load.
+
+  Saves its state as a binary journal, see LRUDict.save_journal(). The state is
+  trusted on load; the files are only checked when they are accessed, the
+  shards are listed only when the state is missing or broken or when the
+  previous process exited before saving the items it added. The content of the
+  files is verified incrementally by cleanup().
+  """
+  STATE_FILE = u'state.bin'
+  # State file used by previous versions, it is migrated on load.
+  JSON_STATE_FILE = u'state.json'
+  # Items verified by cleanup(), saved as a binary journal.
+  VERIFIED_FILE = u'verified.bin'
+  # Statistics of the eviction policy, saved as a binary journal.
+  POLICY_FILE = u'policy.bin'
+  # Exists while items were added since the state was last saved. If it is
+  # found on load, the state is missing items and the shards are listed.
+  DIRTY_FILE = u'dirty'
+  # Directory holding the data of the parsed .isolated files, see
+  # write_parsed().
+  PARSED_DIR = u'parsed'
+  # Maximum number of bytes hashed by a cleanup() call.
+  VERIFY_BUDGET = 512 * 1024 * 1024
+  # Prefix of the files returned by allocate(). They are not valid digests, so
+  # the ones left behind by a crash are removed on load.
+  TEMP_PREFIX = u'tmp'
+  _SHARD_RE = re.compile(r'^[0-9a-f]{2}$')
+
+  def __init__(self, cache_dir, policies, hash_algo, reflink=False):
     """
     Arguments:
       cache_dir: directory where to place the cache.
       policies: cache retention policies.
       algo: hashing algorithm used.
+      reflink: map the files as copy-on-write clones instead of hardlinks.
+          Hardlinks are used if the file system of cache_dir doesn't support
+          it.
     """
     # All protected methods (starting with '_') except _path should be called
     # with self._lock held.
@@ -1369,9 +2238,26 @@ class DiskCache(LocalCache):
     self.cache_dir = cache_dir
     self.policies = policies
     self.hash_algo = hash_algo
+    self.reflink = reflink
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.verified_file = os.path.join(cache_dir, self.VERIFIED_FILE)
+    self.policy_file = os.path.join(cache_dir, self.POLICY_FILE)
+    self.dirty_file = os.path.join(cache_dir, self.DIRTY_FILE)
+    self.parsed_dir = os.path.join(cache_dir, self.PARSED_DIR)
     # Items in a LRU lookup dict(digest: size).
     self._lru = lru.LRUDict()
+    # Items whose content was verified, oldest verification first,
+    # dict(digest: timestamp). An item is removed once it is hardlinked since
+    # its content can then be modified through the link. Clones can't modify
+    # it.
+    self._verified = lru.LRUDict()
+    # Decides which items are evicted first.
+    self._policy = EVICTION_POLICIES[policies.eviction]()
+    # Items larger than policies.max_admitted_size added during this run, they
+    # are evicted on exit.
+    self._transient = set()
+    # Digests of the items having their parsed data saved in self.parsed_dir.
+    self._parsed_saved = set()
     # Current cached free disk space. It is updated by self._trim().
     self._free_disk = 0
     # The items that must not be evicted during this run since they were
@@ -1379,10 +2265,16 @@ class DiskCache(LocalCache):
     self._protected = set()
     # Cleanup operations done by self._load(), if any.
     self._operations = []
+    # True when self.dirty_file exists.
+    self._dirty = False
     with tools.Profiler('Setup'):
       with self._lock:
         # self._load() calls self._trim() which initializes self._free_disk.
         self._load()
+    if self.reflink and not self._probe_reflink():
+      logging.warning(
+          '%s doesn\'t support reflink, using hardlinks', self.cache_dir)
+      self.reflink = False
 
   def __enter__(self):
     return self
@@ -1390,6 +2282,7 @@ class DiskCache(LocalCache):
   def __exit__(self, _exc_type, _exec_value, _traceback):
     with tools.Profiler('CleanupTrimming'):
       with self._lock:
+        self._evict_transient()
         self._trim()
 
         logging.info(
@@ -1407,6 +2300,14 @@ class DiskCache(LocalCache):
             self._free_disk / 1024)
     return False
 
+  @property
+  def eviction_policy(self):
+    return self._policy.name
+
+  @property
+  def copy_on_write(self):
+    return self.reflink
+
   def cached_set(self):
     with self._lock:
       return self._lru.keys_set()
@@ -1418,19 +2319,50 @@ class DiskCache(LocalCache):
       logging.info(
           'Evicted items with the following sizes: %s', sorted(self._evicted))
 
-    # What remains to be done is to hash every single item to
-    # detect corruption, then save to ensure state.json is up to date.
-    # Sadly, on a 50Gb cache with 100mib/s I/O, this is still over 8 minutes.
-    # TODO(maruel): Let's revisit once directory metadata is stored in
-    # state.json so only the files that had been mapped since the last cleanup()
-    # call are manually verified.
-    #
-    #with self._lock:
-    #  for digest in self._lru:
-    #    if not isolated_format.is_valid_hash(
-    #        self._path(digest), self.hash_algo):
-    #      self.evict(digest)
-    #      logging.info('Deleted corrupted item: %s', digest)
+    # What remains to be done is to hash the items to detect corruption. On a
+    # 50Gb cache with 100mib/s I/O, hashing everything is over 8 minutes so
+    # only VERIFY_BUDGET bytes are hashed per call. The items never verified or
+    # hardlinked since their last verification go first, most recently used
+    # first, then the items verified the longest time ago.
+    with self._lock:
+      candidates = [
+          d for d in reversed(list(self._lru)) if d not in self._verified]
+      candidates.extend(self._verified)
+    budget = self.VERIFY_BUDGET
+    verified = []
+    corrupted = []
+    for digest in candidates:
+      if budget <= 0:
+        break
+      with self._lock:
+        size = self._lru.get(digest)
+      if size is None:
+        continue
+      budget -= size
+      try:
+        valid = (
+            isolated_format.hash_file(self._path(digest), self.hash_algo) ==
+            digest)
+      except (IOError, OSError):
+        valid = False
+      if valid:
+        verified.append(digest)
+        with self._lock:
+          if digest in self._lru:
+            self._verified.add(digest, int(time.time()))
+      else:
+        logging.warning('Deleted corrupted item: %s', digest)
+        corrupted.append(digest)
+        try:
+          self.evict(digest)
+        except KeyError:
+          pass
+    logging.info(
+        'Verified %d items, %d were corrupted; %d/%d items never verified',
+        len(verified), len(corrupted),
+        len(self._lru) - len(self._verified), len(self._lru))
+    with self._lock:
+      self._save()
 
   def touch(self, digest, size):
     """Verifies an actual file is valid.
@@ -1450,6 +2382,8 @@ class DiskCache(LocalCache):
         return False
       self._lru.touch(digest)
       self._protected.add(digest)
+      self._policy.accessed(digest, self._lru[digest])
+      self._hits.append(self._lru[digest])
     return True
 
   def evict(self, digest):
@@ -1463,10 +2397,83 @@ class DiskCache(LocalCache):
     with fs.open(self._path(digest), 'rb') as f:
       return f.read()
 
+  def getfileobj(self, digest):
+    """Opens a cached item for reading and updates its LRU position.
+
+    Unlike touch(), the file is not checked.
+
+    Raises IOError if the item is not in the cache.
+    """
+    with self._lock:
+      if digest not in self._lru:
+        raise IOError('%s is not cached' % digest)
+      self._lru.touch(digest)
+      self._policy.accessed(digest, self._lru[digest])
+      self._hits.append(self._lru[digest])
+    return fs.open(self._path(digest), 'rb')
+
+  def trim(self):
+    """Trims the cache, including the items used so far.
+
+    For long running processes, which would otherwise never evict the items
+    they used nor the items larger than policies.max_admitted_size.
+    """
+    with self._lock:
+      self._protected.clear()
+      self._evict_transient()
+      self._trim()
+
+  def read_parsed(self, digest):
+    data = super(DiskCache, self).read_parsed(digest)
+    if data is not None:
+      return data
+    with self._lock:
+      if digest not in self._parsed_saved or digest not in self._lru:
+        return None
+    path = os.path.join(self.parsed_dir, digest)
+    try:
+      with fs.open(path, 'rb') as f:
+        version, data = marshal.load(f)
+      if version != isolated_format.ISOLATED_FILE_VERSION:
+        raise ValueError('Unexpected version %r' % version)
+    except (IOError, OSError, EOFError, ValueError, TypeError) as e:
+      logging.warning('Ignoring parsed data of %s: %s', digest, e)
+      with self._lock:
+        self._parsed_saved.discard(digest)
+      file_path.try_remove(path)
+      return None
+    super(DiskCache, self).write_parsed(digest, data)
+    return data
+
+  def write_parsed(self, digest, data):
+    """Memoizes the data of a parsed .isolated file next to the cache.
+
+    It is saved with marshal, which loads much faster than the json file can be
+    parsed and validated. It is deleted when the item is evicted.
+    """
+    super(DiskCache, self).write_parsed(digest, data)
+    with self._lock:
+      if digest in self._parsed_saved:
+        return
+      if not fs.isdir(self.parsed_dir):
+        fs.mkdir(self.parsed_dir)
+      elif sys.platform != 'win32':
+        file_path.set_read_only(self.parsed_dir, False)
+      path = os.path.join(self.parsed_dir, digest)
+      try:
+        with fs.open(path, 'wb') as f:
+          marshal.dump((isolated_format.ISOLATED_FILE_VERSION, data), f)
+      except (IOError, OSError, ValueError) as e:
+        logging.warning('Failed to save parsed data of %s: %s', digest, e)
+        file_path.try_remove(path)
+        return
+      self._parsed_saved.add(digest)
+
   def write(self, digest, content):
     assert content is not None
     with self._lock:
       self._protected.add(digest)
+      self._mark_dirty()
     path = self._path(digest)
     # A stale broken file may remain. It is possible for the file to have write
     # access bit removed which would cause the file_write() call to fail to open
@@ -1482,22 +2489,69 @@ class DiskCache(LocalCache):
       # caller, it will be logged there.
       file_path.try_remove(path)
       raise
+    self._added_file(digest, size)
+    return digest
+
+  def allocate(self, size):
+    if sys.platform != 'win32':
+      # Necessary otherwise the file can't be created.
+      file_path.set_read_only(self.cache_dir, False)
+    handle, path = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=self.cache_dir)
+    os.close(handle)
+    try:
+      with fs.open(path, 'r+b') as f:
+        f.truncate(size)
+    except:
+      file_path.try_remove(path)
+      raise
+    return path
+
+  def adopt(self, digest, path):
+    with self._lock:
+      self._protected.add(digest)
+      self._mark_dirty()
+    dest = self._path(digest)
+    # Same as in write(), a stale broken file may remain.
+    file_path.try_remove(dest)
+    shard = os.path.dirname(dest)
+    if not fs.isdir(shard):
+      fs.makedirs(shard)
+    if sys.platform != 'win32':
+      # Necessary otherwise the file can't be moved.
+      file_path.set_read_only(self.cache_dir, False)
+    fs.rename(path, dest)
+    self._added_file(digest, fs.stat(dest).st_size)
+
+  def _added_file(self, digest, size):
+    """Adds a new file written at self._path(digest) to the cache."""
     # Make the file read-only in the cache.  This has a few side-effects since
     # the file node is modified, so every directory entries to this file becomes
     # read-only. It's fine here because it is a new file.
-    file_path.set_read_only(path, True)
+    file_path.set_read_only(self._path(digest), True)
     with self._lock:
       self._add(digest, size)
-    return digest
+      if (self.policies.max_admitted_size and
+          size > self.policies.max_admitted_size):
+        self._transient.add(digest)
 
   def hardlink(self, digest, dest, file_mode):
     """Hardlinks the file to |dest|.
 
     Note that the file permission bits are on the file node, not the directory
     entry, so changing the access bit on any of the directory entries for the
-    file node will affect them all.
+    file node will affect them all. It is not the case when self.reflink is
+    set.
     """
     path = self._path(digest)
+    if self.reflink:
+      # The clone is a distinct file node so it is made writeable right away,
+      # it can't affect the cached item.
+      file_path.link_file(dest, path, file_path.REFLINK_WITH_FALLBACK)
+      fs.chmod(dest, ((0400 if file_mode is None else file_mode) & 0700) | 0200)
+      with self._lock:
+        self._linked.append(self._lru[digest])
+      return
+
     if not file_path.link_file(dest, path, file_path.HARDLINK_WITH_FALLBACK):
       # Report to the server that it failed with more details. We'll want to
       # squash them all.
@@ -1508,55 +2562,88 @@ class DiskCache(LocalCache):
       fs.chmod(dest, file_mode & 0500)
     with self._lock:
       self._linked.append(self._lru[digest])
+      if digest in self._verified:
+        self._verified.pop(digest)
+
+  def _probe_reflink(self):
+    """Returns True if the file system of the cache supports reflink.
+
+    It is checked once instead of failing back to a full copy of every file.
+    """
+    if sys.platform != 'win32':
+      # Necessary otherwise the file can't be created.
+      file_path.set_read_only(self.cache_dir, False)
+    # Left behind files are removed on load, like the ones of allocate().
+    handle, path = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=self.cache_dir)
+    os.close(handle)
+    clone = path + u'-clone'
+    try:
+      file_path.reflink(path, clone)
+      return True
+    except OSError as e:
+      logging.debug('Failed to reflink in %s: %s', self.cache_dir, e)
+      return False
+    finally:
+      file_path.try_remove(clone)
+      file_path.try_remove(path)
 
   def _load(self):
-    """Loads state of the cache from json file."""
+    """Loads state of the cache from its state file."""
     self._lock.assert_locked()
 
     if not os.path.isdir(self.cache_dir):
       fs.makedirs(self.cache_dir)
-    else:
-      # Make sure the cache is read-only.
-      # TODO(maruel): Calculate the cost and optimize the performance
-      # accordingly.
-      file_path.make_tree_read_only(self.cache_dir)
 
     # Load state of the cache.
+    json_state_file = os.path.join(self.cache_dir, self.JSON_STATE_FILE)
+    trusted = False
     if fs.isfile(self.state_file):
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load_journal(self.state_file)
+        trusted = True
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken state file.
         file_path.try_remove(self.state_file)
+    elif fs.isfile(json_state_file):
+      try:
+        self._lru = lru.LRUDict.load(json_state_file)
+      except ValueError as err:
+        logging.error('Failed to load cache state: %s' % (err,))
+    # self._save() removes it once the state is saved below.
+    self._dirty = fs.isfile(self.dirty_file)
+    if trusted and self._dirty:
+      # The files added before the previous process died are not in the state.
+      logging.warning('Cache state was not saved, listing the cache')
+      trusted = False
+
+    # Once migrated, the top level directory only holds the shards so it is
+    # cheap to list.
+    shards, flat = self._migrate_flat_layout()
+    if trusted:
+      # Files that disappeared are detected by touch() when they are used. The
+      # files are made read-only as they are added so the tree isn't walked.
+      found = self._lru.keys_set()
+      found.update(flat)
+    else:
+      # Make sure the cache is read-only, the previous process may have died
+      # before it could mark the files it added.
+      file_path.make_tree_read_only(self.cache_dir)
+      found = self._scan_shards(shards)
 
     # Ensure that all files listed in the state still exist and add new ones.
     previous = self._lru.keys_set()
     unknown = []
-    for filename in fs.listdir(self.cache_dir):
-      if filename == self.STATE_FILE:
-        continue
-      if filename in previous:
-        self._initial_size += self._lru[filename]
-        previous.remove(filename)
+    for digest in found:
+      if digest in previous:
+        self._initial_size += self._lru[digest]
+        previous.remove(digest)
         self._initial_number_items += 1
         continue
-      # An untracked file.
-      if not isolated_format.is_valid_hash(filename, self.hash_algo):
-        logging.warning('Removing unknown file %s from cache', filename)
-        p = self._path(filename)
-        if fs.isdir(p):
-          try:
-            file_path.rmtree(p)
-          except OSError:
-            pass
-        else:
-          file_path.try_remove(p)
-        continue
-      # File that's not referenced in 'state.json'.
+      # File that's not referenced in the state.
       # TODO(vadimsh): Verify its SHA1 matches file name.
-      logging.warning('Adding unknown file %s to cache', filename)
-      unknown.append(filename)
+      logging.warning('Adding unknown file %s to cache', digest)
+      unknown.append(digest)
 
     if unknown:
       # Add as oldest files. They will be deleted eventually if not accessed.
@@ -1574,7 +2661,123 @@ class DiskCache(LocalCache):
       logging.warning('Removed %d lost files', len(previous))
       for filename in previous:
         self._lru.pop(filename)
+
+    # Load the verification progress of cleanup().
+    if fs.isfile(self.verified_file):
+      try:
+        self._verified = lru.LRUDict.load_journal(self.verified_file)
+      except ValueError as err:
+        logging.error('Failed to load verification state: %s' % (err,))
+        file_path.try_remove(self.verified_file)
+      for digest in self._verified.keys_set() - self._lru.keys_set():
+        self._verified.pop(digest)
+
+    # Only keep the parsed data of the cached .isolated files.
+    if fs.isdir(self.parsed_dir):
+      for digest in fs.listdir(self.parsed_dir):
+        if digest in self._lru:
+          self._parsed_saved.add(digest)
+        else:
+          self._remove_unknown(os.path.join(self.parsed_dir, digest))
+
+    # Load the statistics of the eviction policy.
+    if self._policy.name != EvictionPolicy.name and fs.isfile(self.policy_file):
+      try:
+        self._policy.load(
+            lru.LRUDict.load_journal(self.policy_file), self._lru)
+      except ValueError as err:
+        logging.error('Failed to load eviction statistics: %s' % (err,))
+        file_path.try_remove(self.policy_file)
     self._trim()
+    # self._trim() saved the state in the new format.
+    if fs.isfile(json_state_file):
+      file_path.try_remove(json_state_file)
+
+  def _migrate_flat_layout(self):
+    """Moves the items stored directly in the cache directory to their shard.
+
+    Also removes unexpected files from the cache directory.
+
+    Returns:
+      tuple(list of shard names, list of digests of the items moved).
+    """
+    self._lock.assert_locked()
+    shards = []
+    flat = []
+    # Directories made writable to move the files.
+    writable = set()
+    for filename in fs.listdir(self.cache_dir):
+      if filename in (
+          self.STATE_FILE, self.JSON_STATE_FILE, self.VERIFIED_FILE,
+          self.POLICY_FILE, self.DIRTY_FILE, self.PARSED_DIR):
+        continue
+      p = os.path.join(self.cache_dir, filename)
+      if fs.isdir(p):
+        if self._SHARD_RE.match(filename):
+          shards.append(filename)
+          continue
+      elif isolated_format.is_valid_hash(filename, self.hash_algo):
+        dest = self._path(filename)
+        shard = os.path.dirname(dest)
+        if sys.platform != 'win32':
+          # Necessary otherwise the file can't be moved.
+          for d in (self.cache_dir, shard):
+            if d not in writable and fs.isdir(d):
+              file_path.set_read_only(d, False)
+              writable.add(d)
+        if not fs.isdir(shard):
+          fs.mkdir(shard)
+          writable.add(shard)
+          shards.append(os.path.basename(shard))
+        fs.rename(p, dest)
+        flat.append(filename)
+        continue
+      self._remove_unknown(p)
+    if flat:
+      logging.warning('Moved %d files to the sharded layout', len(flat))
+    return shards, flat
+
+  def _scan_shards(self, shards):
+    """Lists the shards concurrently and returns the set of digests found.
+
+    Removes unexpected files from the shards.
+    """
+    def scan(shard):
+      found = []
+      shard_dir = os.path.join(self.cache_dir, shard)
+      if sys.platform != 'win32':
+        # Necessary otherwise the items can't be added or removed.
+        file_path.set_read_only(shard_dir, False)
+      for filename in fs.listdir(shard_dir):
+        digest = shard + filename
+        if isolated_format.is_valid_hash(digest, self.hash_algo):
+          found.append(digest)
+        else:
+          self._remove_unknown(os.path.join(shard_dir, filename))
+      return found
+
+    found = set()
+    if not shards:
+      return found
+    threads = min(len(shards), max(threading_utils.num_processors(), 2) * 2)
+    with threading_utils.ThreadPool(0, threads, 0, 'scan') as pool:
+      for shard in shards:
+        pool.add_task(0, scan, shard)
+      for digests in pool.iter_results():
+        found.update(digests)
+    return found
+
+  @staticmethod
+  def _remove_unknown(path):
+    """Removes a file or directory that doesn't belong in the cache."""
+    logging.warning('Removing unknown file %s from cache', path)
+    if fs.isdir(path):
+      try:
+        file_path.rmtree(path)
+      except OSError:
+        pass
+    else:
+      file_path.try_remove(path)
 
   def _save(self):
     """Saves the LRU ordering."""
@@ -1586,7 +2789,32 @@ class DiskCache(LocalCache):
         file_path.set_read_only(d, False)
     if fs.isfile(self.state_file):
       file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    self._lru.save_journal(self.state_file)
+    # Do not bother creating these files until they have content.
+    for state, state_file in (
+        (self._verified, self.verified_file),
+        (self._policy.stats, self.policy_file)):
+      if fs.isfile(state_file):
+        file_path.set_read_only(state_file, False)
+      elif not state:
+        continue
+      state.save_journal(state_file)
+    if self._dirty:
+      # All the items are now in the state.
+      file_path.try_remove(self.dirty_file)
+      self._dirty = False
+
+  def _mark_dirty(self):
+    """Creates self.dirty_file before an item is added to the directory."""
+    self._lock.assert_locked()
+    if self._dirty:
+      return
+    if sys.platform != 'win32':
+      # Necessary otherwise the file can't be created.
+      file_path.set_read_only(self.cache_dir, False)
+    with fs.open(self.dirty_file, 'wb'):
+      pass
+    self._dirty = True
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
@@ -1625,20 +2853,27 @@ class DiskCache(LocalCache):
           usage_percent)
     self._save()
 
+  def _evict_transient(self):
+    """Evicts the items larger than policies.max_admitted_size."""
+    self._lock.assert_locked()
+    for digest in self._transient:
+      if digest in self._lru:
+        logging.info('Not keeping large item %s', digest)
+        self._delete_file(digest, self._lru.pop(digest))
+    self._transient.clear()
+
   def _path(self, digest):
     """Returns the path to one item."""
-    return os.path.join(self.cache_dir, digest)
+    return os.path.join(self.cache_dir, digest[:2], digest[2:])
 
   def _remove_lru_file(self):
-    """Removes the last recently used file and returns its size."""
+    """Removes the file chosen by the eviction policy and returns its size.
+
+    With the default policy, it is the least recently used file.
+    """
     self._lock.assert_locked()
-    try:
-      digest, size = self._lru.get_oldest()
-    except KeyError:
-      raise Error('Nothing to remove')
-    if digest in self._protected:
-      raise Error('Not enough space to map the whole isolated tree')
-    digest, size = self._lru.pop_oldest()
+    digest = self._policy.next_victim(self._lru, self._protected)
+    size = self._lru.pop(digest)
     self._delete_file(digest, size)
     return size
 
@@ -1649,6 +2884,7 @@ class DiskCache(LocalCache):
       size = fs.stat(self._path(digest)).st_size
     self._added.append(size)
     self._lru.add(digest, size)
+    self._policy.accessed(digest, size)
     self._free_disk -= size
     # Do a quicker version of self._trim(). It only enforces free disk space,
     # not cache size limits. It doesn't actually look at real free disk space,
@@ -1665,6 +2901,13 @@ class DiskCache(LocalCache):
   def _delete_file(self, digest, size=UNKNOWN_FILE_SIZE):
     """Deletes cache file from the file system."""
     self._lock.assert_locked()
+    if digest in self._verified:
+      self._verified.pop(digest)
+    self._policy.removed(digest)
+    self._parsed.pop(digest, None)
+    if digest in self._parsed_saved:
+      self._parsed_saved.remove(digest)
+      file_path.try_remove(os.path.join(self.parsed_dir, digest))
     try:
       if size == UNKNOWN_FILE_SIZE:
         size = fs.stat(self._path(digest)).st_size
@@ -1734,7 +2977,12 @@ class IsolatedBundle(object):
       # Wait until some *.isolated file is fetched, parse it.
       item_hash = fetch_queue.wait(pending)
       item = pending.pop(item_hash)
-      item.load(fetch_queue.cache.read(item_hash))
+      data = fetch_queue.cache.read_parsed(item_hash)
+      if data is None:
+        item.load(fetch_queue.cache.read(item_hash))
+        fetch_queue.cache.write_parsed(item_hash, item.data)
+      else:
+        item.load_data(data)
 
       # Start fetching included *.isolated files.
       for new_child in item.children:
@@ -1841,13 +3089,15 @@ def get_storage(url, namespace):
   return Storage(get_storage_api(url, namespace))
 
 
-def upload_tree(base_url, infiles, namespace):
+def upload_tree(base_url, infiles, namespace, existence_cache=None):
   """Uploads the given tree to the given url.
 
   Arguments:
     base_url:  The url of the isolate server to upload to.
     infiles:   iterable of pairs (absolute path, metadata dict) of files.
     namespace: The namespace to use on the server.
+    existence_cache: optional ExistenceCache of the items known to be present
+                     on the server.
   """
   # Convert |infiles| into a list of FileItem objects, skip duplicates.
   # Filter out symlinks, since they are not represented by items on isolate
@@ -1870,6 +3120,10 @@ def upload_tree(base_url, infiles, namespace):
 
   logging.info('Skipped %d duplicated entries', skipped)
   with get_storage(base_url, namespace) as storage:
+    storage.existence_cache = existence_cache
+    # Nothing waits on a specific file, upload as many files per second as
+    # possible.
+    storage.net_scheduler = threading_utils.SizeScheduler
     return storage.upload_items(items)
 
 
@@ -1957,37 +3211,67 @@ def fetch_isolated(isolated_hash, storage, cache, outdir):
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
+def directory_to_metadata(root, algo, blacklist, fingerprint_cache=None):
   """Returns the FileItem list and .isolated metadata for a directory."""
+  metadata = {}
+  items = list(
+      iter_directory_items(root, algo, blacklist, metadata, fingerprint_cache))
+  return items, metadata
+
+
+def iter_directory_items(
+    root, algo, blacklist, metadata, fingerprint_cache=None):
+  """Yields a FileItem for each file in a directory as soon as it is hashed.
+
+  The files are hashed concurrently on a thread pool, hashlib releases the GIL
+  while hashing.
+
+  Arguments:
+    root: directory to process.
+    algo: hashing algorithm to use.
+    blacklist: function that returns True if a file should be omitted.
+    metadata: dict filled with the .isolated metadata of every entry, keyed by
+              relative path. It is complete once the generator is exhausted.
+    fingerprint_cache: optional isolated_format.FingerprintCache.
+  """
   root = file_path.get_native_path_case(root)
   paths = isolated_format.expand_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo)
-    for relpath in paths
-  }
-  for v in metadata.itervalues():
-    v.pop('t')
-  items = [
-      FileItem(
-          path=os.path.join(root, relpath),
-          digest=meta['h'],
-          size=meta['s'],
-          high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
-  return items, metadata
-
 
-def archive_files_to_storage(storage, files, blacklist):
+  def process(relpath):
+    meta = isolated_format.file_to_metadata(
+        os.path.join(root, relpath), {}, 0, algo, fingerprint_cache)
+    meta.pop('t')
+    return relpath, meta
+
+  threads = min(max(threading_utils.num_processors(), 2), len(paths) or 1)
+  with threading_utils.ThreadPool(0, threads, 0, 'hash') as pool:
+    for relpath in paths:
+      pool.add_task(0, process, relpath)
+    for relpath, meta in pool.iter_results():
+      metadata[relpath] = meta
+      if 'h' in meta:
+        yield FileItem(
+            path=os.path.join(root, relpath),
+            digest=meta['h'],
+            size=meta['s'],
+            high_priority=relpath.endswith('.isolated'))
+
+
+def archive_files_to_storage(
+    storage, files, blacklist, fingerprint_cache=None):
   """Stores every entries and returns the relevant data.
 
+  Files are fed to the storage as soon as they are hashed, so the existence
+  checks and uploads overlap with the hashing of the rest of the tree.
+
   Arguments:
     storage: a Storage object that communicates with the remote object store.
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    fingerprint_cache: optional isolated_format.FingerprintCache used to skip
+                       hashing unmodified files.
 
   Returns:
     tuple(list(tuple(hash, path)), list(FileItem cold), list(FileItem hot)).
@@ -1999,23 +3283,28 @@ def archive_files_to_storage(storage, files, blacklist):
 
   # List of tuple(hash, path).
   results = []
+  # List of FileItem, in the order they were handed to the storage.
+  items_to_upload = []
   # The temporary directory is only created as needed.
-  tempdir = None
-  try:
-    # TODO(maruel): Yield the files to a worker thread.
-    items_to_upload = []
+  tempdir = []
+
+  def iter_items():
     for f in files:
       try:
         filepath = os.path.abspath(f)
         if fs.isdir(filepath):
           # Uploading a whole directory.
-          items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+          metadata = {}
+          for item in iter_directory_items(
+              filepath, storage.hash_algo, blacklist, metadata,
+              fingerprint_cache):
+            yield item
 
           # Create the .isolated file.
           if not tempdir:
-            tempdir = tempfile.mkdtemp(prefix=u'isolateserver')
-          handle, isolated = tempfile.mkstemp(dir=tempdir, suffix=u'.isolated')
+            tempdir.append(tempfile.mkdtemp(prefix=u'isolateserver'))
+          handle, isolated = tempfile.mkstemp(
+              dir=tempdir[0], suffix=u'.isolated')
           os.close(handle)
           data = {
               'algo':
@@ -2025,38 +3314,45 @@ def archive_files_to_storage(storage, files, blacklist):
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
-          items_to_upload.extend(items)
-          items_to_upload.append(
-              FileItem(
-                  path=isolated,
-                  digest=h,
-                  size=fs.stat(isolated).st_size,
-                  high_priority=True))
+          yield FileItem(
+              path=isolated,
+              digest=h,
+              size=fs.stat(isolated).st_size,
+              high_priority=True)
           results.append((h, f))
 
         elif fs.isfile(filepath):
-          h = isolated_format.hash_file(filepath, storage.hash_algo)
-          items_to_upload.append(
-            FileItem(
-                path=filepath,
-                digest=h,
-                size=fs.stat(filepath).st_size,
-                high_priority=f.endswith('.isolated')))
+          h = isolated_format.hash_file(
+              filepath, storage.hash_algo, fingerprint_cache)
+          yield FileItem(
+              path=filepath,
+              digest=h,
+              size=fs.stat(filepath).st_size,
+              high_priority=f.endswith('.isolated'))
           results.append((h, f))
         else:
           raise Error('%s is neither a file or directory.' % f)
       except OSError:
         raise Error('Failed to process %s.' % f)
-    uploaded = storage.upload_items(items_to_upload)
+
+  def track(items):
+    for item in items:
+      items_to_upload.append(item)
+      yield item
+
+  try:
+    uploaded = storage.upload_items(track(iter_items()))
     cold = [i for i in items_to_upload if i in uploaded]
     hot = [i for i in items_to_upload if i not in uploaded]
     return results, cold, hot
   finally:
-    if tempdir and fs.isdir(tempdir):
-      file_path.rmtree(tempdir)
+    if tempdir and fs.isdir(tempdir[0]):
+      file_path.rmtree(tempdir[0])
 
 
-def archive(out, namespace, files, blacklist):
+def archive(
+    out, namespace, files, blacklist, existence_cache=None,
+    fingerprint_cache=None):
   if files == ['-']:
     files = sys.stdin.readlines()
 
@@ -2066,8 +3362,10 @@ def archive(out, namespace, files, blacklist):
   files = [f.decode('utf-8') for f in files]
   blacklist = tools.gen_blacklist(blacklist)
   with get_storage(out, namespace) as storage:
+    storage.existence_cache = existence_cache
     # Ignore stats.
-    results = archive_files_to_storage(storage, files, blacklist)[0]
+    results = archive_files_to_storage(
+        storage, files, blacklist, fingerprint_cache)[0]
   print('\n'.join('%s %s' % (r[0], r[1]) for r in results))
 
 
@@ -2085,12 +3383,29 @@ def CMDarchive(parser, args):
   """
   add_isolate_server_options(parser)
   add_archive_options(parser)
+  add_fingerprint_cache_options(parser)
+  parser.add_option(
+      '--existence-cache', metavar='FILE', default='',
+      help='Remember the items seen on the server in this file, to not check '
+           'them again for %d hours' % (EXISTENCE_CACHE_TTL / 3600))
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True)
+  fingerprint_cache = process_fingerprint_cache_options(options)
+  existence_cache = None
+  if options.existence_cache:
+    existence_cache = ExistenceCache(
+        unicode(os.path.abspath(options.existence_cache)))
   try:
-    archive(options.isolate_server, options.namespace, files, options.blacklist)
+    archive(
+        options.isolate_server, options.namespace, files, options.blacklist,
+        existence_cache, fingerprint_cache)
   except Error as e:
     parser.error(e.args[0])
+  finally:
+    if fingerprint_cache is not None:
+      fingerprint_cache.save()
+    if existence_cache is not None:
+      existence_cache.save()
   return 0
 
 
@@ -2111,6 +3426,7 @@ def CMDdownload(parser, args):
   parser.add_option(
       '-t', '--target', metavar='DIR', default='download',
       help='destination directory')
+  add_download_options(parser)
   add_cache_options(parser)
   options, args = parser.parse_args(args)
   if args:
@@ -2128,6 +3444,7 @@ def CMDdownload(parser, args):
       parser.error(
           '--target \'%s\' exists, please use another target' % options.target)
   with get_storage(options.isolate_server, options.namespace) as storage:
+    process_download_options(parser, options, storage)
     # Fetching individual files.
     if options.file:
       # TODO(maruel): Enable cache in this case too.
@@ -2171,6 +3488,45 @@ def add_archive_options(parser):
            'directories')
 
 
+def add_fingerprint_cache_options(parser):
+  """Adds --fingerprint-cache option to parser."""
+  parser.add_option(
+      '--fingerprint-cache', metavar='FILE', default='',
+      help='Remember the hash of archived files in this file, keyed by their '
+           'inode, size and timestamps, to skip hashing unmodified files on '
+           'the next run')
+
+
+def process_fingerprint_cache_options(options):
+  """Returns an isolated_format.FingerprintCache or None if not requested.
+
+  The caller must call save() on it once done.
+  """
+  if not options.fingerprint_cache:
+    return None
+  return isolated_format.FingerprintCache(
+      unicode(os.path.abspath(options.fingerprint_cache)))
+
+
+def add_download_options(parser):
+  """Adds --download-ranges option to parser."""
+  parser.add_option(
+      '--download-ranges',
+      type='int',
+      metavar='N',
+      default=1,
+      help='Download items of uncompressed namespaces larger than %dmb as N '
+           'concurrent byte ranges, default=%%default' % (
+               MIN_SIZE_FOR_RANGED_FETCH / 1024 / 1024))
+
+
+def process_download_options(parser, options, storage):
+  """Applies the download options to a Storage instance."""
+  if options.download_ranges < 1:
+    parser.error('--download-ranges must be at least 1.')
+  storage.download_ranges = options.download_ranges
+
+
 def add_isolate_server_options(parser):
   """Adds --isolate-server and --namespace options to parser."""
   parser.add_option(
@@ -2182,6 +3538,10 @@ def add_isolate_server_options(parser):
   parser.add_option(
       '--namespace', default='default-gzip',
       help='The namespace to use on the Isolate Server, default: %default')
+  parser.add_option(
+      '--tcp-keep-alive', action='store_true',
+      help='Enables TCP keep-alive on the connections to the Isolate Server, '
+           'so idle ones are not dropped by the network')
 
 
 def process_isolate_server_options(parser, options, set_exception_handler):
@@ -2197,6 +3557,8 @@ def process_isolate_server_options(parser, options, set_exception_handler):
     parser.error('--isolate-server %s' % e)
   if set_exception_handler:
     on_error.report_on_exception_exit(options.isolate_server)
+  if options.tcp_keep_alive:
+    net.configure_connection_pools(tcp_keep_alive=True)
   try:
     return auth.ensure_logged_in(options.isolate_server)
   except ValueError as e:
@@ -2229,19 +3591,41 @@ def add_cache_options(parser):
       default=100000,
       help='Trim if more than this number of items are in the cache '
            'default=%default')
+  cache_group.add_option(
+      '--cache-policy',
+      choices=sorted(EVICTION_POLICIES),
+      default=EvictionPolicy.name,
+      help='Order in which items are trimmed: lru evicts the least recently '
+           'used item, lru-2 the item whose second to last use is the '
+           'oldest, lfu the item with the fewest uses per byte and gdsf '
+           'weights the uses per byte with the item age. default=%default')
+  cache_group.add_option(
+      '--max-admitted-size',
+      type='int',
+      metavar='NNN',
+      default=0,
+      help='Do not keep items larger than this value in the cache once they '
+           'were mapped, 0 to keep all the items. default=%default')
+  cache_group.add_option(
+      '--reflink', action='store_true',
+      help='Map the files as copy-on-write clones of the cached items on file '
+           'systems supporting it (btrfs, XFS) instead of hardlinks, or as '
+           'copies otherwise. The mapped files are writeable.')
   parser.add_option_group(cache_group)
 
 
 def process_cache_options(options):
   if options.cache:
     policies = CachePolicies(
-        options.max_cache_size, options.min_free_space, options.max_items)
+        options.max_cache_size, options.min_free_space, options.max_items,
+        options.cache_policy, options.max_admitted_size)
 
     # |options.cache| path may not exist until DiskCache() instance is created.
     return DiskCache(
         unicode(os.path.abspath(options.cache)),
         policies,
-        isolated_format.get_hash_algo(options.namespace))
+        isolated_format.get_hash_algo(options.namespace),
+        options.reflink)
   else:
     return MemoryCache()
 
@@ -222,9 +222,13 @@ def run_command(command, cwd, tmp_dir, hard_timeout, grace_period):
   return exit_code, had_hard_timeout
 
 
-def delete_and_upload(storage, out_dir, leak_temp_dir):
+def delete_and_upload(
+    storage, out_dir, leak_temp_dir, fingerprint_cache=None):
   """Deletes the temporary run directory and uploads results back.
 
+  |fingerprint_cache| is an optional isolated_format.FingerprintCache used to
+  skip hashing output files that were already hashed.
+
   Returns:
     tuple(outputs_ref, success, cold, hot)
     - outputs_ref: a dict referring to the results archived back to the isolated
@@ -245,7 +249,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
     with tools.Profiler('ArchiveOutput'):
       try:
         results, f_cold, f_hot = isolateserver.archive_files_to_storage(
-            storage, [out_dir], None)
+            storage, [out_dir], None, fingerprint_cache)
         outputs_ref = {
           'isolated': results[0][0],
           'isolatedserver': storage.location,
@@ -278,7 +282,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
 
 def map_and_run(
     isolated_hash, storage, cache, leak_temp_dir, root_dir, hard_timeout,
-    grace_period, extra_args):
+    grace_period, extra_args, fingerprint_cache=None):
   """Maps and run the command. Returns metadata about the result."""
   result = {
     'duration': None,
@@ -292,11 +296,29 @@ def map_and_run(
     #    'initial_size': 0,
     #    'items_cold': '<large.pack()>',
     #    'items_hot': '<large.pack()>',
+    #    'cache': {
+    #      'policy': 'lru',
+    #      'hits': 0,
+    #      'hits_size': 0,
+    #      'misses': 0,
+    #      'misses_size': 0,
+    #    },
+    #    'network': {
+    #      'concurrency': {
+    #        'limit': 0,
+    #        'peak': 0,
+    #        'successes': 0,
+    #        'failures': 0,
+    #        'decreases': 0,
+    #      },
+    #      'contains_batch_size': {<same as concurrency>},
+    #    },
     #  },
     #  'upload': {
     #    'duration': 0.,
     #    'items_cold': '<large.pack()>',
     #    'items_hot': '<large.pack()>',
+    #    'network': {<same as download, cumulative>},
     #  },
     },
     'outputs_ref': None,
@@ -336,9 +358,19 @@ def map_and_run(
       'items_cold': base64.b64encode(large.pack(sorted(cache.added))),
       'items_hot': base64.b64encode(
           large.pack(sorted(set(cache.linked) - set(cache.added)))),
+      'cache': {
+        'policy': cache.eviction_policy,
+        'hits': len(cache.hits),
+        'hits_size': sum(cache.hits),
+        'misses': len(cache.added),
+        'misses_size': sum(cache.added),
+      },
+      'network': storage.get_network_stats(),
     }
 
-    change_tree_read_only(run_dir, bundle.read_only)
+    if not (cache.copy_on_write and bundle.read_only in (0, None)):
+      # Copy-on-write files were already mapped writeable.
+      change_tree_read_only(run_dir, bundle.read_only)
     cwd = os.path.normpath(os.path.join(run_dir, bundle.relative_cwd))
     command = bundle.command + extra_args
     file_path.ensure_command_has_abs_path(command, cwd)
@@ -399,11 +431,12 @@ def map_and_run(
       # This deletes out_dir if leak_temp_dir is not set.
       start = time.time()
       result['outputs_ref'], success, cold, hot = delete_and_upload(
-          storage, out_dir, leak_temp_dir)
+          storage, out_dir, leak_temp_dir, fingerprint_cache)
       result['stats']['upload'] = {
         'duration': time.time() - start,
         'items_cold': base64.b64encode(large.pack(cold)),
         'items_hot': base64.b64encode(large.pack(hot)),
+        'network': storage.get_network_stats(),
       }
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
@@ -416,7 +449,7 @@ def map_and_run(
 
 def run_tha_test(
     isolated_hash, storage, cache, leak_temp_dir, result_json, root_dir,
-    hard_timeout, grace_period, extra_args):
+    hard_timeout, grace_period, extra_args, fingerprint_cache=None):
   """Downloads the dependencies in the cache, hardlinks them into a temporary
   directory and runs the executable from there.
 
@@ -444,6 +477,8 @@ def run_tha_test(
     grace_period: number of seconds to wait between SIGTERM and SIGKILL.
     extra_args: optional arguments to add to the command stated in the .isolate
                 file.
+    fingerprint_cache: optional isolated_format.FingerprintCache used when
+                       hashing the output files.
 
   Returns:
     Process exit code that should be used.
@@ -462,7 +497,7 @@ def run_tha_test(
   # run_isolated exit code. Depends on if result_json is used or not.
   result = map_and_run(
       isolated_hash, storage, cache, leak_temp_dir, root_dir, hard_timeout,
-      grace_period, extra_args)
+      grace_period, extra_args, fingerprint_cache)
   logging.info('Result:\n%s', tools.format_json(result, dense=True))
   if result_json:
     # We've found tests to delete 'work' when quitting, causing an exception
@@ -513,6 +548,8 @@ def main(args):
       '-s', '--isolated',
       help='Hash of the .isolated to grab from the isolate server')
   isolateserver.add_isolate_server_options(data_group)
+  isolateserver.add_download_options(data_group)
+  isolateserver.add_fingerprint_cache_options(data_group)
   parser.add_option_group(data_group)
 
   isolateserver.add_cache_options(parser)
@@ -553,11 +590,18 @@ def main(args):
     parser.error('--isolated is required.')
   with isolateserver.get_storage(
       options.isolate_server, options.namespace) as storage:
+    isolateserver.process_download_options(parser, options, storage)
     # Hashing schemes used by |storage| and |cache| MUST match.
     assert storage.hash_algo == cache.hash_algo
-    return run_tha_test(
-        options.isolated, storage, cache, options.leak_temp_dir, options.json,
-        options.root_dir, options.hard_timeout, options.grace_period, args)
+    fingerprint_cache = isolateserver.process_fingerprint_cache_options(options)
+    try:
+      return run_tha_test(
+          options.isolated, storage, cache, options.leak_temp_dir,
+          options.json, options.root_dir, options.hard_timeout,
+          options.grace_period, args, fingerprint_cache)
+    finally:
+      if fingerprint_cache is not None:
+        fingerprint_cache.save()
 
 
 if __name__ == '__main__':
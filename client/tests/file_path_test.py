@@ -163,6 +163,20 @@ class FilePathTest(auto_stub.TestCase):
     # must be reset to be read-only after deleting one of the hard link
     # directory entry.
 
+  def test_link_file_reflink(self):
+    # Whether the clone is supported or a copy is used depends on the file
+    # system, the result must be a distinct file node either way.
+    file_bar = os.path.join(self.tempdir, 'bar')
+    file_link = os.path.join(self.tempdir, 'link')
+    write_content(file_bar, 'bar')
+    file_path.set_read_only(file_bar, True)
+    file_path.link_file(file_link, file_bar, file_path.REFLINK_WITH_FALLBACK)
+    self.assertNotEqual(fs.stat(file_bar).st_ino, fs.stat(file_link).st_ino)
+    file_path.set_read_only(file_link, False)
+    write_content(file_link, 'link')
+    with fs.open(file_bar, 'rb') as f:
+      self.assertEqual('bar', f.read())
+
   def test_rmtree_unicode(self):
     subdir = os.path.join(self.tempdir, 'hi')
     fs.mkdir(subdir)
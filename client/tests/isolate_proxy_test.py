@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# Copyright 2016 The LUCI Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+import zlib
+
+# net_utils adjusts sys.path.
+import net_utils
+
+import isolate_proxy
+import isolated_format
+import isolateserver
+from depot_tools import fix_encoding
+from utils import file_path
+from utils import net
+
+import isolateserver_mock
+
+
+ALGO = isolated_format.get_hash_algo('default-gzip')
+
+
+class FakeStorageApi(isolateserver.StorageApi):
+  """Returns the content of |contents|, optionally blocking on |event|."""
+
+  def __init__(self, contents, event=None):
+    super(FakeStorageApi, self).__init__()
+    self.contents = contents
+    self.event = event
+    self.fetched = []
+
+  def fetch(self, digest, offset=0, length=None):
+    self.fetched.append(digest)
+    if self.event:
+      self.event.wait()
+    if digest not in self.contents:
+      raise IOError('missing %s' % digest)
+    yield self.contents[digest]
+
+  def fetch_batch(self, digests):
+    self.fetched.extend(digests)
+    if self.event:
+      self.event.wait()
+    return dict((d, self.contents[d]) for d in digests if d in self.contents)
+
+
+class ProxyTest(unittest.TestCase):
+  def setUp(self):
+    super(ProxyTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolate_proxy')
+    self.upstream = isolateserver_mock.MockIsolateServer()
+    self.policies = isolateserver.CachePolicies(0, 0, 0)
+    self.store = None
+    self.server = None
+    self.thread = None
+
+  def tearDown(self):
+    try:
+      if self.server:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+      if self.store:
+        self.store.close()
+      self.upstream.close_start()
+      file_path.rmtree(self.tempdir)
+      self.upstream.close_end()
+    finally:
+      super(ProxyTest, self).tearDown()
+
+  def start_proxy(self, get_storage_api=None):
+    if not get_storage_api:
+      get_storage_api = lambda namespace: isolateserver.get_storage_api(
+          self.upstream.url, namespace)
+    self.store = isolate_proxy.ProxyStore(
+        os.path.join(self.tempdir, u'proxy'), self.policies, get_storage_api)
+    self.server = isolate_proxy.ProxyServer(
+        ('127.0.0.1', 0), self.upstream.url, self.store)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def fetch(self, namespace, digests):
+    """Fetches |digests| through the proxy into a new MemoryCache."""
+    cache = isolateserver.MemoryCache()
+    with isolateserver.get_storage(self.server.url, namespace) as storage:
+      queue = isolateserver.FetchQueue(storage, cache)
+      for digest in digests:
+        queue.add(digest)
+      pending = set(digests)
+      while pending:
+        pending.remove(queue.wait(pending))
+    return dict((d, cache.read(d)) for d in digests)
+
+  def test_fetch_cached(self):
+    self.start_proxy()
+    contents = ['a' * 1000, 'b' * 2000]
+    digests = [
+      self.upstream.add_content_compressed('default-gzip', c)
+      for c in contents
+    ]
+    expected = dict(zip(digests, contents))
+    self.assertEqual(expected, self.fetch('default-gzip', digests))
+    self.assertEqual(2, self.store.stats['misses'])
+    # Served from the proxy cache once the upstream content is gone.
+    self.upstream.contents.clear()
+    self.assertEqual(expected, self.fetch('default-gzip', digests))
+    self.assertEqual(2, self.store.stats['hits'])
+
+  def test_fetch_batch(self):
+    self.start_proxy()
+    digest = self.upstream.add_content('default', 'small')
+    data = self.store.read_batch('default', [digest, '0' * 40])
+    self.assertEqual({digest: 'small'}, data)
+    self.upstream.contents.clear()
+    self.assertEqual({digest: 'small'}, self.fetch('default', [digest]))
+
+  def test_fetch_corrupted(self):
+    self.start_proxy()
+    digest = ALGO('content').hexdigest()
+    self.upstream.contents['default-gzip'] = {
+      digest: zlib.compress('other').encode('base64'),
+    }
+    with self.assertRaises(IOError):
+      self.store.open('default-gzip', digest)
+    # Nothing was cached.
+    cache = self.store._get('default-gzip')[0]
+    self.assertEqual(set(), cache.cached_set())
+
+  def test_coalesced(self):
+    content = zlib.compress('content')
+    digest = ALGO('content').hexdigest()
+    event = threading.Event()
+    api = FakeStorageApi({digest: content}, event)
+    self.start_proxy(lambda _namespace: api)
+    results = []
+    def read():
+      with self.store.open('default-gzip', digest) as f:
+        results.append(f.read())
+    threads = [threading.Thread(target=read) for _ in xrange(5)]
+    for t in threads:
+      t.start()
+    # Wait for the followers to be waiting on the leader.
+    while self.store.stats['coalesced'] < 4:
+      time.sleep(0.01)
+    event.set()
+    for t in threads:
+      t.join()
+    self.assertEqual([content] * 5, results)
+    self.assertEqual([digest], api.fetched)
+    self.assertEqual(1, self.store.stats['misses'])
+
+  def test_coalesced_batch(self):
+    content = zlib.compress('content')
+    digest = ALGO('content').hexdigest()
+    event = threading.Event()
+    api = FakeStorageApi({digest: content}, event)
+    self.start_proxy(lambda _namespace: api)
+    results = []
+    def read():
+      with self.store.open('default-gzip', digest) as f:
+        results.append(f.read())
+    def read_batch():
+      results.append(self.store.read_batch('default-gzip', [digest])[digest])
+    threads = [threading.Thread(target=read)] + [
+      threading.Thread(target=read_batch) for _ in xrange(2)
+    ]
+    for t in threads:
+      t.start()
+    # The batches wait on the fetch started by open().
+    while self.store.stats['coalesced'] < 2:
+      time.sleep(0.01)
+    event.set()
+    for t in threads:
+      t.join()
+    self.assertEqual([content] * 3, results)
+    self.assertEqual([digest], api.fetched)
+    self.assertEqual(1, self.store.stats['misses'])
+
+  def test_ranged(self):
+    self.start_proxy()
+    content = os.urandom(600 * 1024)
+    digest = self.upstream.add_content('default', content)
+    response = net.url_read_json(
+        self.server.url + isolate_proxy.API_PREFIX + 'retrieve',
+        data={'digest': digest, 'namespace': {'namespace': 'default'}})
+    self.assertEqual(
+        '%s/content/default/%s' % (self.server.url, digest), response['url'])
+    api = isolateserver.get_storage_api(self.server.url, 'default')
+    self.assertEqual(content, ''.join(api.fetch(digest)))
+    self.assertEqual(
+        content[1000:3000], ''.join(api.fetch(digest, 1000, 2000)))
+    self.assertEqual(content[1000:], ''.join(api.fetch(digest, 1000)))
+
+  def test_invalid_range(self):
+    content = os.urandom(1000)
+    digest = ALGO(content).hexdigest()
+    self.start_proxy(lambda _namespace: FakeStorageApi({digest: content}))
+    url = '%s/content/default/%s' % (self.server.url, digest)
+    for value in ('bytes=500-100', 'bytes=1000-', 'bytes=a-'):
+      request = urllib2.Request(url, headers={'Range': value})
+      with self.assertRaises(urllib2.HTTPError) as e:
+        urllib2.urlopen(request)
+      self.assertEqual(416, e.exception.code)
+      self.assertEqual('bytes */1000', e.exception.headers['Content-Range'])
+    request = urllib2.Request(url, headers={'Range': 'bytes=100-100'})
+    self.assertEqual(content[100], urllib2.urlopen(request).read())
+
+  def test_upload(self):
+    self.start_proxy()
+    items = [isolateserver.BufferItem('item %d' % i) for i in xrange(5)]
+    storage = isolateserver.get_storage(self.server.url, 'default-gzip')
+    with storage:
+      self.assertEqual(set(items), set(storage.upload_items(items)))
+    self.assertEqual(
+        set(i.digest for i in items),
+        set(self.upstream.contents['default-gzip']))
+    # Nothing was cached.
+    self.assertEqual(0, self.store.stats['misses'])
+
+  def test_invalid(self):
+    self.start_proxy()
+    with self.assertRaises(ValueError):
+      self.store.open('../default', '0' * 40)
+    with self.assertRaises(ValueError):
+      self.store.open('default', 'not a digest')
+
+
+class VerifiedTest(unittest.TestCase):
+  def test_verified(self):
+    digest = ALGO('content').hexdigest()
+    self.assertEqual(
+        ['content'],
+        list(isolate_proxy._verified('default', digest, ['content'])))
+    with self.assertRaises(IOError):
+      list(isolate_proxy._verified('default', digest, ['other']))
+
+  def test_verified_compressed(self):
+    digest = ALGO('content').hexdigest()
+    compressed = zlib.compress('content')
+    for namespace in ('default-gzip', 'default-deflate'):
+      self.assertEqual(
+          [compressed],
+          list(isolate_proxy._verified(namespace, digest, [compressed])))
+
+
+class IsLoopbackTest(unittest.TestCase):
+  def test_is_loopback(self):
+    self.assertTrue(isolate_proxy.is_loopback('127.0.0.1'))
+    self.assertTrue(isolate_proxy.is_loopback('::1'))
+    self.assertTrue(isolate_proxy.is_loopback('localhost'))
+    self.assertFalse(isolate_proxy.is_loopback('0.0.0.0'))
+    self.assertFalse(isolate_proxy.is_loopback('192.168.0.1'))
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  logging.basicConfig(
+      level=(logging.DEBUG if '-v' in sys.argv else logging.CRITICAL))
+  unittest.main()
@@ -249,6 +249,79 @@ class TestIsolated(auto_stub.TestCase):
     self.assertEqual([('foo', data, True)], calls)
 
 
+class FingerprintCacheTest(auto_stub.TestCase):
+  def setUp(self):
+    super(FingerprintCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format_')
+    self.state_file = os.path.join(self.tempdir, u'fingerprints.json')
+    self.cache = isolated_format.FingerprintCache(self.state_file)
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(FingerprintCacheTest, self).tearDown()
+
+  def hash_file(self, path):
+    return isolated_format.hash_file(path, ALGO, self.cache)
+
+  def write_file(self, name, content, age=60):
+    path = os.path.join(self.tempdir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    mtime = os.stat(path).st_mtime - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+  def test_hit(self):
+    path = self.write_file(u'a', 'foo')
+    expected = ALGO('foo').hexdigest()
+    self.assertEqual(expected, self.hash_file(path))
+    self.assertEqual(1, len(self.cache))
+    # Prove the file is not hashed again.
+    self.cache.add(os.stat(path), ALGO, 'cached')
+    self.assertEqual('cached', self.hash_file(path))
+
+  def test_modified(self):
+    path = self.write_file(u'a', 'foo')
+    self.assertEqual(
+        ALGO('foo').hexdigest(), self.hash_file(path))
+    self.write_file(u'a', 'bar', age=120)
+    self.assertEqual(
+        ALGO('bar').hexdigest(), self.hash_file(path))
+    self.assertEqual(2, len(self.cache))
+
+  def test_recent_not_cached(self):
+    path = self.write_file(u'a', 'foo', age=0)
+    self.assertEqual(
+        ALGO('foo').hexdigest(), self.hash_file(path))
+    self.assertEqual(0, len(self.cache))
+
+  def test_save_load(self):
+    path = self.write_file(u'a', 'foo')
+    self.hash_file(path)
+    self.assertTrue(self.cache.save())
+    cache = isolated_format.FingerprintCache(self.state_file)
+    self.assertEqual(ALGO('foo').hexdigest(), cache.get(os.stat(path), ALGO))
+    self.assertEqual(None, cache.get(os.stat(path), hashlib.md5))
+
+  def test_load_corrupted(self):
+    with open(self.state_file, 'wb') as f:
+      f.write('not json')
+    cache = isolated_format.FingerprintCache(self.state_file)
+    self.assertEqual(0, len(cache))
+
+  def test_evict(self):
+    self.cache.max_items = 2
+    paths = [self.write_file(unicode(i), str(i)) for i in xrange(3)]
+    for path in paths:
+      self.hash_file(path)
+    self.assertEqual(2, len(self.cache))
+    self.assertEqual(None, self.cache.get(os.stat(paths[0]), ALGO))
+    self.assertEqual(
+        ALGO('2').hexdigest(), self.cache.get(os.stat(paths[2]), ALGO))
+
+
 if __name__ == '__main__':
   fix_encoding.fix_encoding()
   if '-v' in sys.argv:
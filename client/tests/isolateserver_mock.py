@@ -8,6 +8,7 @@ import hashlib
 import json
 import logging
 import re
+import struct
 import sys
 import threading
 import urllib2
@@ -53,14 +54,28 @@ class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def _read_body(self):
     """Reads the request body."""
-    return self.rfile.read(int(self.headers['Content-Length']))
+    return ''.join(self._iter_body())
 
   def _drop_body(self):
     """Reads the request body."""
+    for _ in self._iter_body():
+      pass
+
+  def _iter_body(self):
+    """Yields the request body in chunks, supports chunked transfer encoding."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      while True:
+        size = int(self.rfile.readline().split(';', 1)[0], 16)
+        if size:
+          yield self.rfile.read(size)
+        # Skip the CRLF following the chunk.
+        self.rfile.readline()
+        if not size:
+          return
     size = int(self.headers['Content-Length'])
     while size:
       chunk = min(4096, size)
-      self.rfile.read(chunk)
+      yield self.rfile.read(chunk)
       size -= chunk
 
   def log_message(self, fmt, *args):
@@ -94,7 +109,10 @@ class IsolateServerHandler(MockHandler):
     return FakeSigner.generate(message, embedded)
 
   def _storage_helper(self, body, gs=False):
-    request = json.loads(body)
+    self._store_entry(json.loads(body), gs)
+    self._json({'ok': True})
+
+  def _store_entry(self, request, gs):
     message = ['datastore', 'gs'][gs]
     content = request['content'] if not gs else None
     embedded = FakeSigner.validate(request['upload_ticket'], message)
@@ -102,7 +120,6 @@ class IsolateServerHandler(MockHandler):
     if namespace not in self.server.contents:
       self.server.contents[namespace] = {}
     self.server.contents[namespace][embedded['d']] = content
-    self._json({'ok': True})
 
   ### Mocked HTTP Methods
 
@@ -151,10 +168,27 @@ class IsolateServerHandler(MockHandler):
         }, index, response['items'])
       logging.info('Returning %s' % response)
       self._json(response)
+    elif self.path.startswith(
+        '/_ah/api/isolateservice/v1/store_inline_batch'):
+      for item in json.loads(body)['items']:
+        self._store_entry(item, False)
+      self._json({'ok': True})
     elif self.path.startswith('/_ah/api/isolateservice/v1/store_inline'):
       self._storage_helper(body)
     elif self.path.startswith('/_ah/api/isolateservice/v1/finalize_gs_upload'):
       self._storage_helper(body, True)
+    elif self.path.startswith('/_ah/api/isolateservice/v1/retrieve_batch'):
+      request = json.loads(body)
+      contents = self.server.contents.get(request['namespace']['namespace'], {})
+      out = []
+      for digest in request['digests']:
+        data = contents.get(digest)
+        if data is None:
+          out.append(struct.pack('>I', 0xffffffff))
+        else:
+          data = base64.b64decode(data)
+          out.append(struct.pack('>I', len(data)) + data)
+      self._json({'content': base64.b64encode(''.join(out))})
     elif self.path.startswith('/_ah/api/isolateservice/v1/retrieve'):
       request = json.loads(body)
       namespace = request['namespace']['namespace']
@@ -7,6 +7,7 @@
 
 import base64
 import collections
+import functools
 import hashlib
 import json
 import logging
@@ -14,6 +15,7 @@ import os
 import StringIO
 import sys
 import tempfile
+import time
 import unittest
 import urllib
 import zlib
@@ -29,6 +31,8 @@ from depot_tools import auto_stub
 from depot_tools import fix_encoding
 from utils import file_path
 from utils import logging_utils
+from utils import lru
+from utils import net
 from utils import threading_utils
 
 import isolateserver_mock
@@ -131,6 +135,10 @@ class MockedStorageApi(isolateserver.StorageApi):
     self.contains_calls = []
     self._namespace = namespace
 
+  @property
+  def location(self):
+    return 'https://fake'
+
   @property
   def namespace(self):
     return self._namespace
@@ -198,6 +206,74 @@ class StorageTest(TestCase):
     result = dict(storage.get_missing_items(items))
     self.assertEqual(missing, result)
 
+  def test_batch_items_for_check_generator(self):
+    items = [isolateserver.Item(str(i), i) for i in xrange(25)]
+    batches = list(isolateserver.batch_items_for_check(iter(items)))
+    # Each batch is yielded as soon as it is full, sorted by size.
+    self.assertEqual([items[19::-1], items[:19:-1]], batches)
+
+  def test_batch_items_for_check_limit(self):
+    items = [isolateserver.Item(str(i), 1) for i in xrange(400)]
+    batches = list(isolateserver.batch_items_for_check(items, lambda: 25))
+    self.assertEqual(
+        list(isolateserver.ITEMS_PER_CONTAINS_QUERIES) + [25, 25, 25, 25, 10],
+        [len(b) for b in batches])
+
+  def test_get_missing_items_adapts_batch_size(self):
+    items = [isolateserver.Item(str(i), i) for i in xrange(400)]
+    class FailingStorageApi(MockedStorageApi):
+      def contains(self, items):
+        if len(self.contains_calls) == 1:
+          self.contains_calls.append(items)
+          raise IOError('Nope')
+        return super(FailingStorageApi, self).contains(items)
+
+    storage = isolateserver.Storage(FailingStorageApi({}))
+    self.assertEqual([], list(storage.get_missing_items(items)))
+    stats = storage.get_network_stats()
+    self.assertEqual(1, stats['contains_batch_size']['decreases'])
+    self.assertEqual(1, stats['concurrency']['failures'])
+
+  def test_get_missing_items_existence_cache(self):
+    items = [isolateserver.Item(str(i), i) for i in xrange(10)]
+    storage_api = MockedStorageApi({items[0].digest: 'push', '8': 'push'})
+    storage = isolateserver.Storage(storage_api)
+    storage.existence_cache = isolateserver.ExistenceCache(
+        os.path.join(self.tempdir, 'existence.json'))
+    self.assertEqual(
+        {items[0]: 'push', items[8]: 'push'},
+        dict(storage.get_missing_items(items)))
+    self.assertEqual(1, len(storage_api.contains_calls))
+    # Only the items that were missing are checked again.
+    storage_api.missing_hashes = {}
+    self.assertEqual({}, dict(storage.get_missing_items(items)))
+    self.assertEqual(2, len(storage_api.contains_calls))
+    self.assertEqual(
+        set([items[0], items[8]]), set(storage_api.contains_calls[1]))
+    self.assertEqual([], list(storage.get_missing_items(items)))
+    self.assertEqual(2, len(storage_api.contains_calls))
+
+  def test_get_missing_items_generator(self):
+    items = [isolateserver.Item(str(i), i) for i in xrange(45)]
+    storage_api = MockedStorageApi(
+        {item.digest: i for i, item in enumerate(items)})
+    storage = isolateserver.Storage(storage_api)
+    consumed = []
+    def gen():
+      for item in items:
+        if len(consumed) == 30:
+          # The first query was sent while items are still being generated.
+          for _ in xrange(100):
+            if storage_api.contains_calls:
+              break
+            time.sleep(0.01)
+          self.assertEqual([items[19::-1]], storage_api.contains_calls)
+        consumed.append(item)
+        yield item
+    result = dict(storage.get_missing_items(gen()))
+    self.assertEqual({item: i for i, item in enumerate(items)}, result)
+    self.assertEqual(3, len(storage_api.contains_calls))
+
   def test_async_push(self):
     for use_zip in (False, True):
       item = FakeItem('1234567')
@@ -246,10 +322,8 @@ class StorageTest(TestCase):
     def push_side_effect():
       raise IOError('Nope')
 
-    # TODO(vadimsh): Retrying push when fetching data from a generator is
-    # broken now (it reuses same generator instance when retrying).
     content_sources = (
-        # generator(),
+        _generator,
         lambda: [chunk],
     )
 
@@ -275,6 +349,151 @@ class StorageTest(TestCase):
         self.assertEqual(
             [expected_push] * attempts, storage_api.push_calls)
 
+  def test_async_push_batch(self):
+    for use_zip in (False, True):
+      items = [FakeItem(c) for c in ('a', 'b', 'c')]
+      batch_calls = []
+      class BatchStorageApi(MockedStorageApi):
+        def push_batch(self, batch):
+          batch_calls.append(batch)
+          # 'b' is left to push().
+          return [i for i, _, _ in batch if i is not items[1]]
+
+      storage_api = BatchStorageApi(
+          {i.digest: 'push_state %s' % i.data for i in items},
+          namespace='default-gzip' if use_zip else 'default')
+      storage = isolateserver.Storage(storage_api)
+      channel = threading_utils.TaskChannel()
+      storage.async_push_batch(
+          channel, [(i, self.get_push_state(storage, i)) for i in items])
+      self.assertEqual(
+          set(items), set(channel.pull() for _ in xrange(len(items))))
+      self.assertEqual(
+          [[(i, 'push_state %s' % i.data, i.zipped if use_zip else None)
+            for i in items]],
+          batch_calls)
+      self.assertEqual(
+          [(items[1], 'push_state b', items[1].zipped if use_zip else 'b')],
+          storage_api.push_calls)
+
+  def test_async_fetch_resume(self):
+    data = ''.join(str(x) for x in xrange(1000))
+    calls = []
+    class BrokenStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0, length=None):
+        calls.append((digest, offset, length))
+        # The first attempt breaks after sending 100 bytes.
+        yield data[offset:offset+100]
+        if len(calls) == 1:
+          raise IOError('Connection reset')
+        yield data[offset+100:]
+
+    storage = isolateserver.Storage(BrokenStorageApi({}))
+    channel = threading_utils.TaskChannel()
+    fetched = []
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'digest', len(data),
+        lambda content: fetched.append(''.join(content)))
+    self.assertEqual('digest', channel.pull())
+    self.assertEqual([data], fetched)
+    # Resumed at the offset of the first missing byte.
+    self.assertEqual([('digest', 0, None), ('digest', 100, None)], calls)
+
+  def test_async_fetch_ranges(self):
+    self.mock(isolateserver, 'MIN_SIZE_FOR_RANGED_FETCH', 100)
+    data = ''.join(str(x) for x in xrange(1000))
+    calls = []
+    class RangedStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0, length=None):
+        calls.append((digest, offset, length))
+        yield data[offset:offset+length]
+
+    storage = isolateserver.Storage(RangedStorageApi({}))
+    storage.download_ranges = 4
+    channel = threading_utils.TaskChannel()
+    fetched = []
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'digest', len(data),
+        lambda content: fetched.append(''.join(content)))
+    self.assertEqual('digest', channel.pull())
+    self.assertEqual([data], fetched)
+    range_size = (len(data) + 3) / 4
+    expected = [
+      ('digest', i * range_size, min(range_size, len(data) - i * range_size))
+      for i in xrange(4)
+    ]
+    self.assertEqual(expected, sorted(calls))
+
+  def test_async_fetch_ranges_cache(self):
+    # The ranges are written in a file of the cache which is then adopted.
+    self.mock(isolateserver, 'MIN_SIZE_FOR_RANGED_FETCH', 100)
+    data = ''.join(str(x) for x in xrange(1000))
+    algo = isolated_format.get_hash_algo('default')
+    digest = algo(data).hexdigest()
+    class RangedStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0, length=None):
+        yield data[offset:offset+length]
+
+    storage = isolateserver.Storage(RangedStorageApi({}))
+    storage.download_ranges = 4
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    cache = isolateserver.DiskCache(
+        cache_dir, isolateserver.CachePolicies(0, 0, 0), algo)
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, digest, len(data), self.fail,
+        cache)
+    self.assertEqual(digest, channel.pull())
+    self.assertEqual(data, cache.read(digest))
+    self.assertEqual([len(data)], cache.added)
+    self.assertEqual(
+        [], [i for i in os.listdir(cache_dir) if i.startswith(u'tmp')])
+
+  def test_async_fetch_ranges_failure(self):
+    self.mock(isolateserver, 'MIN_SIZE_FOR_RANGED_FETCH', 100)
+    data = 'x' * 1000
+    class RangedStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0, length=None):
+        if offset:
+          raise IOError('Nope')
+        yield data[offset:offset+length]
+
+    storage = isolateserver.Storage(RangedStorageApi({}))
+    storage.download_ranges = 2
+    channel = threading_utils.TaskChannel()
+    fetched = []
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'digest', len(data),
+        lambda content: fetched.append(''.join(content)))
+    with self.assertRaises(IOError):
+      channel.pull()
+    self.assertEqual([], fetched)
+
+  def test_async_fetch_batch(self):
+    calls = []
+    class BatchStorageApi(MockedStorageApi):
+      def fetch(self, digest, offset=0, length=None):
+        calls.append(digest)
+        yield digest
+
+      def fetch_batch(self, digests):
+        calls.append(digests)
+        # 'b' is not returned and 'c' is corrupted.
+        return {'a': 'a', 'c': 'cc'}
+
+    storage = isolateserver.Storage(BatchStorageApi({}))
+    channel = threading_utils.TaskChannel()
+    fetched = {}
+    def sink(digest, content):
+      fetched[digest] = ''.join(content)
+    storage.async_fetch_batch(
+        channel, threading_utils.PRIORITY_MED,
+        [(d, 1, functools.partial(sink, d)) for d in ('a', 'b', 'c')])
+    self.assertEqual(['a', 'b', 'c'], sorted(channel.pull() for _ in xrange(3)))
+    self.assertEqual({'a': 'a', 'b': 'b', 'c': 'c'}, fetched)
+    self.assertEqual(['a', 'b', 'c'], calls[0])
+    self.assertEqual(['b', 'c'], sorted(calls[1:]))
+
   def test_upload_tree(self):
     files = {
       u'/a': {
@@ -382,7 +601,7 @@ class IsolateServerStorageApiTest(TestCase):
     response = data
     return (
         server + '/some/gs/url/%s/%s' % (namespace, item),
-        {},
+        {'headers': request_headers} if request_headers else {},
         response,
         response_headers,
     )
@@ -487,6 +706,52 @@ class IsolateServerStorageApiTest(TestCase):
       with self.assertRaises(IOError):
         _ = ''.join(storage.fetch(item, offset))
 
+  def test_fetch_range_success(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    offset = 200
+    length = 100
+    self.expected_requests([
+        self.mock_fetch_request(server, namespace, item, offset=offset),
+        self.mock_gs_request(
+            server, namespace, item, data[offset:offset+length], offset=offset,
+            request_headers={
+              'Range': 'bytes=%d-%d' % (offset, offset + length - 1),
+            },
+            response_headers={
+              'Content-Range': 'bytes %d-%d/%d' % (
+                  offset, offset + length - 1, len(data)),
+            }),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    fetched = ''.join(storage.fetch(item, offset, length))
+    self.assertEqual(data[offset:offset+length], fetched)
+
+  def test_fetch_range_incomplete(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    offset = 200
+    length = 100
+    self.expected_requests([
+        self.mock_fetch_request(server, namespace, item, offset=offset),
+        self.mock_gs_request(
+            server, namespace, item, data[offset:], offset=offset,
+            request_headers={
+              'Range': 'bytes=%d-%d' % (offset, offset + length - 1),
+            },
+            response_headers={
+              'Content-Range': 'bytes %d-%d/%d' % (
+                  offset, len(data) - 1, len(data)),
+            }),
+    ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    with self.assertRaises(IOError):
+      _ = ''.join(storage.fetch(item, offset, length))
+
   def test_push_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -582,6 +847,51 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertTrue(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
+  def test_push_streamed_to_gs(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    chunks = [str(x) * 100 for x in xrange(10)]
+    data = ''.join(chunks)
+    item = FakeItem(data)
+    contains_request = {'items': [
+        {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]}
+    contains_response = {'items': [
+        {'index': 0,
+         'gs_upload_url': server + '/FAKE_GCS/whatevs/1234',
+         'upload_ticket': 'ticket!'}]}
+    uploads = []
+    def check_put(kwargs):
+      body = kwargs.pop('data')
+      # The body is streamed and can be restarted.
+      self.assertTrue(callable(body))
+      uploads.append(''.join(body()))
+      uploads.append(''.join(body()))
+      self.assertEqual(
+          {
+            'content_type': 'application/octet-stream',
+            'method': 'PUT',
+            'headers': {'Cache-Control': 'public, max-age=31536000'},
+          },
+          kwargs)
+    requests = [
+      self.mock_contains_request(
+          server, namespace, contains_request, contains_response),
+      (server + '/FAKE_GCS/whatevs/1234', check_put, '', None),
+      (
+        server + '/_ah/api/isolateservice/v1/finalize_gs_upload',
+        {'data': {'upload_ticket': 'ticket!'}},
+        {'ok': True},
+      ),
+    ]
+    self.expected_requests(requests)
+    storage = isolateserver.IsolateServer(server, namespace)
+    missing = storage.contains([item])
+    push_state = missing[item]
+    storage.push(item, push_state, isolateserver.RestartableContent(
+        lambda: iter(chunks)))
+    self.assertEqual([data, data], uploads)
+    self.assertTrue(push_state.finalized)
+
   def test_contains_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -632,6 +942,80 @@ class IsolateServerStorageApiTest(TestCase):
     with self.assertRaises(isolated_format.MappingError):
       storage.contains([])
 
+  def test_fetch_batch_errors(self):
+    responses = []
+    calls = []
+    def url_read_json(url, **kwargs):
+      calls.append(url)
+      self.assertEqual(True, kwargs['raise_http_error'])
+      response = responses.pop(0)
+      if isinstance(response, Exception):
+        raise response
+      return response
+    self.mock(net, 'url_read_json', url_read_json)
+    storage = isolateserver.IsolateServer('http://example.com', 'default')
+
+    # Transient errors only skip the batch.
+    responses = [None, net.HttpError(400, 'text/plain', None)]
+    self.assertEqual({}, storage.fetch_batch(['a']))
+    self.assertEqual({}, storage.fetch_batch(['a']))
+    self.assertEqual(2, len(calls))
+    self.assertEqual(False, storage._no_fetch_batch)
+
+    # The server doesn't support it.
+    responses = [net.HttpError(404, 'text/plain', None)]
+    self.assertEqual({}, storage.fetch_batch(['a']))
+    self.assertEqual(True, storage._no_fetch_batch)
+    self.assertEqual({}, storage.fetch_batch(['a']))
+    self.assertEqual(3, len(calls))
+
+    # Malformed response.
+    storage._no_fetch_batch = False
+    responses = [[]]
+    self.assertEqual({}, storage.fetch_batch(['a']))
+    self.assertEqual(True, storage._no_fetch_batch)
+
+  def test_push_batch_errors(self):
+    responses = []
+    calls = []
+    def url_read_json(url, **kwargs):
+      calls.append(url)
+      self.assertEqual(True, kwargs['raise_http_error'])
+      response = responses.pop(0)
+      if isinstance(response, Exception):
+        raise response
+      return response
+    self.mock(net, 'url_read_json', url_read_json)
+    storage = isolateserver.IsolateServer('http://example.com', 'default')
+    item = isolateserver.BufferItem('a')
+    def push_batch():
+      push_state = isolateserver._IsolateServerPushState(
+          {'upload_ticket': 'ticket'}, item.size)
+      return storage.push_batch([(item, push_state, None)])
+
+    # Transient errors only skip the batch.
+    responses = [None, net.HttpError(400, 'text/plain', None)]
+    self.assertEqual([], push_batch())
+    self.assertEqual([], push_batch())
+    self.assertEqual(2, len(calls))
+    self.assertEqual(False, storage._no_push_batch)
+
+    responses = [{'ok': True}]
+    self.assertEqual([item], push_batch())
+
+    # The server doesn't support it.
+    responses = [net.HttpError(404, 'text/plain', None)]
+    self.assertEqual([], push_batch())
+    self.assertEqual(True, storage._no_push_batch)
+    self.assertEqual([], push_batch())
+    self.assertEqual(4, len(calls))
+
+    # Malformed response.
+    storage._no_push_batch = False
+    responses = [{}]
+    self.assertEqual([], push_batch())
+    self.assertEqual(True, storage._no_push_batch)
+
 
 class IsolateServerStorageSmokeTest(unittest.TestCase):
   """Tests public API of Storage class using file system as a store."""
@@ -698,7 +1082,7 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_upload_items_gzip(self):
     self.run_upload_items_test('default-gzip')
 
-  def run_push_and_fetch_test(self, namespace):
+  def run_push_and_fetch_test(self, namespace, with_size=False):
     storage = isolateserver.get_storage(self.server.url, namespace)
 
     # Upload items.
@@ -714,7 +1098,11 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
     pending = set()
     for item in items:
       pending.add(item.digest)
-      queue.add(item.digest)
+      if with_size:
+        # Small items of known size are fetched in batches.
+        queue.add(item.digest, item.size)
+      else:
+        queue.add(item.digest)
 
     # Wait for fetch to complete.
     while pending:
@@ -732,6 +1120,12 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_push_and_fetch_gzip(self):
     self.run_push_and_fetch_test('default-gzip')
 
+  def test_push_and_fetch_batch(self):
+    self.run_push_and_fetch_test('default', True)
+
+  def test_push_and_fetch_batch_gzip(self):
+    self.run_push_and_fetch_test('default-gzip', True)
+
   if sys.maxsize == (2**31) - 1:
     def test_archive_multiple_huge_file(self):
       self.server.discard_content()
@@ -912,7 +1306,7 @@ def get_storage(_isolate_server, namespace):
     @staticmethod
     def upload_items(items):
       # Always returns the second item as not present.
-      return [items[1]]
+      return [list(items)[1]]
   return StorageFake()
 
 
@@ -992,6 +1386,44 @@ class TestArchive(TestCase):
       self.help_test_archive(['archive'])
 
 
+class ExistenceCacheTest(TestCase):
+  def setUp(self):
+    super(ExistenceCacheTest, self).setUp()
+    self.state_file = os.path.join(self.tempdir, u'existence.json')
+    self.now = 1000000000.
+    self.mock(time, 'time', lambda: self.now)
+
+  def test_ttl(self):
+    cache = isolateserver.ExistenceCache(self.state_file, ttl=60)
+    cache.add('https://a', 'default', ['1' * 40])
+    self.assertTrue(cache.is_present('https://a', 'default', '1' * 40))
+    self.assertFalse(cache.is_present('https://b', 'default', '1' * 40))
+    self.assertFalse(cache.is_present('https://a', 'default-gzip', '1' * 40))
+    self.now += 60
+    self.assertFalse(cache.is_present('https://a', 'default', '1' * 40))
+    self.assertEqual(0, len(cache))
+
+  def test_save_load(self):
+    cache = isolateserver.ExistenceCache(self.state_file, ttl=60, max_items=2)
+    cache.add('https://a', 'default', ['1' * 40, '2' * 40])
+    self.now += 30
+    cache.add('https://a', 'default', ['3' * 40])
+    self.assertEqual(2, len(cache))
+    self.now += 40
+    # The expired items are not saved.
+    self.assertTrue(cache.save())
+    cache = isolateserver.ExistenceCache(self.state_file)
+    self.assertEqual(1, len(cache))
+    self.assertFalse(cache.is_present('https://a', 'default', '2' * 40))
+    self.assertTrue(cache.is_present('https://a', 'default', '3' * 40))
+
+  def test_broken_state(self):
+    with open(self.state_file, 'wb') as f:
+      f.write('broken')
+    cache = isolateserver.ExistenceCache(self.state_file)
+    self.assertEqual(0, len(cache))
+
+
 class DiskCacheTest(TestCase):
   def setUp(self):
     super(DiskCacheTest, self).setUp()
@@ -1074,6 +1506,282 @@ class DiskCacheTest(TestCase):
     self.assertEqual({h_c}, cache._protected)
     self.assertEqual(1003, cache._free_disk)
 
+  def test_load_state_without_listdir(self):
+    self._free_disk = 1100
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('a'))
+      h_b = cache.write(*self.to_hash('b'))
+    self.assertEqual(
+        [cache.STATE_FILE],
+        [f for f in os.listdir(self.tempdir) if f.startswith('state')])
+    # The state is trusted, the shards are not listed nor walked.
+    self.mock(
+        file_path, 'make_tree_read_only', lambda _: self.fail('Walked tree'))
+    old_listdir = isolateserver.fs.listdir
+    def listdir(p):
+      self.assertEqual(self.tempdir, p)
+      return old_listdir(p)
+    self.mock(isolateserver.fs, 'listdir', listdir)
+    cache = self.get_cache()
+    self.assertEqual([(h_a, 1), (h_b, 1)], cache._lru._items.items())
+    self.assertEqual(2, cache.initial_number_items)
+    self.assertEqual(2, cache.initial_size)
+    # A lost file is detected when it is accessed.
+    os.remove(os.path.join(self.tempdir, h_a[:2], h_a[2:]))
+    self.assertFalse(cache.touch(h_a, 1))
+    self.assertTrue(cache.touch(h_b, 1))
+
+  def test_load_after_crash_scans_shards(self):
+    self._free_disk = 1100
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('a'))
+    self.assertFalse(os.path.isfile(cache.dirty_file))
+    # The process dies before saving the state.
+    cache = self.get_cache()
+    h_b = cache.write(*self.to_hash('b'))
+    self.assertTrue(os.path.isfile(cache.dirty_file))
+    cache = self.get_cache()
+    # The item missing from the state is added back as the oldest one.
+    self.assertEqual([(h_b, 1), (h_a, 1)], cache._lru._items.items())
+    self.assertFalse(os.path.isfile(cache.dirty_file))
+
+  def test_sharded_layout(self):
+    self._free_disk = 1100
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('a'))
+    self.assertEqual(
+        sorted([h_a[:2], cache.STATE_FILE]), sorted(os.listdir(self.tempdir)))
+    self.assertEqual([h_a[2:]], os.listdir(os.path.join(self.tempdir, h_a[:2])))
+    self.assertEqual('a', self.get_cache().read(h_a))
+
+  def test_load_corrupted_state_scans_shards(self):
+    self._free_disk = 1100
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('a'))
+      h_b = cache.write(*self.to_hash('b'))
+    os.remove(os.path.join(self.tempdir, h_a[:2], h_a[2:]))
+    isolateserver.file_write(os.path.join(self.tempdir, h_b[:2], 'z'), 'z')
+    with open(cache.state_file, 'wb') as f:
+      f.write('garbage')
+    cache = self.get_cache()
+    self.assertEqual([(h_b, 1)], cache._lru._items.items())
+    self.assertEqual([h_b[2:]], os.listdir(os.path.join(self.tempdir, h_b[:2])))
+
+  def test_reflink(self):
+    self._free_disk = 1100
+    # Simulate a file system supporting reflink.
+    self.mock(
+        file_path, 'reflink',
+        lambda source, link_name: file_path.readable_copy(link_name, source))
+    cache = isolateserver.DiskCache(
+        self.tempdir, self._policies, self._algo, reflink=True)
+    self.assertTrue(cache.copy_on_write)
+    h_a = cache.write(*self.to_hash('a'))
+    cache._verified.add(h_a, 1)
+    dest = os.path.join(self.tempdir, 'dest')
+    cache.hardlink(h_a, dest, 0500)
+    # The mapped file is writeable and distinct from the cached item, which
+    # stays verified.
+    self.assertNotEqual(os.stat(dest).st_ino, os.stat(cache._path(h_a)).st_ino)
+    self.assertEqual(0700, os.stat(dest).st_mode & 0777)
+    with open(dest, 'wb') as f:
+      f.write('b')
+    self.assertEqual('a', cache.read(h_a))
+    self.assertEqual([h_a], list(cache._verified))
+    self.assertEqual([1], cache.linked)
+
+  def test_reflink_unsupported(self):
+    self._free_disk = 1100
+    def reflink(_source, _link_name):
+      raise OSError(95, 'Operation not supported')
+    self.mock(file_path, 'reflink', reflink)
+    cache = isolateserver.DiskCache(
+        self.tempdir, self._policies, self._algo, reflink=True)
+    # Hardlinks are used instead of copying every file.
+    self.assertFalse(cache.copy_on_write)
+    # The probe files were removed.
+    self.assertEqual([cache.STATE_FILE], os.listdir(self.tempdir))
+    h_a = cache.write(*self.to_hash('a'))
+    dest = os.path.join(self.tempdir, 'dest')
+    cache.hardlink(h_a, dest, 0500)
+    self.assertEqual(os.stat(dest).st_ino, os.stat(cache._path(h_a)).st_ino)
+
+  def test_parsed(self):
+    self._free_disk = 1100
+    data = {u'files': {u'a': {u'h': u'0'*40, u's': 1}}, u'version': u'1.4'}
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('{}'))
+      h_b = cache.write(*self.to_hash('b'))
+      self.assertEqual(None, cache.read_parsed(h_a))
+      cache.write_parsed(h_a, data)
+      cache.write_parsed(h_b, data)
+      self.assertEqual(data, cache.read_parsed(h_a))
+    self.assertEqual(
+        sorted([h_a, h_b]), sorted(os.listdir(cache.parsed_dir)))
+
+    # The saved data is used by the next run, until the item is evicted.
+    cache = self.get_cache()
+    self.assertEqual(data, cache.read_parsed(h_a))
+    with cache._lock:
+      cache._delete_file(h_a)
+    self.assertEqual(None, cache.read_parsed(h_a))
+    self.assertEqual([h_b], os.listdir(cache.parsed_dir))
+
+    # Corrupted data is ignored and removed.
+    path = os.path.join(cache.parsed_dir, h_b)
+    os.chmod(path, 0600)
+    with open(path, 'wb') as f:
+      f.write('garbage')
+    self.assertEqual(None, self.get_cache().read_parsed(h_b))
+    self.assertEqual([], os.listdir(cache.parsed_dir))
+
+  def test_cleanup_verify(self):
+    self._free_disk = 1100
+    self._policies.max_items = 10
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('a'))
+      h_b = cache.write(*self.to_hash('b'))
+      h_c = cache.write(*self.to_hash('c'))
+    # Corrupt an item without changing its size.
+    path = os.path.join(self.tempdir, h_b[:2], h_b[2:])
+    os.chmod(path, 0600)
+    with open(path, 'wb') as f:
+      f.write('z')
+
+    # The most recently used items are verified first.
+    cache = self.get_cache()
+    cache.VERIFY_BUDGET = 2
+    cache.cleanup()
+    self.assertEqual([h_a, h_c], list(cache._lru))
+    self.assertEqual([h_c], list(cache._verified))
+
+    # The progress is saved.
+    cache = self.get_cache()
+    self.assertEqual([h_c], list(cache._verified))
+    cache.VERIFY_BUDGET = 1
+    cache.cleanup()
+    self.assertEqual([h_c, h_a], list(cache._verified))
+    # Once everything was verified, the oldest verification is redone.
+    cache.VERIFY_BUDGET = 1
+    cache.cleanup()
+    self.assertEqual([h_a, h_c], list(cache._verified))
+
+    # A hardlinked item has to be verified again.
+    cache.hardlink(h_a, os.path.join(self.tempdir, 'dest'), None)
+    self.assertEqual([h_c], list(cache._verified))
+
+  def test_policy_size_weighted(self):
+    for eviction in ('lfu', 'gdsf', 'lru'):
+      file_path.rmtree(self.tempdir)
+      self._free_disk = 1100
+      self._policies = isolateserver.CachePolicies(100, 1000, 10, eviction)
+      with self.get_cache() as cache:
+        h_a = cache.write(*self.to_hash('a'))
+        h_c = cache.write(*self.to_hash('c'))
+        h_b = cache.write(*self.to_hash('b'*50))
+      self._policies.max_items = 2
+      with self.get_cache() as cache:
+        pass
+      if eviction == 'lru':
+        expected = [h_c, h_b]
+      else:
+        # The large item goes first.
+        expected = [h_a, h_c]
+      self.assertEqual(expected, list(cache._lru), eviction)
+
+  def test_policy_lru_2(self):
+    for eviction in ('lru-2', 'lru'):
+      file_path.rmtree(self.tempdir)
+      self._free_disk = 1100
+      self._policies = isolateserver.CachePolicies(100, 1000, 10, eviction)
+      with self.get_cache() as cache:
+        h_a = cache.write(*self.to_hash('a'))
+      with self.get_cache() as cache:
+        self.assertTrue(cache.touch(h_a, 1))
+        h_b = cache.write(*self.to_hash('b'))
+        h_c = cache.write(*self.to_hash('c'))
+      self._policies.max_items = 2
+      with self.get_cache() as cache:
+        pass
+      if eviction == 'lru':
+        expected = [h_b, h_c]
+      else:
+        # The item used twice is kept.
+        expected = [h_a, h_c]
+      self.assertEqual(sorted(expected), sorted(cache._lru), eviction)
+      self.assertEqual(eviction, cache.eviction_policy)
+
+  def test_policy_stats(self):
+    for eviction in ('lfu', 'gdsf', 'lru-2'):
+      file_path.rmtree(self.tempdir)
+      self._free_disk = 1100
+      self._policies = isolateserver.CachePolicies(100, 1000, 10, eviction)
+      with self.get_cache() as cache:
+        h_a = cache.write(*self.to_hash('a'))
+        # The first access is counted once.
+        self.assertEqual(1, cache._policy.stats[h_a][0], eviction)
+        self.assertTrue(cache.touch(h_a, 1))
+        self.assertEqual(2, cache._policy.stats[h_a][0], eviction)
+
+  def test_policy_protected(self):
+    self._free_disk = 1100
+    self._policies = isolateserver.CachePolicies(100, 1000, 10, 'gdsf')
+    with self.assertRaises(isolateserver.Error):
+      with self.get_cache() as cache:
+        cache.write(*self.to_hash('a'))
+        cache.write(*self.to_hash('b'))
+        # Both items are in use.
+        self._policies.max_items = 1
+
+  def test_max_admitted_size(self):
+    self._free_disk = 1100
+    self._policies = isolateserver.CachePolicies(100, 1000, 10, 'lru', 10)
+    with self.get_cache() as cache:
+      h_a = cache.write(*self.to_hash('a'*20))
+      h_b = cache.write(*self.to_hash('b'))
+      # The item is usable during the run.
+      self.assertEqual('a'*20, cache.read(h_a))
+    self.assertEqual([h_b], list(cache._lru))
+    self.assertFalse(
+        os.path.isfile(os.path.join(self.tempdir, h_a[:2], h_a[2:])))
+
+  def test_trim_long_running(self):
+    self._free_disk = 1100
+    self._policies = isolateserver.CachePolicies(100, 1000, 10, 'lru', 10)
+    cache = self.get_cache()
+    h_a = cache.write(*self.to_hash('a'*20))
+    h_b = cache.write(*self.to_hash('b'))
+    self.assertEqual([20, 1], cache.added)
+    cache.trim()
+    self.assertEqual([h_b], list(cache._lru))
+    self.assertEqual(set(), cache._protected)
+    cache.reset_stats()
+    self.assertEqual([], cache.added)
+    self.assertEqual([], cache.evicted)
+    self.assertFalse(
+        os.path.isfile(os.path.join(self.tempdir, h_a[:2], h_a[2:])))
+
+  def test_load_json_state(self):
+    h_a = self.to_hash('a')[0]
+    isolateserver.file_write(os.path.join(self.tempdir, h_a), 'a')
+    h_b = self.to_hash('b')[0]
+    isolateserver.file_write(os.path.join(self.tempdir, h_b), 'b')
+    with open(os.path.join(self.tempdir, u'state.json'), 'wb') as f:
+      json.dump([[h_b, 1], [h_a, 1]], f)
+    self._free_disk = 1100
+    cache = self.get_cache()
+    self.assertEqual([(h_b, 1), (h_a, 1)], cache._lru._items.items())
+    # The state was migrated.
+    self.assertFalse(os.path.isfile(os.path.join(self.tempdir, u'state.json')))
+    self.assertEqual(
+        [(h_b, 1), (h_a, 1)],
+        lru.LRUDict.load_journal(cache.state_file)._items.items())
+    # The files were moved to their shard.
+    self.assertEqual(
+        sorted([h_a[:2], h_b[:2], cache.STATE_FILE]),
+        sorted(os.listdir(self.tempdir)))
+    self.assertEqual('a', cache.read(h_a))
+
 
 def clear_env_vars():
   for e in ('ISOLATE_DEBUG', 'ISOLATE_SERVER'):
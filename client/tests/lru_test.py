@@ -221,6 +221,73 @@ class LRUDictTest(unittest.TestCase):
           ['key', 'another_value'],
       ]))
 
+  def test_load_save_journal(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      data = [1, 2, 3]
+      lru_dict = self.prepare_lru_dict(data)
+      self.assertTrue(lru_dict.save_journal(tmp_name))
+      self.assertFalse(lru_dict.save_journal(tmp_name))
+      size = os.stat(tmp_name).st_size
+
+      # Changes are appended.
+      lru_dict.touch(1)
+      lru_dict.pop(2)
+      lru_dict.add(4, 4)
+      self.assertTrue(lru_dict.save_journal(tmp_name))
+      self.assertLess(size, os.stat(tmp_name).st_size)
+      loaded = lru.LRUDict.load_journal(tmp_name)
+      self.assertEqual([(3, None), (1, None), (4, 4)], loaded._items.items())
+
+      # Changes done after loading are appended too.
+      loaded.pop_oldest()
+      self.assertTrue(loaded.save_journal(tmp_name))
+      self.assert_order(lru.LRUDict.load_journal(tmp_name), [1, 4])
+
+      # A truncated record is ignored.
+      with open(tmp_name, 'rb') as f:
+        content = f.read()
+      with open(tmp_name, 'wb') as f:
+        f.write(content[:-1])
+      self.assert_order(lru.LRUDict.load_journal(tmp_name), [3, 1, 4])
+    finally:
+      os.unlink(tmp_name)
+
+  def test_journal_compaction(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      lru_dict = self.prepare_lru_dict([1])
+      lru_dict.save_journal(tmp_name)
+      size = os.stat(tmp_name).st_size
+      for _ in xrange(lru.JOURNAL_SLACK):
+        lru_dict.touch(1)
+        lru_dict.save_journal(tmp_name)
+      self.assertLess(size, os.stat(tmp_name).st_size)
+      # The journal is rewritten once it grows too large.
+      lru_dict.touch(1)
+      lru_dict.touch(1)
+      lru_dict.touch(1)
+      lru_dict.save_journal(tmp_name)
+      self.assertEqual(size, os.stat(tmp_name).st_size)
+      self.assert_order(lru.LRUDict.load_journal(tmp_name), [1])
+    finally:
+      os.unlink(tmp_name)
+
+  def test_corrupted_journal(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      with open(tmp_name, 'wb') as f:
+        f.write('garbage, not a state')
+      with self.assertRaises(ValueError):
+        lru.LRUDict.load_journal(tmp_name)
+      with self.assertRaises(ValueError):
+        lru.LRUDict.load_journal(tmp_name + '.missing')
+    finally:
+      os.unlink(tmp_name)
+
 
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
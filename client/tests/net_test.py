@@ -5,13 +5,17 @@
 
 # pylint: disable=R0201,W0613
 
+import BaseHTTPServer
+import SocketServer
 import StringIO
 import __builtin__
 import contextlib
 import logging
 import math
 import os
+import socket
 import sys
+import threading
 import unittest
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -357,6 +361,83 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(['filepath'], removed)
 
 
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Length', '2')
+    self.end_headers()
+    self.wfile.write('ok')
+
+  def log_message(self, *_args):
+    pass
+
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  # Do not wait for the kept alive connections on shutdown.
+  daemon_threads = True
+
+
+class RequestsLibEngineTest(auto_stub.TestCase):
+  def setUp(self):
+    super(RequestsLibEngineTest, self).setUp()
+    self.server = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.url = 'http://127.0.0.1:%d' % self.server.server_port
+    self.mock(net, '_http_services', {})
+    self.mock(net, '_connection_pool_size', net.CONNECTION_POOL_SIZE)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    super(RequestsLibEngineTest, self).tearDown()
+
+  def get(self, engine):
+    response = engine.perform_request(net.HttpRequest(
+        'GET', self.url + '/', [], None, {}, 10, False, True))
+    self.assertEqual('ok', response.read())
+
+  def test_connection_stats(self):
+    engine = net.RequestsLibEngine()
+    self.get(engine)
+    self.get(engine)
+    self.assertEqual(
+        {'connections': 1, 'requests': 2}, engine.get_connection_stats())
+
+  def test_configure_connection_pools(self):
+    service = net.HttpService(self.url, net.RequestsLibEngine())
+    net._http_services[self.url] = service
+    self.get(service.engine)
+    net.ensure_connection_pool_size(8)
+    self.assertEqual(net.CONNECTION_POOL_SIZE, net._connection_pool_size)
+    net.ensure_connection_pool_size(net.CONNECTION_POOL_SIZE + 1)
+    adapter = service.engine.session.adapters['http://']
+    self.assertEqual(net.CONNECTION_POOL_SIZE + 1, adapter._pool_maxsize)
+    # The connection was dropped with the old pool but it is still counted.
+    self.get(service.engine)
+    self.assertEqual(
+        {'connections': 2, 'requests': 2}, net.get_connection_stats())
+
+  def test_configure_connection_pools_tcp_keep_alive(self):
+    self.mock(net, '_tcp_keep_alive', False)
+    service = net.HttpService(self.url, net.RequestsLibEngine())
+    net._http_services[self.url] = service
+    keep_alive = (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    adapter = service.engine.session.adapters['http://']
+    self.assertNotIn(
+        keep_alive,
+        adapter.poolmanager.connection_pool_kw.get('socket_options', []))
+    net.configure_connection_pools(tcp_keep_alive=True)
+    # The existing pools were replaced.
+    adapter = service.engine.session.adapters['http://']
+    self.assertIn(
+        keep_alive, adapter.poolmanager.connection_pool_kw['socket_options'])
+    self.get(service.engine)
+
+
 class TestNetFunctions(auto_stub.TestCase):
   def test_fix_url(self):
     data = [
@@ -150,6 +150,16 @@ def list_files_tree(directory):
   return sorted(actual)
 
 
+def cache_path(digest):
+  """Returns the path of an item relative to the cache directory."""
+  return os.path.join(digest[:2], digest[2:])
+
+
+def parsed_path(digest):
+  """Returns the path of the parsed data of an .isolated file in the cache."""
+  return os.path.join('parsed', digest)
+
+
 def read_content(filepath):
   with open(filepath, 'rb') as f:
     return f.read()
@@ -260,10 +270,11 @@ class RunIsolatedTest(unittest.TestCase):
     # different names and ensure both are created.
     isolated_hash = self._store('repeated_files.isolated')
     expected = [
-      'state.json',
-      isolated_hash,
-      self._store('file1.txt'),
-      self._store('repeated_files.py'),
+      'state.bin',
+      cache_path(isolated_hash),
+      parsed_path(isolated_hash),
+      cache_path(self._store('file1.txt')),
+      cache_path(self._store('repeated_files.py')),
     ]
 
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
@@ -278,10 +289,11 @@ class RunIsolatedTest(unittest.TestCase):
     # MAX_PATH.
     isolated_hash = self._store('max_path.isolated')
     expected = [
-      'state.json',
-      isolated_hash,
-      self._store('file1.txt'),
-      self._store('max_path.py'),
+      'state.bin',
+      cache_path(isolated_hash),
+      parsed_path(isolated_hash),
+      cache_path(self._store('file1.txt')),
+      cache_path(self._store('max_path.py')),
     ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', err)
@@ -292,7 +304,9 @@ class RunIsolatedTest(unittest.TestCase):
 
   def test_fail_empty_isolated(self):
     isolated_hash = self._store_isolated({})
-    expected = ['state.json', isolated_hash]
+    expected = [
+      'state.bin', cache_path(isolated_hash), parsed_path(isolated_hash),
+    ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', out)
     self.assertIn(
@@ -310,17 +324,21 @@ class RunIsolatedTest(unittest.TestCase):
     # as file2.txt.
     isolated_hash = self._store('check_files.isolated')
     expected = [
-      'state.json',
-      isolated_hash,
-      self._store('check_files.py'),
-      self._store('file1.txt'),
-      self._store('file3.txt'),
+      'state.bin',
+      cache_path(isolated_hash),
+      parsed_path(isolated_hash),
+      cache_path(self._store('check_files.py')),
+      cache_path(self._store('file1.txt')),
+      cache_path(self._store('file3.txt')),
       # Maps file1.txt.
-      self._store('manifest1.isolated'),
+      cache_path(self._store('manifest1.isolated')),
+      parsed_path(self._store('manifest1.isolated')),
       # References manifest1.isolated. Maps file2.txt but it is overriden.
-      self._store('manifest2.isolated'),
-      self._store('repeated_files.py'),
-      self._store('repeated_files.isolated'),
+      cache_path(self._store('manifest2.isolated')),
+      parsed_path(self._store('manifest2.isolated')),
+      cache_path(self._store('repeated_files.py')),
+      cache_path(self._store('repeated_files.isolated')),
+      parsed_path(self._store('repeated_files.isolated')),
     ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', err)
@@ -329,7 +347,7 @@ class RunIsolatedTest(unittest.TestCase):
     actual = list_files_tree(self.cache)
     self.assertEqual(sorted(expected), actual)
 
-  def _test_corruption_common(self, new_content):
+  def _test_corruption_common(self, new_content, refetched):
     isolated_hash = self._store('file_with_size.isolated')
     file1_hash = self._store('file1.txt')
 
@@ -338,17 +356,21 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode)
     expected = {
       '.': (040707, 040707, 040777),
-      'state.json': (0100606, 0100606, 0100666),
+      'state.bin': (0100606, 0100606, 0100666),
+      file1_hash[:2]: (040707, 040707, 040777),
+      isolated_hash[:2]: (040707, 040707, 040777),
       # The reason for 0100666 on Windows is that the file node had to be
       # modified to delete the hardlinked node. The read only bit is reset on
       # load.
-      file1_hash: (0100400, 0100400, 0100666),
-      isolated_hash: (0100400, 0100400, 0100444),
+      cache_path(file1_hash): (0100400, 0100400, 0100666),
+      cache_path(isolated_hash): (0100400, 0100400, 0100444),
+      'parsed': (040707, 040707, 040777),
+      parsed_path(isolated_hash): (0100606, 0100606, 0100666),
     }
     self.assertTreeModes(self.cache, expected)
 
     # Modify one of the files in the cache to be invalid.
-    cached_file_path = os.path.join(self.cache, file1_hash)
+    cached_file_path = os.path.join(self.cache, cache_path(file1_hash))
     previous_mode = os.stat(cached_file_path).st_mode
     os.chmod(cached_file_path, 0600)
     write_content(cached_file_path, new_content)
@@ -362,9 +384,17 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode, (out, err, returncode))
     expected = {
       '.': (040700, 040700, 040777),
-      u'state.json': (0100600, 0100600, 0100666),
-      unicode(file1_hash): (0100400, 0100400, 0100666),
-      unicode(isolated_hash): (0100400, 0100400, 0100444),
+      u'state.bin': (0100600, 0100600, 0100666),
+      # The shard is made writable to replace the corrupted file.
+      unicode(file1_hash[:2]): (
+          (040700, 040700, 040777) if refetched else
+          (040500, 040500, 040777)),
+      unicode(isolated_hash[:2]): (040500, 040500, 040777),
+      unicode(cache_path(file1_hash)): (0100400, 0100400, 0100666),
+      unicode(cache_path(isolated_hash)): (0100400, 0100400, 0100444),
+      # The parsed data is loaded back from the previous run.
+      u'parsed': (040500, 040500, 040777),
+      unicode(parsed_path(isolated_hash)): (0100400, 0100400, 0100666),
     }
     self.assertTreeModes(self.cache, expected)
     return cached_file_path
@@ -373,14 +403,14 @@ class RunIsolatedTest(unittest.TestCase):
     # Test that an entry with an invalid file size properly gets removed and
     # fetched again. This test case also check for file modes.
     cached_file_path = self._test_corruption_common(
-        CONTENTS['file1.txt'] + ' now invalid size')
+        CONTENTS['file1.txt'] + ' now invalid size', True)
     self.assertEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
 
   def test_corrupted_cache_entry_same_size(self):
     # Test that an entry with an invalid file content but same size is NOT
     # detected property.
     cached_file_path = self._test_corruption_common(
-        CONTENTS['file1.txt'][:-1] + ' ')
+        CONTENTS['file1.txt'][:-1] + ' ', False)
     # TODO(maruel): This corruption is NOT detected.
     # This needs to be fixed.
     self.assertNotEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
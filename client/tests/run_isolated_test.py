@@ -59,13 +59,17 @@ class StorageFake(object):
   def hash_algo(self):
     return isolateserver_mock.ALGO
 
-  def async_fetch(self, channel, _priority, digest, _size, sink):
+  def async_fetch(
+      self, channel, _priority, digest, _size, sink, _cache=None):
     sink([self._files[digest]])
     channel.send_result(digest)
 
   def upload_items(self, items_to_upload):
     # Return all except the first one.
-    return items_to_upload[1:]
+    return list(items_to_upload)[1:]
+
+  def get_network_stats(self):
+    return {}
 
 
 class RunIsolatedTestBase(auto_stub.TestCase):
@@ -176,7 +180,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
           ],
         self.popen_calls)
 
-  def _run_tha_test(self, isolated_hash, files):
+  def _run_tha_test(self, isolated_hash, files, cache=None):
     make_tree_call = []
     def add(i, _):
       make_tree_call.append(i)
@@ -187,7 +191,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
     ret = run_isolated.run_tha_test(
         isolated_hash,
         StorageFake(files),
-        isolateserver.MemoryCache(),
+        cache or isolateserver.MemoryCache(),
         False,
         None,
         None,
@@ -273,6 +277,28 @@ class RunIsolatedTest(RunIsolatedTestBase):
         [([self.temp_join(u'invalid'), u'command'], {'detached': True})],
         self.popen_calls)
 
+  def test_run_tha_test_naked_reflink(self):
+    # The copy-on-write files are mapped writeable, the tree isn't walked.
+    isolated = json_dumps({'command': ['invalid', 'command']})
+    isolated_hash = isolateserver_mock.hash_content(isolated)
+    files = {isolated_hash:isolated}
+    # Simulate a file system supporting reflink.
+    self.mock(
+        file_path, 'reflink',
+        lambda source, link_name: file_path.readable_copy(link_name, source))
+    cache = isolateserver.DiskCache(
+        os.path.join(self.tempdir, 'cache'),
+        isolateserver.CachePolicies(0, 0, 0), isolateserver_mock.ALGO,
+        reflink=True)
+    make_tree_call = self._run_tha_test(isolated_hash, files, cache)
+    self.assertEqual(
+        [
+          'make_tree_deleteable', 'make_tree_deleteable',
+          'make_tree_deleteable',
+        ],
+        make_tree_call)
+    self.assertEqual(1, len(self.popen_calls))
+
   def test_main_naked(self):
     self.mock(on_error, 'report', lambda _: None)
     # The most naked .isolated file that can exist.
@@ -495,10 +521,19 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
           u'initial_size': 0,
           u'items_cold': [len(isolated_in_json)],
           u'items_hot': [],
+          u'cache': {
+            u'policy': u'lru',
+            u'hits': 0,
+            u'hits_size': 0,
+            u'misses': 1,
+            u'misses_size': len(isolated_in_json),
+          },
+          u'network': {},
         },
         u'upload': {
           u'items_cold': [len(isolated_out_json)],
           u'items_hot': [15],
+          u'network': {},
         },
       },
       u'version': 3,
@@ -490,6 +490,186 @@ class AutoRetryThreadPoolTest(unittest.TestCase):
     self.assertEqual(16, threading_utils.IOAutoRetryThreadPool.MAX_WORKERS)
 
 
+class AdaptiveLimitTest(unittest.TestCase):
+  def test_aimd(self):
+    limit = threading_utils.AdaptiveLimit(2, 1, 8)
+    # Slow start.
+    limit.on_success()
+    limit.on_success()
+    self.assertEqual(4, limit.value)
+    epoch = limit.epoch
+    limit.on_failure(epoch)
+    self.assertEqual(2, limit.value)
+    # Failures of operations started at the previous limit are ignored.
+    limit.on_failure(epoch)
+    self.assertEqual(2, limit.value)
+    # Additive increase, one step per window.
+    limit.on_success()
+    limit.on_success()
+    self.assertEqual(2, limit.value)
+    limit.on_success()
+    self.assertEqual(3, limit.value)
+    for _ in xrange(100):
+      limit.on_success()
+    self.assertEqual(8, limit.value)
+    limit.on_failure(limit.epoch)
+    limit.on_failure(limit.epoch)
+    limit.on_failure(limit.epoch)
+    limit.on_failure(limit.epoch)
+    self.assertEqual(1, limit.value)
+    expected = {
+      'limit': 1,
+      'peak': 8,
+      'successes': 105,
+      'failures': 6,
+      'decreases': 5,
+    }
+    self.assertEqual(expected, limit.get_stats())
+
+  def test_concurrency(self):
+    concurrency = threading_utils.AdaptiveConcurrency(2, 1, 2)
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+    def task():
+      with lock:
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+      time.sleep(0.01)
+      with lock:
+        running[0] -= 1
+    with threading_utils.ThreadPool(
+        8, 8, 0, concurrency=concurrency) as pool:
+      for _ in xrange(16):
+        pool.add_task(0, task)
+      pool.join()
+    self.assertEqual(2, peak[0])
+    self.assertEqual(16, concurrency.get_stats()['successes'])
+
+  def test_concurrency_failure(self):
+    concurrency = threading_utils.AdaptiveConcurrency(4, 1, 4)
+    with threading_utils.IOAutoRetryThreadPool(concurrency) as pool:
+      channel = threading_utils.TaskChannel()
+      def throw():
+        raise IOError('Nope')
+      pool.add_task_with_channel(channel, 0, throw)
+      with self.assertRaises(IOError):
+        channel.pull()
+    stats = concurrency.get_stats()
+    self.assertEqual(1 + pool.RETRIES, stats['failures'])
+    self.assertEqual(0, stats['successes'])
+    self.assertLess(stats['limit'], 4)
+
+
+class SchedulerTest(unittest.TestCase):
+  def run_tasks(self, scheduler, tasks):
+    """Runs |tasks|, a list of (name, priority, hints), on a single thread
+    once they are all queued and returns the names in the order they ran.
+    """
+    ran = []
+    event = threading.Event()
+    with threading_utils.ThreadPool(1, 1, 0, scheduler=scheduler) as pool:
+      # Blocks the worker until all the tasks are queued.
+      pool.add_task(0, event.wait)
+      while pool.tasks.qsize():
+        time.sleep(0.001)
+      for name, priority, hints in tasks:
+        pool.add_task_with_hints(priority, hints, ran.append, name)
+      event.set()
+      pool.join()
+      stats = pool.get_scheduler_stats()
+    self.assertEqual(len(tasks) + 1, stats['wait']['count'])
+    self.assertEqual(len(tasks) + 1, stats['depth']['count'])
+    self.assertEqual(len(tasks) - 1, stats['depth']['max'])
+    return ran
+
+  def test_fifo(self):
+    tasks = [
+      ('a', 1, None),
+      ('b', 0, threading_utils.TaskHints(size=1)),
+      ('c', 1, threading_utils.TaskHints(size=1)),
+      ('d', 0, None),
+    ]
+    self.assertEqual(
+        ['b', 'd', 'a', 'c'],
+        self.run_tasks(threading_utils.Scheduler, tasks))
+
+  def test_size(self):
+    tasks = [
+      ('a', 0, None),
+      ('b', 0, threading_utils.TaskHints(size=10)),
+      ('c', 0, threading_utils.TaskHints(size=1)),
+      ('d', 1, threading_utils.TaskHints(size=0)),
+      ('e', 0, threading_utils.TaskHints(size=5)),
+    ]
+    self.assertEqual(
+        ['c', 'e', 'b', 'a', 'd'],
+        self.run_tasks(threading_utils.SizeScheduler, tasks))
+
+  def test_deadline(self):
+    now = time.time()
+    tasks = [
+      ('a', 0, None),
+      ('b', 0, threading_utils.TaskHints(deadline=now + 10)),
+      ('c', 0, threading_utils.TaskHints(deadline=now + 1)),
+      ('d', 0, None),
+    ]
+    self.assertEqual(
+        ['c', 'b', 'a', 'd'],
+        self.run_tasks(threading_utils.DeadlineScheduler, tasks))
+
+  def test_weighted_fair(self):
+    # Flow 'x' queues all its tasks first, 'y' has twice the weight.
+    tasks = [
+      ('x%d' % i, 0, threading_utils.TaskHints(flow='x')) for i in xrange(4)
+    ] + [
+      ('y%d' % i, 0, threading_utils.TaskHints(flow='y', weight=2))
+      for i in xrange(4)
+    ]
+    self.assertEqual(
+        ['y0', 'x0', 'y1', 'y2', 'x1', 'y3', 'x2', 'x3'],
+        self.run_tasks(threading_utils.WeightedFairScheduler, tasks))
+
+  def test_auto_retry_keeps_hints(self):
+    ran = []
+    def fail_once(name):
+      ran.append(name)
+      if ran.count(name) == 1:
+        raise IOError()
+      return name
+    event = threading.Event()
+    def block():
+      event.wait()
+    with threading_utils.AutoRetryThreadPool(
+        [IOError], 2, 1, 1, 0,
+        scheduler=threading_utils.SizeScheduler) as pool:
+      pool.add_task(0, block)
+      while pool.tasks.qsize():
+        time.sleep(0.001)
+      pool.add_task_with_hints(
+          0, threading_utils.TaskHints(size=2), fail_once, 'big')
+      pool.add_task_with_hints(
+          0, threading_utils.TaskHints(size=1), fail_once, 'small')
+      event.set()
+      self.assertEqual(['small', 'big'], sorted(pool.join(), reverse=True))
+    # Both retries run at a lower priority, still smallest first.
+    self.assertEqual(['small', 'big', 'small', 'big'], ran)
+
+
+class HistogramTest(unittest.TestCase):
+  def test_buckets(self):
+    h = threading_utils.Histogram(1)
+    for i in (0, 1, 2, 3, 9):
+      h.add(i)
+    expected = {
+      'buckets': [[1, 2], [2, 1], [4, 1], [16, 1]],
+      'count': 5,
+      'max': 9,
+      'sum': 15,
+    }
+    self.assertEqual(expected, h.get_stats())
+
+
 class FakeProgress(object):
   @staticmethod
   def print_update():
@@ -9,6 +9,7 @@ is running and thus it caches results of functions that depend on FS state.
 """
 
 import ctypes
+import errno
 import getpass
 import logging
 import os
@@ -25,7 +26,11 @@ from utils import tools
 
 
 # Types of action accepted by link_file().
-HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, COPY = range(1, 5)
+HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, COPY, REFLINK_WITH_FALLBACK = (
+    range(1, 6))
+
+# ioctl request to clone a file, _IOW(0x94, 9, int) in linux/fs.h.
+_FICLONE = 0x40049409
 
 
 ## OS-specific imports
@@ -39,6 +44,8 @@ if sys.platform == 'win32':
 elif sys.platform == 'darwin':
   import Carbon.File  #  pylint: disable=F0401
   import MacOS  # pylint: disable=F0401
+else:
+  import fcntl
 
 
 if sys.platform == 'win32':
@@ -675,6 +682,28 @@ def hardlink(source, link_name):
     fs.link(source, link_name)
 
 
+def reflink(source, link_name):
+  """Creates a copy-on-write clone of a file.
+
+  The clone shares the data blocks of |source| until either file is modified,
+  so it is as cheap as a hardlink but it is a distinct file node. Only
+  supported on linux by the file systems implementing FICLONE, like btrfs and
+  XFS. Raises OSError otherwise.
+  """
+  assert isinstance(source, unicode), source
+  assert isinstance(link_name, unicode), link_name
+  if not sys.platform.startswith('linux'):
+    raise OSError(errno.EOPNOTSUPP, 'reflink is not supported on this OS')
+  with fs.open(source, 'rb') as src:
+    try:
+      with fs.open(link_name, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except (IOError, OSError) as e:
+      try_remove(link_name)
+      raise OSError(e.errno, e.strerror)
+  fs.chmod(link_name, fs.stat(source).st_mode)
+
+
 def readable_copy(outfile, infile):
   """Makes a copy of the file that is readable by everyone."""
   fs.copy2(infile, outfile)
@@ -735,7 +764,8 @@ def link_file(outfile, infile, action):
   Returns:
     True if the action was caried on, False if fallback was used.
   """
-  if action not in (HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, COPY):
+  if action not in (
+      HARDLINK, HARDLINK_WITH_FALLBACK, SYMLINK, COPY, REFLINK_WITH_FALLBACK):
     raise ValueError('Unknown mapping action %s' % action)
   if not fs.isfile(infile):
     raise OSError('%s is missing' % infile)
@@ -749,6 +779,17 @@ def link_file(outfile, infile, action):
   elif action == SYMLINK and sys.platform != 'win32':
     # On windows, symlink are converted to hardlink and fails over to copy.
     fs.symlink(infile, outfile)  # pylint: disable=E1101
+  elif action == REFLINK_WITH_FALLBACK:
+    try:
+      reflink(infile, outfile)
+    except OSError as e:
+      # The file system doesn't support it or it is a different file system.
+      logging.debug(
+          'Failed to reflink, failing back to copy %s to %s: %s' % (
+            infile, outfile, e))
+      readable_copy(outfile, infile)
+      # Signal caller that fallback copy was used.
+      return False
   else:
     # HARDLINK or HARDLINK_WITH_FALLBACK.
     try:
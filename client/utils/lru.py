@@ -6,6 +6,19 @@
 
 import collections
 import json
+import logging
+import marshal
+import os
+import sys
+
+
+# Header of the binary journal, see LRUDict.load_journal().
+JOURNAL_HEADER = ('lru', 1)
+
+
+# The journal is compacted when it holds more than this number of records in
+# addition to twice the number of items.
+JOURNAL_SLACK = 1000
 
 
 class LRUDict(object):
@@ -15,7 +28,8 @@ class LRUDict(object):
   (key, value) pairs in order they are inserted and can effectively pop oldest
   items.
 
-  Can also store its state as *.json file on disk.
+  Can also store its state as *.json file on disk, or as a binary append-only
+  journal that only needs to be written the changes done since it was loaded.
   """
 
   def __init__(self):
@@ -23,6 +37,12 @@ class LRUDict(object):
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Records not yet appended to the journal.
+    self._journal = []
+    # Number of records appended to the journal since it was last compacted.
+    self._journal_records = 0
+    # True if the journal must be rewritten from scratch on the next save.
+    self._journal_compact = True
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -76,6 +96,89 @@ class LRUDict(object):
     lru._dirty = False
     return lru
 
+  @classmethod
+  def load_journal(cls, state_file):
+    """Loads state saved by save_journal() and returns LRUDict in that state.
+
+    The journal is a sequence of marshal records: a header, a snapshot of all
+    the (key, value) pairs and then the ('a', key, value) and ('d', key)
+    records appended by save_journal() since the last compaction.
+
+    A truncated last record, caused by a process interrupted while appending,
+    is ignored.
+
+    Raises ValueError if state file is corrupted.
+    """
+    lru = cls()
+    try:
+      with open(state_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if marshal.load(f) != JOURNAL_HEADER:
+          raise ValueError('unexpected header')
+        state = marshal.load(f)
+        if not isinstance(state, list):
+          raise ValueError('snapshot should be a list')
+        for pair in state:
+          if not isinstance(pair, tuple) or len(pair) != 2:
+            raise ValueError('expecting pairs: %s' % (pair,))
+          lru._items[pair[0]] = pair[1]
+        if len(lru) != len(state):
+          raise ValueError('found duplicate keys')
+        lru._journal_compact = False
+        while f.tell() < size:
+          try:
+            record = marshal.load(f)
+          except (EOFError, ValueError) as e:
+            logging.warning(
+                'Ignoring truncated record in %s: %s', state_file, e)
+            lru._journal_compact = True
+            break
+          if record[0] == 'a' and len(record) == 3:
+            lru._items.pop(record[1], None)
+            lru._items[record[1]] = record[2]
+          elif record[0] == 'd' and len(record) == 2:
+            lru._items.pop(record[1], None)
+          else:
+            raise ValueError('unexpected record: %s' % (record,))
+          lru._journal_records += 1
+    except (IOError, EOFError, ValueError, TypeError, IndexError) as e:
+      raise ValueError('Broken state file %s: %s' % (state_file, e))
+
+    lru._dirty = False
+    return lru
+
+  def save_journal(self, state_file):
+    """Saves cache state as a binary journal if it was modified.
+
+    Only appends the changes done since the last load or save, unless the
+    journal grew too large compared to the number of items, in which case it is
+    compacted by writing a new snapshot.
+    """
+    if not self._journal_compact and not self._journal:
+      return False
+
+    if (self._journal_compact or
+        self._journal_records + len(self._journal) >
+            2 * len(self._items) + JOURNAL_SLACK):
+      tmp = state_file + '.tmp'
+      with open(tmp, 'wb') as f:
+        marshal.dump(JOURNAL_HEADER, f)
+        marshal.dump(self._items.items(), f)
+      if sys.platform == 'win32' and os.path.isfile(state_file):
+        os.remove(state_file)
+      os.rename(tmp, state_file)
+      self._journal_records = 0
+      self._journal_compact = False
+    else:
+      with open(state_file, 'ab') as f:
+        for record in self._journal:
+          marshal.dump(record, f)
+      self._journal_records += len(self._journal)
+
+    self._journal = []
+    self._dirty = False
+    return True
+
   def save(self, state_file):
     """Saves cache state to a file if it was modified."""
     if not self._dirty:
@@ -92,6 +195,7 @@ class LRUDict(object):
     self._items.pop(key, None)
     self._items[key] = value
     self._dirty = True
+    self._log(('a', key, value))
 
   def batch_insert_oldest(self, items):
     """Prepends list of |items| to the dict, marks them as least recently used.
@@ -113,6 +217,8 @@ class LRUDict(object):
 
     self._items = new_items
     self._dirty = True
+    self._journal_compact = True
+    self._journal = []
 
   def keys_set(self):
     """Set of keys of items in this dict."""
@@ -127,8 +233,10 @@ class LRUDict(object):
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = self._items.pop(key)
+    value = self._items.pop(key)
+    self._items[key] = value
     self._dirty = True
+    self._log(('a', key, value))
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
@@ -137,6 +245,7 @@ class LRUDict(object):
     """
     value = self._items.pop(key)
     self._dirty = True
+    self._log(('d', key))
     return value
 
   def get_oldest(self):
@@ -155,8 +264,20 @@ class LRUDict(object):
     """
     pair = self._items.popitem(last=False)
     self._dirty = True
+    self._log(('d', pair[0]))
     return pair
 
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
     return self._items.itervalues()
+
+  def _log(self, record):
+    """Queues a record to be appended to the journal on the next save."""
+    if self._journal_compact:
+      return
+    if len(self._journal) > len(self._items) + JOURNAL_SLACK:
+      # The snapshot would be smaller, stop accumulating records.
+      self._journal_compact = True
+      self._journal = []
+      return
+    self._journal.append(record)
@@ -69,6 +69,10 @@ CONTENT_ENCODERS = {
 }
 
 
+# Default maximum number of connections kept open per host by
+# RequestsLibEngine.
+CONNECTION_POOL_SIZE = 64
+
 # Google Storage URL regular expression.
 GS_STORAGE_HOST_URL_RE = re.compile(r'https://.*\.storage\.googleapis\.com')
 
@@ -89,6 +93,11 @@ _auth_config = None
 # Default is RequestsLibEngine.
 _request_engine_cls = None
 
+# Connection pools configuration of RequestsLibEngine. Can be changed by
+# 'configure_connection_pools'.
+_connection_pool_size = CONNECTION_POOL_SIZE
+_tcp_keep_alive = False
+
 
 class NetError(IOError):
   """Generic network related error."""
@@ -134,6 +143,64 @@ def get_engine_class():
   return _request_engine_cls or RequestsLibEngine
 
 
+def configure_connection_pools(pool_size=None, tcp_keep_alive=None):
+  """Globally changes the connection pools of RequestsLibEngine.
+
+  Each HttpService, so each host, has its own engine and its own pools, so the
+  isolate server and the Google Storage hosts it redirects to don't compete
+  for connections.
+
+  Arguments:
+    pool_size: maximum number of connections kept open per host. It should be
+        at least the number of threads sending requests concurrently, any
+        connection beyond it is closed after use and a new one, with a new TLS
+        handshake, has to be opened for the next request. The existing pools
+        are resized.
+    tcp_keep_alive: if True, enables TCP keep-alive on the connections so
+        idle ones are not silently dropped by the network. The existing pools
+        are replaced.
+  """
+  global _connection_pool_size
+  global _tcp_keep_alive
+  changed = False
+  if tcp_keep_alive is not None and tcp_keep_alive != _tcp_keep_alive:
+    _tcp_keep_alive = tcp_keep_alive
+    changed = True
+  if pool_size is not None and pool_size != _connection_pool_size:
+    _connection_pool_size = pool_size
+    changed = True
+  if changed:
+    with _http_services_lock:
+      services = _http_services.values()
+    for service in services:
+      if isinstance(service.engine, RequestsLibEngine):
+        service.engine.set_pool_size(_connection_pool_size)
+
+
+def ensure_connection_pool_size(threads):
+  """Grows the connection pools to fit |threads| concurrent requests per host.
+  """
+  if threads > _connection_pool_size:
+    configure_connection_pools(pool_size=threads)
+
+
+def get_connection_stats():
+  """Returns the number of requests sent and connections opened, all hosts
+  combined.
+
+  A request not opening a connection reused a kept alive one.
+  """
+  out = {'requests': 0, 'connections': 0}
+  with _http_services_lock:
+    services = _http_services.values()
+  for service in services:
+    stats = getattr(service.engine, 'get_connection_stats', None)
+    if stats:
+      for k, v in stats().iteritems():
+        out[k] += v
+  return out
+
+
 def url_open(url, **kwargs):  # pylint: disable=W0621
   """Attempts to open the given url multiple times.
 
@@ -370,7 +437,8 @@ class HttpService(object):
       stream=True,
       method=None,
       headers=None,
-      follow_redirects=True):
+      follow_redirects=True,
+      raise_http_error=False):
     """Attempts to open the given url multiple times.
 
     |urlpath| is relative to the server root, i.e. '/some/request?param=1'.
@@ -380,6 +448,9 @@ class HttpService(object):
       - str for pre-encoded data
       - list for data to be form-encoded
       - dict for data to be form-encoded
+      - callable that returns an iterable of str chunks. It is called once per
+        attempt and the body is sent with chunked transfer encoding, so it is
+        never fully buffered in memory.
 
     - Optionally retries HTTP 404 and 50x.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
@@ -400,6 +471,10 @@ class HttpService(object):
     otherwise redirect response will be returned as is. It can be recognized
     by the presence of 'Location' response header.
 
+    If |raise_http_error| is True, an HttpError that is not retried, e.g. a 404,
+    is raised instead of returning None, so the caller can tell it apart from
+    a transient failure.
+
     If |read_timeout| is not None will configure underlying socket to
     raise TimeoutError exception whenever there's no response from the server
     for more than |read_timeout| seconds. It can happen during any read
@@ -417,7 +492,11 @@ class HttpService(object):
       assert method in (None, 'DELETE', 'POST', 'PUT')
       method = method or 'POST'
       content_type = content_type or DEFAULT_CONTENT_TYPE
-      body = self.encode_request_body(data, content_type)
+      if callable(data):
+        # Streamed body, a new stream is generated on each attempt.
+        body = data
+      else:
+        body = self.encode_request_body(data, content_type)
     else:
       assert method in (None, 'DELETE', 'GET')
       method = method or 'GET'
@@ -432,7 +511,8 @@ class HttpService(object):
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
     if body is not None:
-      headers['Content-Length'] = len(body)
+      if not callable(body):
+        headers['Content-Length'] = len(body)
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -449,7 +529,8 @@ class HttpService(object):
       try:
         # Prepare and send a new request.
         request = HttpRequest(
-            method, resource_url, query_params, body,
+            method, resource_url, query_params,
+            body() if callable(body) else body,
             headers, read_timeout, stream, follow_redirects)
         if self.authenticator:
           self.authenticator.authorize(request)
@@ -500,6 +581,8 @@ class HttpService(object):
           logging.warning(
               'Able to connect to %s but an exception was thrown.\n%s',
               request.get_full_url(), self._format_error(e, verbose=True))
+          if raise_http_error:
+            raise
           return None
 
         # Retry all other errors.
@@ -579,7 +662,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or iterable of str)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket
@@ -673,6 +756,17 @@ class Authenticator(object):
     """Purges access credentials from local cache."""
 
 
+class _KeepAliveHTTPAdapter(adapters.HTTPAdapter):
+  """HTTPAdapter that enables TCP keep-alive on its connections."""
+
+  def init_poolmanager(self, *args, **kwargs):
+    connection_cls = requests.packages.urllib3.connection.HTTPConnection
+    kwargs['socket_options'] = connection_cls.default_socket_options + [
+      (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    super(_KeepAliveHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+
 class RequestsLibEngine(object):
   """Class that knows how to execute HttpRequests via requests library."""
 
@@ -706,13 +800,51 @@ class RequestsLibEngine(object):
     # Configure session.
     self.session.trust_env = False
     self.session.verify = tools.get_cacerts_bundle()
-    # Configure connection pools.
+    self._lock = threading.Lock()
+    # Counters of the pools that were replaced by set_pool_size().
+    self._retired_stats = {'requests': 0, 'connections': 0}
+    self._mount_adapters(_connection_pool_size)
+
+  def _mount_adapters(self, pool_size):
+    """Configures connection pools."""
+    adapter_cls = (
+        _KeepAliveHTTPAdapter if _tcp_keep_alive else adapters.HTTPAdapter)
     for protocol in ('https://', 'http://'):
-      self.session.mount(protocol, adapters.HTTPAdapter(
+      adapter = adapter_cls(
           pool_connections=64,
-          pool_maxsize=64,
+          pool_maxsize=pool_size,
           max_retries=0,
-          pool_block=False))
+          pool_block=False)
+      self.session.mount(protocol, adapter)
+
+  def set_pool_size(self, pool_size):
+    """Replaces the connection pools with ones holding |pool_size| connections.
+
+    The connections in the current pools are dropped.
+    """
+    with self._lock:
+      old = self.session.adapters.values()
+      self._mount_adapters(pool_size)
+      self._add_pools_stats(self._retired_stats, old)
+    for adapter in old:
+      adapter.close()
+
+  def get_connection_stats(self):
+    """Returns the number of requests sent and connections opened."""
+    with self._lock:
+      out = self._retired_stats.copy()
+      self._add_pools_stats(out, self.session.adapters.values())
+    return out
+
+  @staticmethod
+  def _add_pools_stats(out, adapters_list):
+    for adapter in adapters_list:
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools.get(key)
+        if pool:
+          out['requests'] += pool.num_requests
+          out['connections'] += pool.num_connections
 
   def perform_request(self, request):
     """Sends a HttpRequest to the server and reads back the response.
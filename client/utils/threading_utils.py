@@ -5,6 +5,7 @@
 """Classes and functions related to threading."""
 
 import functools
+import heapq
 import inspect
 import logging
 import os
@@ -59,14 +60,302 @@ class ThreadPoolClosed(ThreadPoolError):
   pass
 
 
+class AdaptiveLimit(object):
+  """Limit adjusted with additive increase / multiplicative decrease (AIMD).
+
+  The limit grows by |step| on every success until the first failure (slow
+  start), then by |step| every limit / step successes. A failure halves it, at
+  most once per epoch: the failures of operations started before the last
+  decrease are ignored since they were started at the higher limit.
+  """
+
+  def __init__(self, initial, minimum, maximum, step=1):
+    assert 0 < minimum <= initial <= maximum, (minimum, initial, maximum)
+    self._lock = threading.Lock()
+    self._limit = float(initial)
+    self._minimum = minimum
+    self._maximum = maximum
+    self._step = step
+    self._slow_start = True
+    # Incremented on every decrease.
+    self._epoch = 0
+    self._peak = initial
+    self._successes = 0
+    self._failures = 0
+    self._decreases = 0
+
+  @property
+  def value(self):
+    """Current limit, as an int."""
+    return int(self._limit)
+
+  @property
+  def epoch(self):
+    """Value to pass to on_failure() for an operation starting now."""
+    return self._epoch
+
+  def on_success(self):
+    with self._lock:
+      self._successes += 1
+      if self._slow_start:
+        self._limit += self._step
+      else:
+        self._limit += float(self._step * self._step) / self._limit
+      self._limit = min(self._limit, self._maximum)
+      self._peak = max(self._peak, int(self._limit))
+
+  def on_failure(self, epoch):
+    with self._lock:
+      self._failures += 1
+      if epoch != self._epoch:
+        return
+      self._epoch += 1
+      self._decreases += 1
+      self._slow_start = False
+      self._limit = max(self._limit / 2, self._minimum)
+
+  def get_stats(self):
+    """Returns the state as a dict, e.g. for run_isolated stats."""
+    with self._lock:
+      return {
+        'limit': int(self._limit),
+        'peak': self._peak,
+        'successes': self._successes,
+        'failures': self._failures,
+        'decreases': self._decreases,
+      }
+
+
+class AdaptiveConcurrency(AdaptiveLimit):
+  """AdaptiveLimit on the number of tasks a ThreadPool runs concurrently.
+
+  A worker thread acquires a slot before taking a task from the queue, so tasks
+  still start in priority order, and releases it once the task is done. The
+  task is deemed successful unless record_failure() was called meanwhile.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(AdaptiveConcurrency, self).__init__(*args, **kwargs)
+    self._slot_freed = threading.Condition(self._lock)
+    self._in_flight = 0
+    # Epoch at which the slot of the current thread was acquired, or None if
+    # a failure was already recorded for it.
+    self._local = threading.local()
+
+  def acquire(self, timeout):
+    """Waits up to |timeout| seconds for a slot. Returns True if acquired."""
+    with self._slot_freed:
+      if self._in_flight >= int(self._limit):
+        self._slot_freed.wait(timeout)
+        if self._in_flight >= int(self._limit):
+          return False
+      self._in_flight += 1
+      self._local.epoch = self._epoch
+    return True
+
+  def record_failure(self):
+    """Marks the task running in the current thread's slot as failed."""
+    epoch = getattr(self._local, 'epoch', None)
+    if epoch is not None:
+      self._local.epoch = None
+      self.on_failure(epoch)
+
+  def release(self, completed=True):
+    """Releases the slot of the current thread.
+
+    Arguments:
+      completed: False if no task ran in the slot.
+    """
+    if self._local.epoch is not None:
+      self._local.epoch = None
+      if completed:
+        self.on_success()
+    with self._slot_freed:
+      self._in_flight -= 1
+      self._slot_freed.notifyAll()
+
+
+class Histogram(object):
+  """Counts values in buckets whose upper bounds are |first| * 2**i.
+
+  Not thread safe.
+  """
+
+  def __init__(self, first):
+    self._first = first
+    self._buckets = {}
+    self._count = 0
+    self._sum = 0
+    self._max = 0
+
+  def add(self, value):
+    bucket = 0
+    upper = self._first
+    while value > upper:
+      bucket += 1
+      upper *= 2
+    self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+    self._count += 1
+    self._sum += value
+    self._max = max(self._max, value)
+
+  def get_stats(self):
+    """Returns a dict with the list of non empty [upper bound, count]."""
+    return {
+      'buckets': [
+        [self._first * 2**i, self._buckets[i]] for i in sorted(self._buckets)
+      ],
+      'count': self._count,
+      'max': self._max,
+      'sum': self._sum,
+    }
+
+
+class TaskHints(object):
+  """Describes a task to the Scheduler of a ThreadPool."""
+
+  def __init__(self, flow=None, weight=1, deadline=None, size=None):
+    """
+    Arguments:
+      flow: hashable identifying the flow of tasks it belongs to, e.g. the
+            TaskChannel receiving its result. Used by WeightedFairScheduler.
+      weight: share of the workers the flow is entitled to, relative to the
+              other flows.
+      deadline: time.time() by which the task should start, None if none.
+      size: cost of the task, e.g. number of bytes to transfer, None if
+            unknown.
+    """
+    assert weight > 0, weight
+    self.flow = flow
+    self.weight = weight
+    self.deadline = deadline
+    self.size = size
+
+
+_NO_HINTS = TaskHints()
+
+
+class Scheduler(Queue.Queue):
+  """Queue of ThreadPool tasks in FIFO order within each priority.
+
+  Subclasses change the order of the tasks of equal priority by overriding
+  key(). The depth of the queue when a task is added and the time a task
+  waited in it are recorded in histograms.
+
+  The items are the tuples (priority, index, hints, func, args, kwargs) added
+  by ThreadPool, or None to stop a worker.
+  """
+
+  def _init(self, maxsize):
+    self.queue = []
+    self.depth = Histogram(1)
+    self.wait = Histogram(0.001)
+
+  def _qsize(self, len=len):
+    return len(self.queue)
+
+  def _put(self, item):
+    self.depth.add(len(self.queue))
+    if item is None:
+      # Like with Queue.PriorityQueue, workers are stopped first.
+      key = ()
+    else:
+      key = (item[0],) + self.key(item[2] or _NO_HINTS) + (item[1],)
+    heapq.heappush(self.queue, (key, time.time(), item))
+
+  def _get(self):
+    _key, added, item = heapq.heappop(self.queue)
+    self.wait.add(time.time() - added)
+    if item is not None:
+      self.on_get(item[2] or _NO_HINTS)
+    return item
+
+  def key(self, _hints):
+    """Returns the tuple ordering a task among the ones of the same priority.
+
+    Called with the queue lock held.
+    """
+    return ()
+
+  def on_get(self, hints):
+    """Called with the queue lock held when a task is dequeued."""
+    pass
+
+  def get_stats(self):
+    """Returns the queue depth and wait time (in seconds) histograms."""
+    with self.mutex:
+      return {
+        'depth': self.depth.get_stats(),
+        'wait': self.wait.get_stats(),
+      }
+
+
+class SizeScheduler(Scheduler):
+  """Runs the smallest tasks first to maximize the number of tasks per second.
+
+  Tasks of unknown size run last.
+  """
+
+  def key(self, hints):
+    return (float('inf') if hints.size is None else hints.size,)
+
+
+class DeadlineScheduler(Scheduler):
+  """Runs the tasks with the earliest deadline first.
+
+  Tasks without a deadline run last, in FIFO order.
+  """
+
+  def key(self, hints):
+    return (float('inf') if hints.deadline is None else hints.deadline,)
+
+
+class WeightedFairScheduler(Scheduler):
+  """Shares the workers between the flows of tasks in proportion to their
+  weight, with weighted fair queuing.
+
+  Each task is assigned a virtual finish time, its size (1 if unknown) divided
+  by the weight of its flow after the finish time of the previous task of the
+  flow, and the tasks run by increasing finish time. So a flow adding many
+  tasks at once doesn't starve the others.
+  """
+
+  def _init(self, maxsize):
+    Scheduler._init(self, maxsize)
+    self._virtual_time = 0.
+    # Finish time of the last task of each flow.
+    self._finish = {}
+
+  def key(self, hints):
+    start = max(self._virtual_time, self._finish.get(hints.flow, 0.))
+    finish = start + float(hints.size or 1) / hints.weight
+    self._finish[hints.flow] = finish
+    return (finish,)
+
+  def _get(self):
+    key = self.queue[0][0]
+    item = Scheduler._get(self)
+    if item is not None:
+      self._virtual_time = key[1]
+      if len(self._finish) > 1000:
+        # Forget the flows without queued tasks.
+        self._finish = {
+          k: v for k, v in self._finish.iteritems() if v > self._virtual_time
+        }
+    return item
+
+
 class ThreadPool(object):
   """Multithreaded worker pool with priority support.
 
-  When the priority of tasks match, it works in strict FIFO mode.
+  When the priority of tasks match, they are run in the order of the
+  Scheduler, by default in strict FIFO mode.
   """
-  QUEUE_CLASS = Queue.PriorityQueue
+  QUEUE_CLASS = Scheduler
 
-  def __init__(self, initial_threads, max_threads, queue_size, prefix=None):
+  def __init__(
+      self, initial_threads, max_threads, queue_size, prefix=None,
+      concurrency=None, scheduler=None):
     """Immediately starts |initial_threads| threads.
 
     Arguments:
@@ -79,6 +368,10 @@ class ThreadPool(object):
                   blocking.
       prefix: Prefix to use for thread names. Pool's threads will be
               named '<prefix>-<thread index>'.
+      concurrency: optional AdaptiveConcurrency limiting the number of tasks
+                   running at once, at most |max_threads|.
+      scheduler: Scheduler subclass ordering the tasks of the same priority,
+                 QUEUE_CLASS if None.
     """
     prefix = prefix or 'tp-0x%0x' % id(self)
     logging.debug(
@@ -87,9 +380,10 @@ class ThreadPool(object):
     assert initial_threads <= max_threads
     assert max_threads <= 1024
 
-    self.tasks = self.QUEUE_CLASS(queue_size)
+    self.tasks = (scheduler or self.QUEUE_CLASS)(queue_size)
     self._max_threads = max_threads
     self._prefix = prefix
+    self._concurrency = concurrency
 
     # Used to assign indexes to tasks.
     self._num_of_added_tasks_lock = threading.Lock()
@@ -149,7 +443,19 @@ class ThreadPool(object):
       Index of the item added, e.g. the total number of enqueued items up to
       now.
     """
+    return self._add_task(priority, None, func, args, kwargs)
+
+  def add_task_with_hints(self, priority, hints, func, *args, **kwargs):
+    """Adds a task described by |hints| to the Scheduler, see add_task().
+
+    Arguments:
+    - hints: TaskHints instance or None.
+    """
+    return self._add_task(priority, hints, func, args, kwargs)
+
+  def _add_task(self, priority, hints, func, args, kwargs):
     assert isinstance(priority, int)
+    assert hints is None or isinstance(hints, TaskHints), hints
     assert callable(func)
     with self._lock:
       if self._is_closed:
@@ -164,7 +470,7 @@ class ThreadPool(object):
     with self._num_of_added_tasks_lock:
       self._num_of_added_tasks += 1
       index = self._num_of_added_tasks
-    self.tasks.put((priority, index, func, args, kwargs))
+    self.tasks.put((priority, index, hints, func, args, kwargs))
     if start_new_worker:
       self._add_worker()
     return index
@@ -176,6 +482,12 @@ class ThreadPool(object):
       self._starting -= 1
       self._ready += 1
     while True:
+      has_slot = False
+      while self._concurrency and not has_slot:
+        has_slot = self._concurrency.acquire(0.1)
+        if self._is_closed:
+          # Do not hold the pool while it is closing.
+          break
       try:
         task = self.tasks.get()
       finally:
@@ -185,7 +497,7 @@ class ThreadPool(object):
         if task is None:
           # We're done.
           return
-        _priority, _index, func, args, kwargs = task
+        _priority, _index, _hints, func, args, kwargs = task
         if inspect.isgeneratorfunction(func):
           for out in func(*args, **kwargs):
             self._output_append(out)
@@ -194,12 +506,16 @@ class ThreadPool(object):
           self._output_append(out)
       except Exception as e:
         logging.warning('Caught exception: %s', e)
+        if has_slot:
+          self._concurrency.record_failure()
         exc_info = sys.exc_info()
         logging.info(''.join(traceback.format_tb(exc_info[2])))
         with self._outputs_exceptions_cond:
           self._exceptions.append(exc_info)
           self._outputs_exceptions_cond.notifyAll()
       finally:
+        if has_slot:
+          self._concurrency.release(task is not None)
         try:
           # Mark thread as ready again, mark task as processed. Do it before
           # waking up threads waiting on self.tasks.join(). Otherwise they might
@@ -313,6 +629,10 @@ class ThreadPool(object):
       except Queue.Empty:
         return index
 
+  def get_scheduler_stats(self):
+    """Returns the queue depth and wait time histograms of the Scheduler."""
+    return self.tasks.get_stats()
+
   def _on_iter_results_step(self):
     pass
 
@@ -347,31 +667,39 @@ class AutoRetryThreadPool(ThreadPool):
     """Tasks added must not use the lower priority bits since they are reserved
     for retries.
     """
-    assert (priority & self.INTERNAL_PRIORITY_BITS) == 0
-    return super(AutoRetryThreadPool, self).add_task(
-        priority,
-        self._task_executer,
-        priority,
-        None,
-        func,
-        *args,
-        **kwargs)
+    return self.add_task_with_channel_and_hints(
+        None, priority, None, func, *args, **kwargs)
+
+  def add_task_with_hints(self, priority, hints, func, *args, **kwargs):
+    """Tasks added must not use the lower priority bits since they are reserved
+    for retries.
+    """
+    return self.add_task_with_channel_and_hints(
+        None, priority, hints, func, *args, **kwargs)
 
   def add_task_with_channel(self, channel, priority, func, *args, **kwargs):
     """Tasks added must not use the lower priority bits since they are reserved
     for retries.
     """
+    return self.add_task_with_channel_and_hints(
+        channel, priority, None, func, *args, **kwargs)
+
+  def add_task_with_channel_and_hints(
+      self, channel, priority, hints, func, *args, **kwargs):
+    """Tasks added must not use the lower priority bits since they are reserved
+    for retries.
+
+    The retries keep the same |hints|.
+    """
     assert (priority & self.INTERNAL_PRIORITY_BITS) == 0
-    return super(AutoRetryThreadPool, self).add_task(
+    return self._add_task(
         priority,
+        hints,
         self._task_executer,
-        priority,
-        channel,
-        func,
-        *args,
-        **kwargs)
+        (priority, hints, channel, func) + args,
+        kwargs)
 
-  def _task_executer(self, priority, channel, func, *args, **kwargs):
+  def _task_executer(self, priority, hints, channel, func, *args, **kwargs):
     """Wraps the function and automatically retry on exceptions."""
     try:
       result = func(*args, **kwargs)
@@ -380,6 +708,8 @@ class AutoRetryThreadPool(ThreadPool):
       channel.send_result(result)
     # pylint: disable=catching-non-exception
     except self._swallowed_exceptions as e:
+      if self._concurrency:
+        self._concurrency.record_failure()
       # Retry a few times, lowering the priority.
       actual_retries = priority & self.INTERNAL_PRIORITY_BITS
       if actual_retries < self._retries:
@@ -387,14 +717,12 @@ class AutoRetryThreadPool(ThreadPool):
         logging.debug(
             'Swallowed exception \'%s\'. Retrying at lower priority %X',
             e, priority)
-        super(AutoRetryThreadPool, self).add_task(
+        self._add_task(
             priority,
+            hints,
             self._task_executer,
-            priority,
-            channel,
-            func,
-            *args,
-            **kwargs)
+            (priority, hints, channel, func) + args,
+            kwargs)
         return
       if channel is None:
         raise
@@ -416,14 +744,21 @@ class IOAutoRetryThreadPool(AutoRetryThreadPool):
   MAX_WORKERS = 16 if sys.maxsize > 2L**32 else 8
   RETRIES = 5
 
-  def __init__(self):
+  def __init__(self, concurrency=None, scheduler=None):
+    """
+    Arguments:
+      concurrency: optional AdaptiveConcurrency, see ThreadPool.
+      scheduler: optional Scheduler subclass, see ThreadPool.
+    """
     super(IOAutoRetryThreadPool, self).__init__(
         [IOError],
         self.RETRIES,
         self.INITIAL_WORKERS,
         self.MAX_WORKERS,
         0,
-        'io')
+        'io',
+        concurrency,
+        scheduler)
 
 
 class Progress(object):
@@ -533,10 +868,10 @@ class Progress(object):
     return '/'.join(i.rjust(max_len) for i in columns_as_str)
 
 
-class QueueWithProgress(Queue.PriorityQueue):
+class QueueWithProgress(Scheduler):
   """Implements progress support in join()."""
   def __init__(self, progress, *args, **kwargs):
-    Queue.PriorityQueue.__init__(self, *args, **kwargs)
+    Scheduler.__init__(self, *args, **kwargs)
     self.progress = progress
 
   def task_done(self):